@@ -0,0 +1,89 @@
+"""
+Measures how many urls/sec `URLAdmission` handles, compared to running the
+checks the old way (`URLValidator`, `URLFilter` then `TLDFilter`).
+
+Run from the project root:
+    python -m benchmarks.bench_admission [--urls N]
+"""
+
+import argparse
+import random
+import re
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from rfc3986 import is_valid_uri
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.url import canonicalize_url
+
+from crawler.middleware.admission import URLAdmission
+
+
+def make_urls(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    settings = get_project_settings()
+    tlds = settings.getlist("ALLOWED_TLDS") + ["com", "org", "net"]
+    hosts = [f"site{i}.{rng.choice(tlds)}" for i in range(200)] + ["grep.geek"]
+    urls = []
+    for _ in range(n):
+        host = rng.choice(hosts)
+        path = "/".join(f"p{rng.randrange(50)}" for _ in range(rng.randrange(4)))
+        query = rng.choice(["", "?q=opennic&b=2", "?cmd=Search&s=DRP", "?cc=1"])
+        scheme = rng.choice(["http", "http", "https", "ftp"])
+        urls.append(f"{scheme}://{host}/{path}{query}")
+    return urls
+
+
+def legacy_admit(urls, whitelist, blacklist, tld_pattern):
+    admitted = []
+    for url in urls:
+        if not is_valid_uri(url):
+            continue
+        url = canonicalize_url(url)
+        if not (
+            (whitelist and re.match(whitelist, url))
+            or (blacklist and not re.match(blacklist, url))
+        ):
+            continue
+        if not url.lower().startswith("http"):
+            continue
+        if re.match(tld_pattern, urlsplit(url).netloc):
+            admitted.append(url)
+    return admitted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--urls", type=int, default=100_000)
+    args = parser.parse_args()
+
+    settings = get_project_settings()
+    urls = make_urls(args.urls)
+    blacklist = settings.getlist("URL_BLACKLIST")
+    blacklist_pattern = (
+        re.compile(r"https?://(" + r"|".join(blacklist) + r")") if blacklist else None
+    )
+    tld_pattern = re.compile(
+        r".*\.(" + r"|".join(settings.getlist("ALLOWED_TLDS")) + r")$"
+    )
+
+    start = perf_counter()
+    legacy = legacy_admit(urls, None, blacklist_pattern, tld_pattern)
+    legacy_time = perf_counter() - start
+
+    admission = URLAdmission.from_settings(settings)
+    start = perf_counter()
+    admitted = admission.admit_many(urls)
+    admission_time = perf_counter() - start
+
+    print(f"urls: {len(urls)}")
+    print(
+        f"legacy:      {len(urls) / legacy_time:>12.0f} urls/sec ({len(legacy)} admitted)"
+    )
+    print(
+        f"admit_many:  {len(urls) / admission_time:>12.0f} urls/sec ({len(admitted)} admitted, deduplicated)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Measures how long a new process takes to serve its first searches (as `web.rs`, or a `serve` worker, does when it starts),
+with and without `warmup`, and checks it against a bound.
+
+Each run is a new Python process, which imports `crawler.whoosh_backend` the way `web.rs` does (with the project root on `sys.path`),
+warms up (or not), then searches every query once ("first") and again ("again").
+The queries are words and phrases from the index's documents (see `benchmarks.suite.make_queries`).
+The index is built from the synthetic corpus (see `benchmarks.corpus`), unless `--index` is given.
+The OS' cache isn't dropped between runs, so the index's files are already cached (as they would be if the index is being written to).
+
+The first searches after warming up should be about as fast as the ones after them:
+the exit status is 1 if they took more than `--max-ratio` times as long, or any first search took more than `--max-first-ms`.
+
+Run from the project root:
+    python -m benchmarks.bench_coldstart [--pages N | --index PATH] [--runs N] [--max-ratio X] [--max-first-ms MS]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from itertools import islice
+from statistics import median
+from typing import Any, Dict, List, Optional
+
+from benchmarks.corpus import make_pages
+from benchmarks.suite import bench_indexing, extract, make_queries
+from crawler.whoosh_backend import get_index, iter_documents
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in each new process, from the project root (which `web.rs` puts on `sys.path`)
+CHILD = """
+import json, sys
+from time import perf_counter
+storage_path, queries_path, warm = sys.argv[1], sys.argv[2], sys.argv[3] == "1"
+start = perf_counter()
+import crawler.whoosh_backend as whoosh_backend
+result = {"import": perf_counter() - start, "warmup": None}
+if warm:
+    start = perf_counter()
+    whoosh_backend.warmup(storage_path)
+    result["warmup"] = perf_counter() - start
+with open(queries_path, encoding="utf-8") as f:
+    queries = [line.strip() for line in f if line.strip()]
+for key in ("first", "again"):
+    result[key] = []
+    for query in queries:
+        start = perf_counter()
+        whoosh_backend.search_packed(query, storage_path)
+        result[key].append(perf_counter() - start)
+print(json.dumps(result))
+"""
+
+
+def run(storage_path: str, queries_path: str, warm: bool) -> Dict[str, Any]:
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, storage_path, queries_path, "1" if warm else "0"],
+        cwd=PROJECT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Optional[float]]:
+    """The median (over the runs) of the import and warmup times, and of the first and repeated searches' total and slowest, in ms."""
+
+    def ms(values: List[float]) -> float:
+        return median(values) * 1e3
+
+    return {
+        "import": ms([r["import"] for r in runs]),
+        "warmup": ms([r["warmup"] for r in runs]) if runs[0]["warmup"] is not None else None,
+        "first": ms([sum(r["first"]) for r in runs]),
+        "first_max": ms([max(r["first"]) for r in runs]),
+        "again": ms([sum(r["again"]) for r in runs]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument(
+        "--index", help="an existing index to use, instead of building one from the corpus"
+    )
+    parser.add_argument("--queries", type=int, default=5, help="queries of each kind")
+    parser.add_argument("--runs", type=int, default=3, help="processes started for each case")
+    parser.add_argument(
+        "--max-ratio",
+        type=float,
+        default=2.0,
+        help="the most the first searches (after warming up) may take, as a multiple of the same searches repeated",
+    )
+    parser.add_argument(
+        "--max-first-ms",
+        type=float,
+        default=None,
+        help="the most any first search (after warming up) may take",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage_path = os.path.abspath(args.index) if args.index else f"{temp_dir}/index"
+        if not args.index:
+            pages = make_pages(args.pages)
+            result = bench_indexing([extract(page) for page in pages], storage_path, 500)
+            print(f"built the index in {result['seconds']:.1f}s", file=sys.stderr)
+        ix = get_index(storage_path)
+        documents = list(islice(iter_documents(ix), 500))
+        ix.close()
+        queries = make_queries(documents, args.queries)
+        queries_path = f"{temp_dir}/queries.txt"
+        with open(queries_path, "w", encoding="utf-8") as f:
+            for search_terms in queries.values():
+                f.writelines(f"{search_term}\n" for search_term in search_terms)
+
+        cases = {
+            "cold": summarize([run(storage_path, queries_path, False) for _ in range(args.runs)]),
+            "warmed up": summarize([run(storage_path, queries_path, True) for _ in range(args.runs)]),
+        }
+
+    count = sum(len(search_terms) for search_terms in queries.values())
+    print(f"{count} queries, median of {args.runs} processes (ms)")
+    print(f"{'':<10} {'import':>8} {'warmup':>8} {'first':>8} {'slowest':>8} {'again':>8} {'ratio':>6}")
+    for name, case in cases.items():
+        warmup = f"{case['warmup']:>8.0f}" if case["warmup"] is not None else f"{'-':>8}"
+        print(
+            f"{name:<10} {case['import']:>8.0f} {warmup} {case['first']:>8.0f} "
+            f"{case['first_max']:>8.0f} {case['again']:>8.0f} {case['first'] / case['again']:>6.2f}"
+        )
+
+    warmed = cases["warmed up"]
+    failures = []
+    if warmed["first"] > args.max_ratio * warmed["again"]:
+        failures.append(
+            f"the first searches took {warmed['first'] / warmed['again']:.2f}x as long as repeating them (the bound is {args.max_ratio}x)"
+        )
+    if args.max_first_ms is not None and warmed["first_max"] > args.max_first_ms:
+        failures.append(
+            f"the slowest first search took {warmed['first_max']:.0f}ms (the bound is {args.max_first_ms:.0f}ms)"
+        )
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
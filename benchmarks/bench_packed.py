@@ -0,0 +1,118 @@
+"""
+Measures the per-result cost of handing search results across the Rust/Python boundary,
+as a dict of dicts (`search`) compared to one packed bytes object (`search_packed`).
+
+For dicts, the cost is building them, then reading every field back out (as `web.rs` used to, with the GIL held).
+For packed results, the cost is packing them, as the only other work done with the GIL held is copying the bytes.
+Unpacking them in Python is also measured, it's an upper bound for decoding them in Rust.
+
+Run from the project root:
+    python -m benchmarks.bench_packed [--results N] [--index PATH --query TERM]
+"""
+
+import argparse
+import random
+import string
+from time import perf_counter
+
+from crawler.whoosh_backend import pack_results, search, search_packed, unpack_results
+
+
+def make_results(n: int, seed: int = 0):
+    rng = random.Random(seed)
+
+    def words(count):
+        return " ".join(
+            "".join(rng.choices(string.ascii_lowercase, k=rng.randrange(3, 10)))
+            for _ in range(count)
+        )
+
+    return {
+        "valid": True,
+        "results": [
+            {
+                "url": f"http://site{rng.randrange(1000)}.geek/{words(3).replace(' ', '/')}",
+                "title": words(rng.randrange(2, 8)),
+                "depth": rng.randrange(6),
+                "snippet": f"{words(8)} <strong>opennic</strong> {words(12)}",
+            }
+            for _ in range(n)
+        ],
+        "duration": 0.01,
+        "total": n,
+        "exact": True,
+        "last": True,
+        "maxpage": 1,
+    }
+
+
+def read_dicts(results):
+    # what `web.rs` did with the dicts: read every field, converting each to a string
+    fields = []
+    for key in ("valid", "duration", "total", "exact", "last", "maxpage"):
+        fields.append(results[key])
+    for result in results["results"]:
+        fields.append(
+            (str(result["url"]), str(result["title"]), str(result["snippet"]))
+        )
+    return fields
+
+
+def copy_dicts(results):
+    # building the dicts (as `search` does), from values that already exist
+    return {
+        **results,
+        "results": [
+            {
+                "url": r["url"],
+                "title": r["title"],
+                "depth": r["depth"],
+                "snippet": r["snippet"],
+            }
+            for r in results["results"]
+        ],
+    }
+
+
+def timeit(function, *args, repeat: int):
+    start = perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--results", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=10_000)
+    parser.add_argument(
+        "--index", default=None, help="Also time real searches on this index."
+    )
+    parser.add_argument("--query", default="opennic")
+    args = parser.parse_args()
+
+    results = make_results(args.results)
+    n = len(results["results"])
+    dict_time = timeit(lambda: read_dicts(copy_dicts(results)), repeat=args.repeat)
+    pack_time = timeit(pack_results, results, repeat=args.repeat)
+    packed = pack_results(results)
+    unpack_time = timeit(unpack_results, packed, repeat=args.repeat)
+
+    print(f"results per page: {n}, packed size: {len(packed)} bytes")
+    print(f"dicts (build + read):   {dict_time / n * 1e6:>8.2f} µs/result")
+    print(f"packed (pack):          {pack_time / n * 1e6:>8.2f} µs/result")
+    print(f"packed (python unpack): {unpack_time / n * 1e6:>8.2f} µs/result")
+
+    if args.index:
+        repeat = max(1, args.repeat // 100)
+        search(args.query, args.index)  # opens the index
+        search_time = timeit(search, args.query, args.index, repeat=repeat)
+        packed_search_time = timeit(
+            search_packed, args.query, args.index, repeat=repeat
+        )
+        print(f"search:                 {search_time * 1e3:>8.2f} ms/query")
+        print(f"search_packed:          {packed_search_time * 1e3:>8.2f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compares phrase queries checked against word positions (whoosh's `Phrase`)
+with ones that use the `phrase_content` bigram field (`ShinglePhrase`), for 2, 3 and 4 word phrases.
+
+The words follow a Zipf distribution, so common words have long posting lists (as in real pages).
+A synthetic index (with `PhraseSchema`) is built in a temporary directory, unless `--index` is given.
+
+Run from the project root:
+    python -m benchmarks.bench_phrase [--docs N] [--index PATH]
+"""
+
+import argparse
+import random
+import string
+import tempfile
+from datetime import datetime
+from itertools import accumulate
+from statistics import median
+from time import perf_counter
+
+from whoosh.query import Phrase
+
+from crawler.whoosh_backend import PhraseSchema, ShinglePhrase, get_index
+
+
+def make_index(path: str, docs: int, vocab: int, seed: int = 0):
+    rng = random.Random(seed)
+    words = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randrange(3, 10)))
+        for _ in range(vocab)
+    ]
+    weights = list(accumulate(1 / rank for rank in range(1, vocab + 1)))
+    now = datetime.now()
+    ix = get_index(path, schema=PhraseSchema)
+    writer = ix.writer()
+    for i in range(docs):
+        writer.update_document(
+            url=f"http://site{i}.geek/",
+            depth=0,
+            title=" ".join(rng.choices(words, cum_weights=weights, k=5)),
+            content=" ".join(rng.choices(words, cum_weights=weights, k=300)),
+            description="",
+            created_at=now,
+            last_updated=now,
+            dead_since=None,
+        )
+    writer.commit()
+    return ix
+
+
+def sample_phrases(searcher, n: int, length: int, seed: int = 0):
+    rng = random.Random(seed + length)
+    phrases = []
+    doc_count = searcher.doc_count_all()
+    while len(phrases) < n:
+        words = searcher.stored_fields(rng.randrange(doc_count))["content"].split()
+        if len(words) >= length:
+            start = rng.randrange(len(words) - length + 1)
+            phrases.append(words[start : start + length])
+    return phrases
+
+
+def time_queries(searcher, query_class, phrases, repeat: int):
+    times, hits = [], []
+    for words in phrases:
+        query = query_class("content", words)
+        start = perf_counter()
+        for _ in range(repeat):
+            results = searcher.search(query, limit=10)
+        times.append((perf_counter() - start) / repeat)
+        hits.append(len(results))
+    return times, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--vocab", type=int, default=20_000)
+    parser.add_argument("--phrases", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--index", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.index:
+            ix = get_index(args.index)
+            if "phrase_content" not in ix.schema:
+                parser.error(f"{args.index} has no phrase fields, rebuild it with --phrase-fields first.")
+        else:
+            start = perf_counter()
+            ix = make_index(f"{temp_dir}/index", args.docs, args.vocab)
+            print(f"built the index in {perf_counter() - start:.1f}s")
+
+        with ix.searcher() as searcher:
+            print(
+                f"{'words':<6} {'positions (ms)':>15} {'bigrams (ms)':>13} {'speedup':>8} {'same hits':>10}"
+            )
+            for length in (2, 3, 4):
+                phrases = sample_phrases(searcher, args.phrases, length)
+                positions, position_hits = time_queries(
+                    searcher, Phrase, phrases, args.repeat
+                )
+                bigrams, bigram_hits = time_queries(
+                    searcher, ShinglePhrase, phrases, args.repeat
+                )
+                print(
+                    f"{length:<6} {median(positions) * 1e3:>15.2f} {median(bigrams) * 1e3:>13.2f}"
+                    f" {median(positions) / median(bigrams):>7.1f}x {str(position_hits == bigram_hits):>10}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures the "did you mean" spelling dictionary (`SpellingDictionary`): how long it takes to build, save and load,
+how long a correction takes, and how often a typo (one deleted, substituted, inserted or swapped letter) is corrected back.
+
+The dictionary is built from a synthetic index in a temporary directory, unless `--index` is given.
+
+Run from the project root:
+    python -m benchmarks.bench_spelling [--docs N] [--index PATH]
+"""
+
+import argparse
+import os
+import random
+import string
+import tempfile
+from collections import Counter
+from time import perf_counter
+
+from benchmarks.bench_phrase import make_index
+from crawler.whoosh_backend import SpellingCorrector, SpellingDictionary, get_index
+from crawler.whoosh_backend.suggestions import _segment_frequencies
+
+
+def make_typo(rng: random.Random, word: str) -> str:
+    i = rng.randrange(len(word))
+    letter = rng.choice(string.ascii_lowercase)
+    kind = rng.randrange(4)
+    if kind == 0:
+        return word[:i] + word[i + 1 :]
+    if kind == 1:
+        return word[:i] + letter + word[i + 1 :]
+    if kind == 2:
+        return word[:i] + letter + word[i:]
+    i = min(i, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2 :]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--vocab", type=int, default=20_000)
+    parser.add_argument("--words", type=int, default=2000)
+    parser.add_argument("--index", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.index:
+            ix, storage_path = get_index(args.index), args.index
+        else:
+            storage_path = f"{temp_dir}/index"
+            ix = make_index(storage_path, args.docs, args.vocab)
+
+        start = perf_counter()
+        totals = Counter()
+        for counts in _segment_frequencies(ix, SpellingCorrector.FIELDS, {}).values():
+            totals.update(counts)
+        dictionary = SpellingDictionary.build(totals)
+        print(f"built in {perf_counter() - start:.2f}s")
+        path = f"{temp_dir}/spelling.dict"
+        dictionary.save(path)
+        start = perf_counter()
+        dictionary = SpellingDictionary.load(path)
+        print(f"loaded in {(perf_counter() - start) * 1e3:.1f}ms")
+        print(
+            f"{len(dictionary.terms)} terms, {len(dictionary.keys)} deletes, {os.path.getsize(path) / 1e6:.1f}MB"
+        )
+
+        rng = random.Random(0)
+        words = rng.sample(
+            [term for term in dictionary.terms if len(term) >= 5], args.words
+        )
+        typos = [make_typo(rng, word) for word in words]
+        start = perf_counter()
+        corrections = [dictionary.correct_word(typo) for typo in typos]
+        duration = perf_counter() - start
+        corrected = sum(
+            word == correction for word, correction in zip(words, corrections)
+        )
+        print(f"{duration / len(typos) * 1e6:.1f}us per word")
+        print(f"{corrected / len(typos):.1%} corrected back to the original word")
+
+
+if __name__ == "__main__":
+    main()
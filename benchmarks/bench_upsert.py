@@ -0,0 +1,114 @@
+"""
+Compares upserting pages one at a time (`MyIndexWriter.update_document`) with upserting them in batches (`update_documents`),
+and with plain `add_document` (which doesn't look for existing documents), for pages that are already in the index (a recrawl)
+and for new ones.
+
+The index is built once from the synthetic corpus (see `benchmarks.corpus`), then every batch is applied and cancelled,
+so each run sees the same index, and only the writing is timed (not committing).
+
+Run from the project root:
+    python -m benchmarks.bench_upsert [--pages N] [--batch N]
+"""
+
+import argparse
+import tempfile
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Dict, List
+
+from whoosh.writing import NO_MERGE
+
+from benchmarks.corpus import make_pages
+from benchmarks.suite import extract
+from crawler.whoosh_backend import get_index
+
+
+def upsert_fields(document: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    """The arguments `SearchDB.add_page_record` upserts the page with."""
+    fields = {
+        "url": document["url"],
+        "depth": document["depth"],
+        "title": document["title"],
+        "content": document["content"],
+        "description": document["description"],
+        "created_at": now,
+        "last_updated": now,
+        "dead_since": None,
+    }
+    exists_fields = fields.copy()
+    del exists_fields["created_at"]
+    return dict(
+        fields, fields_if_exists=exists_fields, comparison_functions={"depth": min}
+    )
+
+
+def one_at_a_time(writer, batch: List[Dict[str, Any]]):
+    for document in batch:
+        writer.update_document(**document)
+
+
+def in_bulk(writer, batch: List[Dict[str, Any]]):
+    writer.update_documents(batch)
+
+
+def add_only(writer, batch: List[Dict[str, Any]]):
+    for document in batch:
+        fields = dict(document)
+        del fields["fields_if_exists"], fields["comparison_functions"]
+        writer.add_document(**fields)
+
+
+def time_batches(
+    ix, documents: List[Dict[str, Any]], batch_size: int, function
+) -> float:
+    """Returns the docs/sec of applying the documents in batches (each one cancelled afterwards)."""
+    duration = 0.0
+    for i in range(0, len(documents), batch_size):
+        writer = ix.writer()
+        start = perf_counter()
+        function(writer, documents[i : i + batch_size])
+        duration += perf_counter() - start
+        writer.cancel()
+    return len(documents) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--new-pages", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument(
+        "--segments", type=int, default=10, help="segments the index is built with"
+    )
+    args = parser.parse_args()
+
+    now = datetime.now()
+    pages = make_pages(args.pages + args.new_pages)
+    documents = [upsert_fields(extract(page), now) for page in pages]
+    existing, new = documents[: args.pages], documents[args.pages :]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ix = get_index(f"{temp_dir}/index")
+        start = perf_counter()
+        per_segment = -(-len(existing) // args.segments)
+        for i in range(0, len(existing), per_segment):
+            writer = ix.writer()
+            add_only(writer, existing[i : i + per_segment])
+            writer.commit(mergetype=NO_MERGE)
+        print(f"built the index in {perf_counter() - start:.1f}s")
+
+        print(
+            f"{'pages':<10} {'add (docs/s)':>13} {'one at a time':>14} {'bulk':>8} {'speedup':>8}"
+        )
+        for name, batch in (("existing", existing), ("new", new)):
+            added = time_batches(ix, batch, args.batch, add_only)
+            single = time_batches(ix, batch, args.batch, one_at_a_time)
+            bulk = time_batches(ix, batch, args.batch, in_bulk)
+            print(
+                f"{name:<10} {added:>13.0f} {single:>14.0f} {bulk:>8.0f} {bulk / single:>7.1f}x"
+            )
+        ix.close()
+
+
+if __name__ == "__main__":
+    main()
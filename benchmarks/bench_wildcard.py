@@ -0,0 +1,106 @@
+"""
+Compares wildcard queries expanded by scanning the term dictionary (whoosh's `Wildcard`)
+with ones expanded using the k-gram index (`KGramWildcard`), for leading, trailing and infix wildcards.
+
+A synthetic index is built in a temporary directory, unless `--index` is given.
+
+Run from the project root:
+    python -m benchmarks.bench_wildcard [--docs N] [--vocab N] [--index PATH]
+"""
+
+import argparse
+import random
+import string
+import tempfile
+from statistics import median
+from time import perf_counter
+
+from whoosh.query import Wildcard
+
+from crawler.whoosh_backend import KGramWildcard, get_index
+
+
+def make_index(path: str, docs: int, vocab: int, seed: int = 0):
+    rng = random.Random(seed)
+    words = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randrange(4, 12)))
+        for _ in range(vocab)
+    ]
+    ix = get_index(path)
+    writer = ix.writer()
+    for i in range(docs):
+        writer.add_document(
+            url=f"http://site{i}.geek/",
+            title=" ".join(rng.choices(words, k=5)),
+            content=" ".join(rng.choices(words, k=200)),
+            depth=0,
+        )
+    writer.commit()
+    return ix
+
+
+def make_patterns(words, n: int, seed: int = 0):
+    rng = random.Random(seed)
+    patterns = {"leading": [], "trailing": [], "infix": [], "contains": []}
+    for word in rng.sample(words, n):
+        patterns["leading"].append(f"*{word[-4:]}")
+        patterns["trailing"].append(f"{word[:4]}*")
+        patterns["infix"].append(f"{word[:2]}*{word[-3:]}")
+        patterns["contains"].append(f"*{word[1:5]}*")
+    return patterns
+
+
+def time_queries(searcher, query_class, patterns, repeat: int):
+    times = []
+    for pattern in patterns:
+        query = query_class("content", pattern)
+        start = perf_counter()
+        for _ in range(repeat):
+            searcher.search(query, limit=10)
+        times.append((perf_counter() - start) / repeat)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--patterns", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--index", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.index:
+            ix = get_index(args.index)
+        else:
+            start = perf_counter()
+            ix = make_index(f"{temp_dir}/index", args.docs, args.vocab)
+            print(
+                f"built the index (and k-gram index) in {perf_counter() - start:.1f}s"
+            )
+
+        with ix.searcher() as searcher:
+            words = [
+                btext.decode()
+                for btext in searcher.reader().lexicon("content")
+                if len(btext) >= 6
+            ]
+            # loads the k-gram indexes, so they aren't included in the first query's time
+            list(KGramWildcard("content", "*zzz*")._btexts(searcher.reader()))
+            patterns = make_patterns(words, min(args.patterns, len(words)))
+            print(f"{'':<10} {'scan (ms)':>10} {'k-gram (ms)':>12} {'speedup':>8}")
+            for kind, kind_patterns in patterns.items():
+                scan = median(
+                    time_queries(searcher, Wildcard, kind_patterns, args.repeat)
+                )
+                kgram = median(
+                    time_queries(searcher, KGramWildcard, kind_patterns, args.repeat)
+                )
+                print(
+                    f"{kind:<10} {scan * 1e3:>10.2f} {kgram * 1e3:>12.2f} {scan / kgram:>7.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+A deterministic synthetic corpus of OpenNIC-like html pages, for the benchmarks.
+
+The same seed always gives the same pages (on any machine), so runs of the suite are comparable.
+Pages are spread over hosts on OpenNIC TLDs, and vary in size from a few dozen words to a few thousand.
+Each page has a title, a meta description, a nav bar, headings, paragraphs, lists and a footer,
+plus the inline scripts and styles that extraction has to skip.
+Words follow a Zipf distribution over a pronounceable vocabulary, so term frequencies look like real text's.
+"""
+
+import random
+from html import escape
+from itertools import accumulate
+from typing import List, NamedTuple
+
+TLDS = [
+    "bbs",
+    "chan",
+    "cyb",
+    "dyn",
+    "geek",
+    "gopher",
+    "indy",
+    "libre",
+    "neo",
+    "null",
+    "o",
+    "oss",
+    "oz",
+    "parody",
+    "pirate",
+]
+# a few real words, which are the most common ones (like stop words are in real pages)
+COMMON_WORDS = [
+    "the",
+    "of",
+    "and",
+    "to",
+    "a",
+    "in",
+    "is",
+    "for",
+    "on",
+    "with",
+    "opennic",
+    "dns",
+    "server",
+    "search",
+    "free",
+    "open",
+    "network",
+    "page",
+    "home",
+    "about",
+]
+_ONSETS = [
+    "b",
+    "c",
+    "d",
+    "f",
+    "g",
+    "h",
+    "k",
+    "l",
+    "m",
+    "n",
+    "p",
+    "r",
+    "s",
+    "t",
+    "v",
+    "w",
+    "z",
+    "br",
+    "ch",
+    "cl",
+    "dr",
+    "gr",
+    "pl",
+    "sh",
+    "st",
+    "th",
+    "tr",
+]
+_VOWELS = ["a", "e", "i", "o", "u", "ai", "ea", "io", "ou"]
+_CODAS = ["", "", "", "n", "r", "s", "t", "l", "m", "ck", "nd", "st"]
+# (share of pages, min words, max words)
+_SIZES = [(0.3, 30, 150), (0.5, 150, 800), (0.2, 800, 4000)]
+
+
+class Page(NamedTuple):
+    url: str
+    body: bytes
+    depth: int
+
+
+def make_vocabulary(size: int, seed: int = 0) -> List[str]:
+    """Returns `size` distinct words, most common first."""
+    rng = random.Random(seed)
+    words = dict.fromkeys(COMMON_WORDS[:size])
+    while len(words) < size:
+        word = "".join(
+            rng.choice(_ONSETS) + rng.choice(_VOWELS) + rng.choice(_CODAS)
+            for _ in range(rng.choice((1, 2, 2, 3, 3, 4)))
+        )
+        words[word] = None
+    return list(words)
+
+
+class CorpusGenerator:
+    """Generates the pages, see `make_pages`."""
+
+    def __init__(
+        self, vocabulary_size: int = 20_000, hosts: int = 200, seed: int = 0
+    ) -> None:
+        self.rng = random.Random(seed)
+        self.words = make_vocabulary(vocabulary_size, seed)
+        self.weights = list(
+            accumulate(1 / rank for rank in range(1, len(self.words) + 1))
+        )
+        self.hosts = [
+            f"{self.sentence(1, 2).replace(' ', '-')}{i}.{self.rng.choice(TLDS)}"
+            for i in range(hosts)
+        ]
+
+    def text(self, n: int) -> List[str]:
+        return self.rng.choices(self.words, cum_weights=self.weights, k=n)
+
+    def sentence(self, low: int, high: int) -> str:
+        return " ".join(self.text(self.rng.randint(low, high)))
+
+    def url(self, host: str) -> str:
+        path = "/".join(self.sentence(1, 1) for _ in range(self.rng.randrange(3)))
+        return f"http://{host}/{path}"
+
+    def page(self, url: str, host: str, words: int) -> bytes:
+        rng = self.rng
+        title = self.sentence(2, 8).title()
+        links = [
+            f'<a href="/{escape(self.sentence(1, 1))}">{escape(self.sentence(1, 2))}</a>'
+            for _ in range(rng.randint(3, 8))
+        ] + [
+            f'<a href="{self.url(rng.choice(self.hosts))}">{escape(self.sentence(1, 3))}</a>'
+            for _ in range(rng.randint(0, 10))
+        ]
+        parts = [
+            "<!DOCTYPE html>",
+            '<html lang="en"><head><meta charset="utf-8">',
+            f"<title>{escape(title)}</title>",
+            f'<meta name="description" content="{escape(self.sentence(8, 25))}">',
+            "<style>body { font-family: sans-serif; } nav a { margin: 0 1em; }</style>",
+            f"<script>var host = {host!r}; window.onload = function () {{ console.log(host); }};</script>",
+            "</head><body>",
+            f"<nav>{' '.join(links)}</nav>",
+            f"<h1>{escape(title)}</h1>",
+        ]
+        written = 0
+        while written < words:
+            kind = rng.random()
+            if kind < 0.15:
+                parts.append(f"<h2>{escape(self.sentence(2, 6))}</h2>")
+            elif kind < 0.3:
+                items = [escape(self.sentence(2, 10)) for _ in range(rng.randint(2, 6))]
+                parts.append(
+                    "<ul>" + "".join(f"<li>{item}</li>" for item in items) + "</ul>"
+                )
+                written += sum(item.count(" ") + 1 for item in items)
+            else:
+                n = rng.randint(15, 120)
+                parts.append(f"<p>{escape(' '.join(self.text(n)))}</p>")
+                written += n
+        parts.append(
+            f'<footer><p>{escape(self.sentence(3, 10))}</p><a href="/">{host}</a></footer>'
+        )
+        parts.append("</body></html>")
+        return "\n".join(parts).encode()
+
+    def pages(self, n: int) -> List[Page]:
+        rng = self.rng
+        shares = list(accumulate(share for share, _, _ in _SIZES))
+        pages = []
+        urls = set()
+        while len(pages) < n:
+            host = rng.choice(self.hosts)
+            depth = rng.choice((0, 1, 1, 2, 2, 2, 3))
+            url = f"http://{host}/" if depth == 0 else self.url(host)
+            if url in urls:
+                continue
+            urls.add(url)
+            _, low, high = _SIZES[
+                rng.choices(range(len(_SIZES)), cum_weights=shares)[0]
+            ]
+            pages.append(Page(url, self.page(url, host, rng.randint(low, high)), depth))
+        return pages
+
+
+def make_pages(n: int, vocabulary_size: int = 20_000, seed: int = 0) -> List[Page]:
+    """Returns `n` pages (with distinct urls), always the same ones for the same arguments."""
+    return CorpusGenerator(vocabulary_size, seed=seed).pages(n)
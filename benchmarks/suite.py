@@ -0,0 +1,321 @@
+"""
+The benchmark suite: extraction, indexing, querying and highlighting, on a synthetic corpus (see `benchmarks.corpus`).
+
+    extraction  pages/sec parsing the html into a `ParsedDocument` (title, description, text and links)
+    indexing    docs/sec adding the pages with `MyIndexWriter.update_documents` (as `SearchDB` does), N pages per batch and commit
+    queries     p50/p95/p99 latency of term, phrase, wildcard and boolean queries (parsing and finding the first page of hits)
+    snippets    the cost of turning those hits into results (`hit_to_result`, i.e. highlighting)
+
+The corpus and the queries only depend on the seed and the sizes, so runs (e.g. before and after a change) can be compared.
+The results are written as JSON (progress goes to stderr), `--compare` prints the change from an earlier run's JSON.
+
+Run from the project root:
+    python -m benchmarks.suite [--pages N] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from statistics import mean, quantiles
+from time import perf_counter
+from typing import Any, Dict, List
+
+import whoosh
+from scrapy import Request
+from scrapy.http import HtmlResponse
+
+from benchmarks.corpus import Page, make_pages
+from crawler.document import ParsedDocument
+from crawler.whoosh_backend import get_index, hit_to_result, parse_query, query_is_valid
+
+
+def latencies(times: List[float]) -> Dict[str, float]:
+    """The percentiles (and mean) of the times, in ms."""
+    cuts = quantiles(times, n=100, method="inclusive")
+    return {
+        "count": len(times),
+        "mean_ms": mean(times) * 1e3,
+        "p50_ms": cuts[49] * 1e3,
+        "p95_ms": cuts[94] * 1e3,
+        "p99_ms": cuts[98] * 1e3,
+    }
+
+
+def extract(page: Page) -> Dict[str, Any]:
+    response = HtmlResponse(
+        page.url,
+        body=page.body,
+        encoding="utf-8",
+        request=Request(page.url, meta={"depth": page.depth}),
+    )
+    document = ParsedDocument.from_response(response)
+    return {
+        "url": page.url,
+        "depth": page.depth,
+        "title": document.title,
+        "content": document.text,
+        "description": document.description,
+        "links": document.links,
+    }
+
+
+def bench_extraction(pages: List[Page]) -> Dict[str, Any]:
+    start = perf_counter()
+    for page in pages:
+        extract(page)
+    duration = perf_counter() - start
+    size = sum(len(page.body) for page in pages)
+    return {
+        "pages": len(pages),
+        "seconds": duration,
+        "pages_per_sec": len(pages) / duration,
+        "mb_per_sec": size / duration / 1e6,
+    }
+
+
+def bench_indexing(
+    documents: List[Dict[str, Any]], path: str, batch: int
+) -> Dict[str, Any]:
+    ix = get_index(path)
+    now = datetime.now()
+    start = perf_counter()
+    writer = ix.writer()
+    batch_documents = []
+    for i, document in enumerate(documents, 1):
+        fields = {
+            "url": document["url"],
+            "depth": document["depth"],
+            "title": document["title"],
+            "content": document["content"],
+            "description": document["description"],
+            "created_at": now,
+            "last_updated": now,
+            "dead_since": None,
+        }
+        exists_fields = fields.copy()
+        del exists_fields["created_at"]
+        batch_documents.append(
+            dict(
+                fields,
+                fields_if_exists=exists_fields,
+                comparison_functions={"depth": min},
+            )
+        )
+        if i % batch == 0 or i == len(documents):
+            writer.update_documents(batch_documents)
+            batch_documents = []
+            writer.commit()
+            if i < len(documents):
+                writer = ix.writer()
+    duration = perf_counter() - start
+    return {
+        "docs": len(documents),
+        "commit_every": batch,
+        "seconds": duration,
+        "docs_per_sec": len(documents) / duration,
+    }
+
+
+def make_queries(
+    documents: List[Dict[str, Any]], n: int, seed: int = 0
+) -> Dict[str, List[str]]:
+    """Returns `n` queries of each kind, made of words from the documents (so most of them have hits)."""
+    rng = random.Random(seed)
+    texts = [document["content"].split() for document in documents]
+    texts = [words for words in texts if len(words) >= 4]
+
+    def words(k: int) -> List[str]:
+        text = rng.choice(texts)
+        start = rng.randrange(len(text) - k + 1)
+        return text[start : start + k]
+
+    def word() -> str:
+        return words(1)[0]
+
+    def stem() -> str:
+        while len(w := word()) < 5:
+            pass
+        return w
+
+    return {
+        "term": [word() for _ in range(n)],
+        "phrase": [f'"{" ".join(words(rng.randint(2, 3)))}"' for _ in range(n)],
+        "wildcard": [
+            rng.choice(
+                (f"{stem()[:3]}*", f"*{stem()[1:4]}*", f"{stem()[:2]}*{stem()[-2:]}")
+            )
+            for _ in range(n)
+        ],
+        "boolean": [
+            rng.choice(
+                (
+                    f"{word()} AND {word()}",
+                    f"{word()} OR {word()}",
+                    f"{word()} AND NOT {word()}",
+                    f"({word()} OR {word()}) AND {word()}",
+                )
+            )
+            for _ in range(n)
+        ],
+    }
+
+
+def bench_queries(ix, queries: Dict[str, List[str]], repeat: int) -> Dict[str, Any]:
+    query_results, snippet_times, page_times = {}, [], []
+    with ix.searcher() as searcher:
+        for kind, search_terms in queries.items():
+            # once to warm up the caches (e.g. the k-gram indexes), and to highlight the hits
+            pages = []
+            for search_term in search_terms:
+                query = parse_query(search_term, ix.schema)
+                if query_is_valid(query):
+                    pages.append(searcher.search_page(query, 1, pagelen=10, terms=True))
+            times = []
+            for _ in range(repeat):
+                for search_term in search_terms:
+                    start = perf_counter()
+                    query = parse_query(search_term, ix.schema)
+                    if query_is_valid(query):
+                        len(searcher.search_page(query, 1, pagelen=10, terms=True))
+                    times.append(perf_counter() - start)
+            query_results[kind] = latencies(times)
+            query_results[kind]["with_hits"] = sum(1 for page in pages if len(page))
+
+            for page in pages:
+                page_start = perf_counter()
+                for hit in page:
+                    start = perf_counter()
+                    hit_to_result(hit)
+                    snippet_times.append(perf_counter() - start)
+                page_times.append(perf_counter() - page_start)
+    return {
+        "queries": query_results,
+        "snippets": {
+            "per_hit": latencies(snippet_times),
+            "per_page": latencies(page_times),
+        },
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, float):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any]):
+    """Prints (to stderr) every number that's in both runs, with how much it changed."""
+    old, new = flatten(baseline), flatten(results)
+    print(f"{'metric':<40} {'baseline':>12} {'now':>12} {'change':>8}", file=sys.stderr)
+    for key in new:
+        if key in old and not key.startswith("meta.") and old[key]:
+            print(
+                f"{key:<40} {old[key]:>12.3f} {new[key]:>12.3f} {new[key] / old[key] - 1:>+8.1%}",
+                file=sys.stderr,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--vocab", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--commit-every",
+        default="100",
+        help="comma separated numbers of pages per commit, each is a separate indexing run (default: 100)",
+    )
+    parser.add_argument("--queries", type=int, default=50, help="queries of each kind")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output", help="where to write the JSON results (default: stdout)"
+    )
+    parser.add_argument(
+        "--compare", help="the JSON results of an earlier run, to compare with"
+    )
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "whoosh": whoosh.versionstring(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        }
+    }
+
+    print(f"generating {args.pages} pages", file=sys.stderr)
+    pages = make_pages(args.pages, args.vocab, args.seed)
+    results["extraction"] = bench_extraction(pages)
+    print(
+        f"extraction: {results['extraction']['pages_per_sec']:.0f} pages/sec",
+        file=sys.stderr,
+    )
+    documents = [extract(page) for page in pages]
+
+    results["indexing"] = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        batches = sorted(int(n) for n in args.commit_every.split(","))
+        for batch in batches:
+            path = f"{temp_dir}/index-{batch}"
+            indexing = bench_indexing(documents, path, batch)
+            results["indexing"][f"commit_every_{batch}"] = indexing
+            print(
+                f"indexing, committing every {batch}: {indexing['docs_per_sec']:.0f} docs/sec",
+                file=sys.stderr,
+            )
+
+        # the index with the fewest segments (the biggest batches), like a crawl's index once merged
+        ix = get_index(f"{temp_dir}/index-{batches[-1]}")
+        queries = make_queries(documents, args.queries, args.seed)
+        results.update(bench_queries(ix, queries, args.repeat))
+        ix.close()
+    for kind, latency in results["queries"].items():
+        print(
+            f"{kind} queries: p50 {latency['p50_ms']:.2f}ms, p95 {latency['p95_ms']:.2f}ms, p99 {latency['p99_ms']:.2f}ms",
+            file=sys.stderr,
+        )
+    print(
+        f"snippets: {results['snippets']['per_hit']['mean_ms']:.2f}ms per hit",
+        file=sys.stderr,
+    )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
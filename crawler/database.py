@@ -1,28 +1,136 @@
-from urllib.parse import urlsplit
-from bs4 import BeautifulSoup
-from scrapy import Spider
+from scrapy import Spider, signals
 from scrapy.crawler import Crawler
 from scrapy.http import HtmlResponse, TextResponse
 from scrapy.robotstxt import RobotParser
 from scrapy.utils.project import get_project_settings
-from whoosh.qparser import PrefixPlugin, QueryParser, plugins
+from whoosh.qparser import QueryParser, plugins
 
 from crawler.custom_signals import (
     RECHECK_DB_FOR_NETLOC,
     GET_START_URLS,
-    TLD_FILTER_CHECK,
     URL_EXISTS,
-    URL_FILTER_CHECK,
 )
-
-from crawler.whoosh_backend import get_index
+from crawler.document import ParsedDocument
+from crawler.metrics import Metrics
+from crawler.middleware.admission import URLAdmission
+
+from crawler.index_writer import IndexWriterThread
+from crawler.whoosh_backend import (
+    MergeScheduler,
+    TieredMergePolicy,
+    dead_docnums,
+    get_index,
+)
 from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+from twisted.internet.defer import Deferred
+
+
+def page_record(
+    response: TextResponse, now: Optional[datetime] = None
+) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Callable]]:
+    """Extracts the page's fields, for upserting it into the index (see `MyIndexWriter.update_document`).
+
+    Args:
+        now (Optional[datetime], optional): When the page was fetched. Defaults to now.
+
+    Returns:
+        Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Callable]]: The fields, the `fields_if_exists` and the `comparison_functions`.
+    """
+    url = response.url
+    document = ParsedDocument.from_response(response)
+    title = document.title
+    text = document.text
+    description = document.description
+    depth = response.meta["depth"]
+
+    now = now or datetime.now()
+
+    dead_since = (
+        now if (399 < response.status < 600) else None
+    )
+
+    default_fields = {
+        "url": url,
+        "depth": depth,
+        "title": title,
+        "content": text,
+        "description": description,
+        "created_at": now,
+        "last_updated": now,
+        "dead_since": dead_since,
+    }
+    exists_fields = default_fields.copy()
+    del exists_fields["created_at"]
+
+    if dead_since:
+        for attr in [
+            "depth",
+            "title",
+            "content",
+            "description",
+        ]:  # these attributes should be unchanged if the site is dead
+            del exists_fields[attr]
+    return default_fields, exists_fields, {"depth": min}
 
 
 class SearchDB:
+    """
+    Spider middleware that adds every page to the index.
+
+    Every change to the index (adding pages, and deleting them in `cleanup` and `recheck_db`) goes through an `IndexWriterThread`,
+    which commits them in batches. If `INDEX_MERGE_ENABLED`, commits don't merge segments,
+    a `MergeScheduler` merges them (in the same thread) once the crawl goes quiet (or there are too many).
+    Otherwise, each commit merges with a `TieredMergePolicy`.
+    If the writer falls behind and its queue fills up, the engine is paused until it's half empty (counted in `index_writer/pauses`).
+
+    Settings:
+        INDEX_WRITER_BATCH_SIZE: the most changes committed at once.
+        INDEX_WRITER_COMMIT_INTERVAL: the longest a change waits to be committed, in seconds.
+        INDEX_WRITER_MAX_QUEUE: how many changes can be queued before the crawl is paused (until half of them are committed).
+        INDEX_MERGE_ENABLED: whether to merge segments in the background.
+        INDEX_MERGE_FACTOR: how many segments of a tier are merged at once (see `TieredMergePolicy`).
+        INDEX_MERGE_MAX_DELETED_RATIO: segments with more deleted documents than this are rewritten.
+        INDEX_MERGE_IDLE_SECONDS: how long the index must go without commits before it's merged.
+        INDEX_MERGE_MAX_SEGMENTS: the index is merged without waiting if it has more segments than this.
+        INDEX_WRITE_TIMEOUT: how long the writer waits for the index to be unlocked (e.g. by another process), in seconds.
+        DEAD_PAGE_TTL: pages that have been dead (see `dead_since`) for longer than this are deleted when the crawl starts, in seconds (0 to keep them).
+    """
+
+    index_writer: IndexWriterThread
+
     @classmethod
     def from_crawler(cls, crawler: Crawler):
         o = cls()
+        o.metrics = Metrics.from_crawler(crawler)
+        settings = crawler.settings
+        o.dead_page_ttl = settings.getfloat("DEAD_PAGE_TTL", 0)
+        merge_policy = TieredMergePolicy(
+            factor=settings.getint("INDEX_MERGE_FACTOR", 10),
+            max_deleted_ratio=settings.getfloat("INDEX_MERGE_MAX_DELETED_RATIO", 0.2),
+        )
+        merge_scheduler = None
+        if settings.getbool("INDEX_MERGE_ENABLED", True):
+            merge_scheduler = MergeScheduler(
+                o.index,
+                merge_policy,
+                idle_seconds=settings.getfloat("INDEX_MERGE_IDLE_SECONDS", 30),
+                max_segments=settings.getint("INDEX_MERGE_MAX_SEGMENTS", 50),
+            )
+        o.index_writer = IndexWriterThread(
+            o.index,
+            batch_size=settings.getint("INDEX_WRITER_BATCH_SIZE", 100),
+            commit_interval=settings.getfloat("INDEX_WRITER_COMMIT_INTERVAL", 5),
+            max_queue=settings.getint("INDEX_WRITER_MAX_QUEUE", 10_000),
+            write_timeout=settings.getfloat("INDEX_WRITE_TIMEOUT", 60),
+            merge_policy=merge_policy,
+            merge_scheduler=merge_scheduler,
+            metrics=o.metrics,
+            stats=crawler.stats,
+        )
+        o.index_writer.start()
+        # the spider only closes once everything queued is committed
+        crawler.signals.connect(o.index_writer.stop, signals.spider_closed)
         crawler.signals.connect(o.recheck_db, RECHECK_DB_FOR_NETLOC)
         crawler.signals.connect(o.get_start_urls, GET_START_URLS)
         crawler.signals.connect(o.url_exists, URL_EXISTS)
@@ -31,97 +139,70 @@ class SearchDB:
 
     def __init__(self) -> None:
         self.index = get_index()
+        self.metrics = Metrics(enabled=False)
+        self.dead_page_ttl = 0.0
+        self.paused = False
+
+    def cleanup(self, crawler: Crawler) -> Deferred:
+        """Deletes the pages whose urls aren't allowed anymore, and the ones that have been dead for longer than `DEAD_PAGE_TTL`.
+
+        This runs in the writer's thread, so it doesn't hold up the crawl starting.
+        """
+        admission = URLAdmission.from_crawler(crawler)
+
+        def cleanup(writer) -> int:
+            with self.index.searcher() as s:
+                urls = [
+                    fields["url"]
+                    for fields in s.all_stored_fields()
+                    if not (
+                        admission.tld_allowed(fields["url"])
+                        and admission.url_allowed(fields["url"])
+                    )
+                ]
+                if self.dead_page_ttl:
+                    urls += [
+                        s.stored_fields(docnum)["url"]
+                        for docnum in dead_docnums(s.reader(), self.dead_page_ttl)
+                    ]
+            return sum(writer.delete_by_term("url", url) for url in set(urls))
 
-    def cleanup(self, crawler: Crawler):
-        results = self.index.get_docnums_and_results()
-        with self.index.writer() as w:
-            for docnum, result in results:
-                url = result["url"]
-                if (
-                    not crawler.signals.send_catch_log(URL_FILTER_CHECK, url=url)
-                ) or (
-                    not crawler.signals.send_catch_log(TLD_FILTER_CHECK, url=url)
-                ):
-                    w.delete_document(docnum)
-
-    def add_page_record(self, response: TextResponse):
-        url = response.url
-        title = (
-            response.css("title::text").get()
-            or response.css("h1::text").get()
-            or response.url
-        )
-        depth = response.meta["depth"]
-
-        text = (
-            BeautifulSoup(response.body, features="lxml")
-            .get_text(separator=" ", strip=True)
-            .removeprefix(title)
-            .lstrip()
-        )
-
-        description = (
-            response.css('meta[name="description"]::attr(content)').get("").strip()
-        )
+        def report(deleted: int):
+            if deleted:
+                print(f"CLEANED UP {deleted} disallowed or dead pages from the index.")
 
-        now = datetime.now()
+        return self.index_writer.call(cleanup).addCallback(report)
 
-        dead_since = (
-            now if (399 < response.status < 600) else None
-        )
-
-        default_fields = {
-            "url": url,
-            "depth": depth,
-            "title": title,
-            "content": text,
-            "description": description,
-            "created_at": now,
-            "last_updated": now,
-            "dead_since": dead_since,
-        }
-        exists_fields = default_fields.copy()
-        del exists_fields["created_at"]
-
-        if dead_since:
-            for attr in [
-                "depth",
-                "title",
-                "content",
-                "description",
-            ]:  # these attributes should be unchanged if the site is dead
-                del exists_fields[attr]
-        writer = self.index.writer()
-        writer.update_document(
-            **default_fields,
-            fields_if_exists=exists_fields,
-            comparison_functions={"depth": min},
-        )
-        writer.commit(optimize=True, merge=True)
+    def add_page_record(self, response: TextResponse) -> Deferred:
+        """Queues the page to be added to the index (or updated), the Deferred fires once it's committed."""
+        with self.metrics.time("extract"):
+            record = page_record(response)
+        return self.index_writer.upsert(*record)
 
     def process_spider_output(self, response: HtmlResponse, result, spider: Spider):
-        self.add_page_record(response)
-        print(f"ADDED {response.url} to index.")
+        url = response.url
+        self.add_page_record(response).addCallbacks(
+            lambda _: print(f"ADDED {url} to index."),
+            lambda failure: print(f"Couldn't add {url} to the index: {failure.value!r}"),
+        )
+        if self.index_writer.full and not self.paused:
+            # no new requests until the writer catches up, the responses already on their way are still added
+            self.paused = True
+            spider.crawler.engine.pause()
+            spider.crawler.stats.inc_value("index_writer/pauses", spider=spider)
+            self.index_writer.wait_for_room().addCallback(self.unpause, spider)
         return result
 
-    def recheck_db(self, url: str, parser: RobotParser, user_agent: str):
+    def unpause(self, _, spider: Spider):
+        self.paused = False
+        spider.crawler.engine.unpause()
+
+    def recheck_db(self, url: str, parser: RobotParser, user_agent: str) -> Deferred:
         # we need to check if all records for a specific url match the new robot parser's specifications
         # this means changes to robots.txt remove records that were previously valid but are now invalid
-
-        split_url = urlsplit(url)
-        base_url = f"{split_url.scheme}://{split_url.netloc}*"
-        with self.index.writer() as w:
-            changed = False
-            for docnum, result in self.index.get_docnums_and_results(
-                QueryParser(
-                    "url", schema=self.index.schema, plugins=[PrefixPlugin]
-                ).parse(base_url)
-            ):
-                if not parser.allowed(result["url"], user_agent):
-                    changed = True
-                    w.delete_document(docnum)
-            if changed:
-                w.commit()
+        return self.index_writer.delete_by_host(
+            url, lambda record_url: not parser.allowed(record_url, user_agent)
+        )
 
     def get_start_urls(self):
         with self.index.searcher() as s:
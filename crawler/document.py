@@ -0,0 +1,110 @@
+from functools import cached_property
+from typing import List, Optional, Sequence, Union
+from urllib.parse import urljoin
+from weakref import WeakKeyDictionary
+
+from cssselect import HTMLTranslator
+from lxml import etree
+from scrapy import Request
+from scrapy.http import TextResponse
+
+# Each response's `ParsedDocument`, by the response's request (or the response, if it has none).
+# It isn't kept in the meta, as the meta is copied into retried and redirected requests, and pickled with requests queued on disk.
+_documents: "WeakKeyDictionary[Union[Request, TextResponse], ParsedDocument]" = WeakKeyDictionary()
+
+_TITLE = etree.XPath("//title/text()")
+_H1 = etree.XPath("//h1/text()")
+_DESCRIPTION = etree.XPath("//meta[@name='description']/@content")
+_LINKS = etree.XPath("//*/@href")
+# BeautifulSoup's `get_text` skips the contents of these tags, so we do too
+_TEXT = etree.XPath(
+    "//text()[not(ancestor::script or ancestor::style or ancestor::template)]"
+)
+
+
+class SelectorUnion:
+    """
+    A list of CSS selectors, compiled into a single XPath union.
+
+    The union is evaluated in one pass over the document.
+    Only when it matches are the selectors checked one by one, to find out which matched first.
+    """
+
+    def __init__(self, selectors: Sequence[str]) -> None:
+        translator = HTMLTranslator()
+        xpaths = [translator.css_to_xpath(selector) for selector in selectors]
+        self.selectors = list(selectors)
+        self.union = etree.XPath(" | ".join(xpaths)) if xpaths else None
+        self.each = [etree.XPath(xpath) for xpath in xpaths]
+
+    def first_match(self, document: "ParsedDocument") -> Optional[int]:
+        """Returns the index of the first selector that matches the document, or `None` if none match."""
+        if self.union is None or document.root is None:
+            return None
+        if not self.union(document.root):
+            return None
+        for i, xpath in enumerate(self.each):
+            if xpath(document.root):
+                return i
+        return None
+
+
+class ParsedDocument:
+    """
+    A response's html, parsed once and shared by `CssFilter`, `SearchDB` and the spider.
+
+    Use `ParsedDocument.from_response`, which keeps the document for as long as the response's request exists.
+    As `response.replace` keeps the request, later stages reuse the same tree.
+
+    Every field is computed lazily, the first time it's accessed.
+    """
+
+    def __init__(
+        self, response: TextResponse, root: Optional[etree._Element] = None
+    ) -> None:
+        self.url = response.url
+        self.body = response.body
+        if root is None:
+            try:
+                root = response.selector.root
+            except (AttributeError, ValueError):
+                root = None
+        self.root = root
+
+    @classmethod
+    def from_response(cls, response: TextResponse) -> "ParsedDocument":
+        key = response.request if response.request is not None else response
+        document = _documents.get(key)
+        # the body is checked as well, in case the response was replaced with a different one
+        if document is None or document.body is not response.body:
+            document = _documents[key] = cls(response)
+        elif document.url != response.url:
+            # e.g. `URLValidator` canonicalised the url, the tree can be reused
+            document = _documents[key] = cls(response, root=document.root)
+        return document
+
+    def _xpath(self, xpath: etree.XPath) -> List[str]:
+        if self.root is None:
+            return []
+        return xpath(self.root)
+
+    @cached_property
+    def title(self) -> str:
+        return str(
+            next(iter(self._xpath(_TITLE) or self._xpath(_H1)), None) or self.url
+        )
+
+    @cached_property
+    def description(self) -> str:
+        return str(next(iter(self._xpath(_DESCRIPTION)), "")).strip()
+
+    @cached_property
+    def text(self) -> str:
+        "The page's visible text, without the title at the start (equivalent to BeautifulSoup's `get_text(separator=' ', strip=True)`)."
+        text = " ".join(stripped for s in self._xpath(_TEXT) if (stripped := s.strip()))
+        return text.removeprefix(self.title).lstrip()
+
+    @cached_property
+    def links(self) -> List[str]:
+        "Every `href` in the page, joined with the page's url."
+        return [urljoin(self.url, str(href)) for href in self._xpath(_LINKS)]
@@ -0,0 +1,285 @@
+import sqlite3
+from pathlib import Path
+from time import time
+from typing import Dict, Generator, Iterable, List, NamedTuple, Optional
+
+from scrapy import Request, Spider
+from scrapy.crawler import Crawler
+from scrapy.http import Response
+
+from crawler.sharding import host_hash
+
+
+class FrontierEntry(NamedTuple):
+    url: str
+    depth: int = 0
+    referrer: Optional[str] = None
+    priority: int = 0
+    # when the lease taken out by `Frontier.due` expires
+    lease: Optional[float] = None
+
+
+class Frontier:
+    """
+    A persistent record of every known url, kept in an SQLite database between crawls.
+
+    Each url has the time it was last fetched and the time it's next due.
+    When a url is handed out (either from `due` or `add`), it's leased for `lease_seconds`,
+    so it won't be handed out again unless the crawl stops before it's fetched.
+    Once fetched, it's due again after `revisit_seconds`.
+    Requests for leased urls carry the lease's expiry in `meta["frontier_lease"]`, which the dupefilter keys on
+    along with the url, so a url is filtered within a lease but can be fetched again under a later one.
+
+    When crawling with several shards (see `crawler.sharding`), every shard shares the database.
+    Each shard only leases urls whose netloc hashes to it, the rest are left for their own shard to pull.
+    Shards also record a heartbeat, so idle shards know whether others may still send them urls.
+
+    Settings:
+        FRONTIER_PATH: path to the database file.
+        FRONTIER_REVISIT_SECONDS: how long until a fetched url is due again (default: `WAIT_TIME`).
+        FRONTIER_LEASE_SECONDS: how long a url that's been handed out is reserved for.
+        FRONTIER_BATCH_SIZE: how many due urls are pulled at once.
+        SHARD_INDEX, SHARD_COUNT: which shard this is, and how many there are.
+
+    One instance is shared per crawler, use `Frontier.from_crawler` to get it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        revisit_seconds: float,
+        lease_seconds: float,
+        batch_size: int = 1000,
+        shard: int = 0,
+        shards: int = 1,
+    ) -> None:
+        if not (0 <= shard < shards):
+            raise ValueError(f"Shard {shard} doesn't exist, there are {shards} shards.")
+        self.path = path
+        self.revisit_seconds = revisit_seconds
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.shard = shard
+        self.shards = shards
+        self._heartbeat = (0.0, None)
+        # other shards may be writing, so wait for their locks
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.create_function("host_hash", 1, host_hash, deterministic=True)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS frontier (
+                    url TEXT PRIMARY KEY,
+                    depth INTEGER NOT NULL DEFAULT 0,
+                    referrer TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    last_fetched REAL,
+                    next_due REAL NOT NULL
+                )""")
+            columns = [
+                row[1] for row in self.connection.execute("PRAGMA table_info(frontier)")
+            ]
+            if "host_hash" not in columns:
+                self.connection.execute(
+                    "ALTER TABLE frontier ADD COLUMN host_hash INTEGER"
+                )
+                self.connection.execute(
+                    "UPDATE frontier SET host_hash = host_hash(url)"
+                )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS frontier_due ON frontier (next_due, priority)"
+            )
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS shards (
+                    shard INTEGER PRIMARY KEY,
+                    heartbeat REAL NOT NULL,
+                    idle INTEGER NOT NULL DEFAULT 0
+                )""")
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> "Frontier":
+        """Returns the crawler's shared instance, creating it if needed."""
+        frontier = getattr(crawler, "frontier", None)
+        if frontier is None:
+            settings = crawler.settings
+            path = settings.get("FRONTIER_PATH")
+            if not path:
+                raise ValueError("FRONTIER_PATH must be set.")
+            frontier = cls(
+                str(Path(path).absolute()),
+                revisit_seconds=settings.getfloat(
+                    "FRONTIER_REVISIT_SECONDS", settings.getfloat("WAIT_TIME", 0)
+                ),
+                lease_seconds=settings.getfloat("FRONTIER_LEASE_SECONDS", 60 * 60 * 24),
+                batch_size=settings.getint("FRONTIER_BATCH_SIZE", 1000),
+                shard=settings.getint("SHARD_INDEX", 0),
+                shards=settings.getint("SHARD_COUNT", 1),
+            )
+            crawler.frontier = frontier
+        return frontier
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM frontier").fetchone()[0]
+
+    def owns(self, url: str) -> bool:
+        """Returns True if the url belongs to this shard."""
+        return self.shards == 1 or host_hash(url) % self.shards == self.shard
+
+    def add(
+        self, entries: Iterable[FrontierEntry], now: Optional[float] = None
+    ) -> Dict[str, float]:
+        """Records the entries, leasing any that are new or due (and belong to this shard).
+
+        Entries that belong to other shards are only recorded, for their shard to pull.
+
+        Returns:
+            Dict[str, float]: The urls that were leased, which should be crawled, and when their lease expires.
+        """
+        now = time() if now is None else now
+        entries = {entry.url: entry for entry in entries}
+        if not entries:
+            return {}
+        known = {}
+        urls = list(entries)
+        # SQLite limits the number of parameters per query
+        for i in range(0, len(urls), 500):
+            chunk = urls[i : i + 500]
+            known.update(
+                self.connection.execute(
+                    f"SELECT url, next_due FROM frontier WHERE url IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        lease = now + self.lease_seconds
+        leased = {
+            url: lease
+            for url in entries
+            if known.get(url, now) <= now and self.owns(url)
+        }
+        routed = {url for url in entries if url not in known and url not in leased}
+        with self.connection:
+            self.connection.executemany(
+                """INSERT INTO frontier (url, depth, referrer, priority, next_due, host_hash) VALUES (?, ?, ?, ?, ?, host_hash(?))
+                ON CONFLICT (url) DO UPDATE SET next_due = excluded.next_due, depth = min(depth, excluded.depth)""",
+                (
+                    (
+                        url,
+                        entries[url].depth,
+                        entries[url].referrer,
+                        entries[url].priority,
+                        leased.get(url, now),
+                        url,
+                    )
+                    for url in leased.keys() | routed
+                ),
+            )
+        return leased
+
+    def due(
+        self, limit: Optional[int] = None, now: Optional[float] = None
+    ) -> List[FrontierEntry]:
+        """Leases and returns (up to `limit`) due urls, highest priority first."""
+        now = time() if now is None else now
+        lease = now + self.lease_seconds
+        with self.connection:
+            rows = self.connection.execute(
+                """SELECT url, depth, referrer, priority FROM frontier
+                WHERE next_due <= ? AND host_hash % ? = ? ORDER BY priority DESC, next_due LIMIT ?""",
+                (now, self.shards, self.shard, limit or self.batch_size),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE frontier SET next_due = ? WHERE url = ?",
+                ((lease, row[0]) for row in rows),
+            )
+        return [FrontierEntry(*row, lease=lease) for row in rows]
+
+    def iter_due(self) -> Generator[FrontierEntry, None, None]:
+        """Yields every due url, pulling them from the database in batches."""
+        while batch := self.due():
+            yield from batch
+
+    def mark_fetched(self, url: str, depth: int = 0, now: Optional[float] = None):
+        now = time() if now is None else now
+        with self.connection:
+            self.connection.execute(
+                """INSERT INTO frontier (url, depth, last_fetched, next_due, host_hash) VALUES (?, ?, ?, ?, host_hash(?))
+                ON CONFLICT (url) DO UPDATE SET last_fetched = excluded.last_fetched, next_due = excluded.next_due""",
+                (url, depth, now, now + self.revisit_seconds, url),
+            )
+
+    def heartbeat(self, idle: bool = False):
+        """Records that this shard is still running (and whether it's idle).
+
+        Unless the idle state changed, this only writes every 10 seconds."""
+        last_time, last_idle = self._heartbeat
+        now = time()
+        if idle == last_idle and now - last_time < 10:
+            return
+        self._heartbeat = (now, idle)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO shards (shard, heartbeat, idle) VALUES (?, ?, ?)",
+                (self.shard, now, idle),
+            )
+
+    def busy_shards(self, max_age: float = 60) -> List[int]:
+        """Returns the other shards that are still crawling."""
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT shard FROM shards WHERE shard != ? AND shard < ? AND heartbeat >= ? AND NOT idle",
+                (self.shard, self.shards, time() - max_age),
+            )
+        ]
+
+    def leave(self):
+        """Records that this shard has stopped."""
+        with self.connection:
+            self.connection.execute("DELETE FROM shards WHERE shard = ?", (self.shard,))
+        self._heartbeat = (0.0, None)
+
+    def close(self):
+        self.connection.close()
+
+
+class FrontierMiddleware:
+    """
+    Spider middleware that keeps the `Frontier` up to date.
+
+    Processed responses are marked as fetched.
+    Followed requests are recorded, and dropped if their url was fetched recently (or is already leased).
+    The rest are leased, and passed on with their lease in `meta["frontier_lease"]`, like the spider's requests from the frontier:
+    the dupefilter is kept (in JOBDIR) between crawls, so it keys on the lease too, or it would drop any url fetched in an earlier crawl.
+    Duplicates within a lease (e.g. the same link twice on a page) are still dropped by the dupefilter.
+
+    Should come after the depth middleware (i.e. have a lower number), so too deep requests are never recorded.
+    """
+
+    def __init__(self, frontier: Frontier) -> None:
+        self.frontier = frontier
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        return cls(Frontier.from_crawler(crawler))
+
+    def process_spider_output(self, response: Response, result, spider: Spider):
+        self.frontier.heartbeat()
+        self.frontier.mark_fetched(response.url, response.meta.get("depth", 0))
+        requests = []
+        for r in result:
+            if isinstance(r, Request) and not r.dont_filter:
+                requests.append(r)
+            else:
+                yield r
+        leased = self.frontier.add(
+            FrontierEntry(
+                r.url, r.meta.get("depth", 0), r.meta.get("referrer"), r.priority
+            )
+            for r in requests
+        )
+        spider.crawler.stats.inc_value(
+            "frontier/dropped", len(requests) - len(leased), spider=spider
+        )
+        for r in requests:
+            if r.url in leased:
+                r.meta["frontier_lease"] = leased[r.url]
+                yield r
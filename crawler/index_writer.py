@@ -0,0 +1,365 @@
+"""
+One thread that owns the index's writer, so every change to the index goes through one place.
+
+Callers queue commands (`add`, `upsert`, `delete_by_term`, `delete_by_host`, or `call` for anything else)
+and get a Deferred back, which fires (in the reactor's thread) with the command's result once it's committed.
+Commands are applied to one open writer and committed in batches, so there's never more than one writer waiting on the lock,
+and a slow commit only delays the queue, not the reactor.
+Queueing never blocks: callers check `full`, and wait for `wait_for_room` (e.g. with the engine paused) before queueing more.
+"""
+
+import queue
+import threading
+from time import perf_counter
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set
+from urllib.parse import urlsplit
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from whoosh.query import Prefix
+from whoosh.writing import NO_MERGE
+
+from crawler.metrics import Metrics
+from crawler.whoosh_backend import MergeScheduler, TieredMergePolicy
+
+
+class IndexCommand(NamedTuple):
+    function: Callable
+    args: tuple
+    deferred: Deferred
+    queued_at: float
+    # the url it adds, if any (see `IndexWriterThread._apply`)
+    url: Optional[str] = None
+
+
+class IndexWriterThread:
+    """
+    Applies queued changes to the index in a background thread, committing them in batches.
+
+    A batch is committed once it has `batch_size` commands, or `commit_interval` seconds after its first command was applied.
+    Upserts are held until the batch is committed (or another command comes), then applied together with `MyIndexWriter.update_documents`,
+    which looks up the existing documents all at once.
+    Commands that read the index (deletes and `call`) commit the batch first if it has any additions, so they see them,
+    and so does adding a url that's already in the batch (a writer can't replace its own uncommitted documents).
+
+    If there's a `merge_scheduler`, batches are committed without merging, and the thread runs the scheduler while the queue is empty
+    (so merges never wait for, or hold up, a writer). Otherwise, each commit merges with `merge_policy`.
+
+    The queue isn't bounded (blocking the reactor's thread would stop the whole crawl), but it's `full` once it has `max_queue` commands,
+    and `wait_for_room` fires once it's down to half that.
+
+    Stats:
+        index_writer/queue_depth: commands waiting to be applied.
+        index_writer/max_queue_depth
+        index_writer/commands, index_writer/commits, index_writer/errors
+    Timings (see `Metrics`): `analyze` (applying a command), `commit`, and `index_latency` (from queueing to committing).
+    """
+
+    def __init__(
+        self,
+        index,
+        batch_size: int = 100,
+        commit_interval: float = 5,
+        max_queue: int = 10_000,
+        write_timeout: float = 60,
+        merge_policy: Optional[TieredMergePolicy] = None,
+        merge_scheduler: Optional[MergeScheduler] = None,
+        metrics: Optional[Metrics] = None,
+        stats=None,
+    ) -> None:
+        self.index = index
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.write_timeout = write_timeout
+        self.merge_policy = merge_policy or TieredMergePolicy()
+        self.merge_scheduler = merge_scheduler
+        self.metrics = metrics or Metrics(enabled=False)
+        self.stats = stats
+        self.max_queue = max_queue
+        self.queue: "queue.Queue[Optional[IndexCommand]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped: Optional[Deferred] = None
+        # whether `_run` has returned (or died), and the Deferreds waiting for room in the queue, shared with the reactor's thread
+        self._lock = threading.Lock()
+        self._finished = False
+        self._waiting: List[Deferred] = []
+        self._writer = None
+        self._opened_at = 0.0
+        self._batch: List[tuple] = []
+        self._batch_urls: Set[str] = set()
+        self._upserts: List[IndexCommand] = []
+
+    def start(self):
+        from twisted.internet import reactor
+
+        self.reactor = reactor
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="index-writer", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> Deferred:
+        """Commits everything that's queued, then stops the thread.
+
+        Returns:
+            Deferred: Fires once the thread has stopped.
+        """
+        if self._stopped is None:
+            with self._lock:
+                self._stopped = Deferred()
+                finished = self._thread is None or self._finished
+            if finished:
+                self._stopped.callback(None)
+            else:
+                self.queue.put(None)
+        return self._stopped
+
+    @property
+    def full(self) -> bool:
+        """Whether `max_queue` commands are waiting, in which case callers should `wait_for_room` before queueing more."""
+        return self.queue.qsize() >= self.max_queue
+
+    def wait_for_room(self) -> Deferred:
+        """Returns a Deferred that fires (in the reactor's thread) once the queue is at most half full."""
+        d = Deferred()
+        with self._lock:
+            if self.queue.qsize() > self.max_queue // 2 and not self._finished:
+                self._waiting.append(d)
+                return d
+        d.callback(None)
+        return d
+
+    def _notify_waiting(self):
+        with self._lock:
+            if not self._waiting or (
+                self.queue.qsize() > self.max_queue // 2 and not self._finished
+            ):
+                return
+            waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            self.reactor.callFromThread(d.callback, None)
+
+    def _submit(self, function: Callable, *args, url: Optional[str] = None) -> Deferred:
+        d = Deferred()
+        self.queue.put(IndexCommand(function, args, d, perf_counter(), url))
+        self._set_queue_depth()
+        return d
+
+    def add(self, **fields) -> Deferred:
+        """Adds a document, without checking whether its url is already in the index."""
+        return self._submit(self._add, fields, url=fields.get("url"))
+
+    def upsert(
+        self,
+        fields: Dict[str, Any],
+        fields_if_exists: Optional[Dict[str, Any]] = None,
+        comparison_functions: Optional[Dict[str, Callable]] = None,
+    ) -> Deferred:
+        """Adds a document, or updates the one with the same url (see `MyIndexWriter.update_document`)."""
+        return self._submit(
+            self._upsert,
+            fields,
+            fields_if_exists,
+            comparison_functions or {},
+            url=fields.get("url"),
+        )
+
+    def delete_by_term(self, fieldname: str, text) -> Deferred:
+        """Deletes every document with the term. The Deferred fires with the number deleted."""
+        return self._submit(self._delete_by_term, fieldname, text)
+
+    def delete_by_host(
+        self, url: str, should_delete: Optional[Callable[[str], bool]] = None
+    ) -> Deferred:
+        """Deletes the documents on the url's host (scheme and netloc), or only the ones whose url `should_delete` returns True for.
+
+        The Deferred fires with the number deleted.
+        """
+        return self._submit(self._delete_by_host, url, should_delete)
+
+    def call(self, function: Callable, *args) -> Deferred:
+        """Runs `function(writer, *args)` in the thread, for changes the other commands don't cover.
+
+        The Deferred fires with its result.
+        """
+        return self._submit(function, *args)
+
+    def _add(self, writer, fields: Dict[str, Any]):
+        writer.add_document(**fields)
+
+    def _upsert(self, writer, fields, fields_if_exists, comparison_functions):
+        # upserts are applied together by `_apply_upserts`, this is what each one amounts to
+        writer.update_document(
+            **fields,
+            fields_if_exists=fields_if_exists,
+            comparison_functions=comparison_functions,
+        )
+
+    def _delete_by_term(self, writer, fieldname: str, text) -> int:
+        return writer.delete_by_term(fieldname, text)
+
+    def _delete_by_host(self, writer, url: str, should_delete) -> int:
+        split_url = urlsplit(url)
+        prefix = f"{split_url.scheme}://{split_url.netloc}/"
+        with self.index.searcher() as searcher:
+            urls = [
+                searcher.stored_fields(docnum)["url"]
+                for docnum in searcher.docs_for_query(Prefix("url", prefix))
+            ]
+        return sum(
+            writer.delete_by_term("url", url)
+            for url in urls
+            if should_delete is None or should_delete(url)
+        )
+
+    def _set_queue_depth(self):
+        if self.stats is not None:
+            depth = self.queue.qsize()
+            self.stats.set_value("index_writer/queue_depth", depth)
+            self.stats.max_value("index_writer/max_queue_depth", depth)
+
+    def _inc(self, name: str, count: int = 1):
+        if self.stats is not None:
+            self.stats.inc_value(f"index_writer/{name}", count)
+
+    def _open_writer(self):
+        if self._writer is None:
+            self._writer = self.index.writer(timeout=self.write_timeout)
+            self._opened_at = perf_counter()
+
+    def _apply(self, command: IndexCommand):
+        if command.function == self._upsert:
+            if command.url in self._batch_urls:
+                self._commit()
+            try:
+                self._open_writer()
+            except Exception:
+                self._inc("errors")
+                self.reactor.callFromThread(command.deferred.errback, Failure())
+                return
+            self._upserts.append(command)
+            return
+        # anything else sees (and comes after) the upserts before it
+        self._apply_upserts()
+        reads = command.url is None
+        if self._batch_urls and (reads or command.url in self._batch_urls):
+            self._commit()
+        try:
+            self._open_writer()
+            with self.metrics.time("analyze"):
+                result = command.function(self._writer, *command.args)
+        except Exception:
+            self._inc("errors")
+            self.reactor.callFromThread(command.deferred.errback, Failure())
+            return
+        self._inc("commands")
+        self._batch.append((command, result))
+        if command.url is not None:
+            self._batch_urls.add(command.url)
+
+    def _apply_upserts(self):
+        upserts, self._upserts = self._upserts, []
+        if not upserts:
+            return
+        try:
+            with self.metrics.time("analyze"):
+                self._writer.update_documents(
+                    dict(
+                        fields,
+                        fields_if_exists=fields_if_exists,
+                        comparison_functions=comparison_functions,
+                    )
+                    for fields, fields_if_exists, comparison_functions in (
+                        command.args for command in upserts
+                    )
+                )
+        except Exception:
+            self._inc("errors", len(upserts))
+            failure = Failure()
+            for command in upserts:
+                self.reactor.callFromThread(command.deferred.errback, failure)
+            return
+        self._inc("commands", len(upserts))
+        for command in upserts:
+            self._batch.append((command, None))
+            self._batch_urls.add(command.url)
+
+    def _cancel(self, writer):
+        # releases the index's lock, unless whatever failed already has
+        try:
+            writer.cancel()
+        except Exception:
+            pass
+
+    def _commit(self):
+        self._apply_upserts()
+        batch, self._batch, self._batch_urls = self._batch, [], set()
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+        try:
+            with self.metrics.time("commit"):
+                writer.commit(
+                    mergetype=NO_MERGE if self.merge_scheduler else self.merge_policy
+                )
+        except Exception:
+            self._inc("errors")
+            failure = Failure()
+            self._cancel(writer)
+            for command, _ in batch:
+                self.reactor.callFromThread(command.deferred.errback, failure)
+            return
+        self._inc("commits")
+        now = perf_counter()
+        for command, result in batch:
+            self.metrics.observe("index_latency", now - command.queued_at)
+            self.reactor.callFromThread(command.deferred.callback, result)
+
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            print(f"The index writer stopped: {e!r}")
+            if self._writer is not None:
+                self._cancel(self._writer)
+                self._writer = None
+        finally:
+            with self._lock:
+                self._finished = True
+                stopped = self._stopped
+            self._notify_waiting()
+            # if `stop` hasn't been called yet, its Deferred fires straight away
+            if stopped is not None:
+                self.reactor.callFromThread(stopped.callback, None)
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            if self._writer is not None:
+                timeout = max(
+                    0, self._opened_at + self.commit_interval - perf_counter()
+                )
+            else:
+                timeout = (
+                    self.merge_scheduler.interval if self.merge_scheduler else None
+                )
+            try:
+                command = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if self._writer is not None:
+                    self._commit()
+                elif self.merge_scheduler is not None:
+                    try:
+                        self.merge_scheduler.run_once()
+                    except Exception as e:
+                        print(f"Merging the index failed: {e!r}")
+                continue
+            self._set_queue_depth()
+            self._notify_waiting()
+            if command is None:
+                stopping = True
+            else:
+                self._apply(command)
+            if stopping or len(self._batch) + len(self._upserts) >= self.batch_size:
+                self._commit()
@@ -0,0 +1,415 @@
+"""
+Timing histograms and counters, for finding out where the time goes when crawling or searching.
+
+The crawler's metrics are recorded into its stats (histograms under `timing/<stage>`), use `Metrics.from_crawler` to get them.
+Searching records into `whoosh_backend.METRICS`.
+Either can be exported to a file on a timer, in Prometheus' text format (e.g. for node_exporter's textfile collector) or as JSON.
+
+When metrics are disabled, timing something costs one attribute check and a shared no-op context manager.
+
+This module doesn't import anything from the crawler (or scrapy, unless it's used as an extension),
+so searching (`crawler.whoosh_backend`) can use it without importing scrapy (e.g. in `web.rs`).
+"""
+
+import json
+import os
+import sys
+import threading
+from bisect import bisect_left
+from collections import Counter
+from contextlib import nullcontext
+from time import perf_counter, sleep, time
+from typing import Any, Dict, Optional, Sequence
+
+# upper bounds (seconds) of the histograms' buckets, the last bucket is everything above them
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class Histogram:
+    """
+    Counts of observed values (e.g. durations) in fixed buckets, plus their count and sum (like a Prometheus histogram).
+
+    Updates aren't locked, so an observation can (rarely) be lost when several threads observe at once.
+    """
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimates the `q` quantile, interpolating within its bucket (the same way Prometheus' `histogram_quantile` does)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                # past the last bound, there's nothing better to return
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i else 0.0
+                return low + (self.buckets[i] - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(map(str, self.buckets + (float("inf"),)), self.counts)),
+        }
+
+    def __repr__(self) -> str:
+        # this is what's shown when scrapy dumps its stats
+        if not self.count:
+            return "Histogram(count=0)"
+        return (
+            f"Histogram(count={self.count}, mean={self.sum / self.count * 1e3:.2f}ms, "
+            f"p50={self.quantile(0.5) * 1e3:.2f}ms, p95={self.quantile(0.95) * 1e3:.2f}ms, p99={self.quantile(0.99) * 1e3:.2f}ms)"
+        )
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> "_Timer":
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+_NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """
+    A registry of named timing histograms and counters.
+
+    Time a stage with `with metrics.time("commit"): ...`, or record a duration measured elsewhere with `observe`.
+    If `stats` (a scrapy `StatsCollector`) is given, histograms are also stored in it (as `timing/<name>`),
+    and counters are scrapy stats, otherwise they're kept here.
+
+    Settings (for `from_crawler`, and the `MetricsExport` extension):
+        METRICS_ENABLED: whether anything is recorded.
+        METRICS_EXPORT_PATH: where to export the metrics to (as JSON if it ends with `.json`, otherwise in Prometheus' text format).
+        METRICS_EXPORT_INTERVAL: how often they're exported (seconds).
+        METRICS_PROFILE_ENABLED: whether to run the `SamplingProfiler` as well.
+        METRICS_PROFILE_INTERVAL: how often it samples (seconds).
+        METRICS_PROFILE_PATH: where the profiler's samples are written to (whenever the metrics are exported).
+    """
+
+    def __init__(self, enabled: bool = True, stats=None, prefix: str = "") -> None:
+        self.enabled = enabled
+        self.stats = stats
+        self.prefix = prefix
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Counter = Counter()
+        self._exporting: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_crawler(cls, crawler) -> "Metrics":
+        """Returns the crawler's shared instance, creating it if needed."""
+        metrics = getattr(crawler, "metrics", None)
+        if metrics is None:
+            metrics = cls(
+                enabled=crawler.settings.getbool("METRICS_ENABLED", False),
+                stats=crawler.stats,
+                prefix="crawler_",
+            )
+            crawler.metrics = metrics
+        return metrics
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+            if self.stats is not None:
+                self.stats.set_value(f"timing/{name}", histogram)
+        return histogram
+
+    def time(self, name: str):
+        """Returns a context manager that records how long its block takes."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self.histogram(name))
+
+    def observe(self, name: str, seconds: float):
+        if self.enabled:
+            self.histogram(name).observe(seconds)
+
+    def observe_since(self, result, name: str, start: float):
+        """Records the time since `start` (a `perf_counter` value), and returns `result`, for use as a Deferred callback."""
+        if self.enabled:
+            self.histogram(name).observe(perf_counter() - start)
+        return result
+
+    def inc(self, name: str, count: int = 1):
+        if not self.enabled:
+            return
+        if self.stats is not None:
+            self.stats.inc_value(name, count)
+        else:
+            self.counters[name] += count
+
+    def _counters(self) -> Dict[str, Any]:
+        if self.stats is None:
+            return dict(self.counters)
+        # every numeric stat, not just the ones counted here
+        return {
+            name: value
+            for name, value in self.stats.get_stats().items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "time": time(),
+                "timings": {
+                    name: histogram.to_dict()
+                    for name, histogram in self.histograms.items()
+                },
+                "counters": self._counters(),
+            },
+            indent=2,
+        )
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in Prometheus' text exposition format.
+
+        Every histogram is a `stage` of `<prefix>stage_seconds`, and every counter is a `name` of `<prefix>value`.
+        """
+        lines = []
+        family = f"{self.prefix}stage_seconds"
+        if self.histograms:
+            lines.append(f"# TYPE {family} histogram")
+        for name, histogram in self.histograms.items():
+            stage = _label(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'{family}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'{family}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}'
+            )
+            lines.append(f'{family}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{family}_count{{stage="{stage}"}} {histogram.count}')
+        counters = self._counters()
+        if counters:
+            lines.append(f"# TYPE {self.prefix}value gauge")
+        for name, value in counters.items():
+            lines.append(f'{self.prefix}value{{name="{_label(name)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str):
+        """Writes the metrics to `path` (replacing it atomically), as JSON if it ends with `.json`, otherwise in Prometheus' text format."""
+        output = self.to_json() if path.endswith(".json") else self.to_prometheus()
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(output)
+        os.replace(temp_path, path)
+
+    def start_exporting(
+        self,
+        path: str,
+        interval: float = 60,
+        profiler: Optional["SamplingProfiler"] = None,
+        profile_path: Optional[str] = None,
+    ):
+        """Exports the metrics (and the profiler's samples, if given) every `interval` seconds, from a background thread."""
+        if self._exporting is not None:
+            return
+
+        def export_loop():
+            while True:
+                sleep(interval)
+                try:
+                    self.export(path)
+                    if profiler is not None and profile_path:
+                        profiler.write(profile_path)
+                except OSError as e:
+                    print(
+                        f"Couldn't export the metrics to {path}: {e}", file=sys.stderr
+                    )
+
+        self._exporting = threading.Thread(
+            target=export_loop, name="metrics-export", daemon=True
+        )
+        self._exporting.start()
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler: every `interval` seconds (from a background thread), the stack of every other thread is sampled,
+    and the number of times each stack was seen is counted.
+
+    The samples are written in the "collapsed" format (`file:function;file:function;... count` per line, outermost frame first),
+    which flame graph tools (e.g. flamegraph.pl or speedscope) read.
+    Unlike `cProfile`, this doesn't slow the profiled code down (only the sampling thread takes the GIL, briefly).
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(temp_path, path)
+
+
+class MetricsExport:
+    """
+    Extension that records download times (`download_latency`, as the `download` stage),
+    and exports the crawler's metrics every `METRICS_EXPORT_INTERVAL` seconds and when the spider closes.
+
+    Also runs the `SamplingProfiler` if `METRICS_PROFILE_ENABLED` is set.
+    Does nothing unless `METRICS_ENABLED` is set (see `Metrics` for the settings).
+    """
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        path: Optional[str],
+        interval: float,
+        profiler: Optional[SamplingProfiler] = None,
+        profile_path: Optional[str] = None,
+    ) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.profiler = profiler
+        self.profile_path = profile_path
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from scrapy import signals
+        from scrapy.exceptions import NotConfigured
+
+        settings = crawler.settings
+        if not settings.getbool("METRICS_ENABLED", False):
+            raise NotConfigured
+        profiler = None
+        if settings.getbool("METRICS_PROFILE_ENABLED", False):
+            profiler = SamplingProfiler(
+                settings.getfloat("METRICS_PROFILE_INTERVAL", 0.01)
+            )
+        o = cls(
+            Metrics.from_crawler(crawler),
+            settings.get("METRICS_EXPORT_PATH"),
+            settings.getfloat("METRICS_EXPORT_INTERVAL", 60),
+            profiler,
+            settings.get("METRICS_PROFILE_PATH", "profile.folded"),
+        )
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(
+            o.response_downloaded, signal=signals.response_downloaded
+        )
+        return o
+
+    def spider_opened(self, spider):
+        from twisted.internet import task
+
+        if self.profiler is not None:
+            self.profiler.start()
+        if self.path:
+            self.task = task.LoopingCall(self.export)
+            self.task.start(self.interval, now=False)
+
+    def response_downloaded(self, response, request, spider):
+        if (latency := request.meta.get("download_latency")) is not None:
+            self.metrics.observe("download", latency)
+
+    def export(self):
+        try:
+            if self.path:
+                self.metrics.export(self.path)
+            if self.profiler is not None and self.profile_path:
+                self.profiler.write(self.profile_path)
+        except OSError as e:
+            print(f"Couldn't export the metrics to {self.path}: {e}", file=sys.stderr)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.export()
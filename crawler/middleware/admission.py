@@ -0,0 +1,169 @@
+import re
+from typing import Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from rfc3986 import is_valid_uri
+from scrapy import Request
+from scrapy.crawler import Crawler
+from scrapy.settings import Settings
+from scrapy.utils.datatypes import LocalCache
+from scrapy.utils.url import canonicalize_url
+
+INVALID = "is invalid"
+NOT_ALLOWED = "isn't allowed."
+INVALID_TLD = "doesn't have a valid TLD."
+
+ADMITTED_META_KEY = "admitted_url"
+"The request meta key `URLValidator` stores the admitted (canonical) url in."
+
+
+def is_admitted(request: Request) -> bool:
+    """Returns True if the request's current url has already passed `URLAdmission.check`."""
+    return request.meta.get(ADMITTED_META_KEY) == request.url
+
+
+class URLAdmission:
+    """
+    Decides whether a url may be crawled (or kept in the index).
+
+    This combines the checks done by `URLValidator`, `URLFilter` and `TLDFilter`,
+    so a url only has to be split once:
+        1. The scheme must be http(s).
+        2. The host's TLD is looked up in a set (`ALLOWED_TLDS` or `DISALLOWED_TLDS`).
+           The verdict is cached per netloc, as most urls share a handful of hosts.
+        3. The url must be a valid URI, and is then canonicalised.
+        4. The canonical url is matched against one compiled, anchored pattern
+           built from `URL_WHITELIST` (or `URL_BLACKLIST` if there is no whitelist).
+
+    The cheap checks run first, so rejected urls never pay for canonicalisation.
+
+    One instance is shared per crawler, use `URLAdmission.from_crawler` to get it.
+    """
+
+    def __init__(
+        self,
+        allowed_tlds: Iterable[str] = (),
+        disallowed_tlds: Iterable[str] = (),
+        whitelist: Iterable[str] = (),
+        blacklist: Iterable[str] = (),
+        cache_size: int = 10000,
+    ) -> None:
+        self.allowed_tlds = frozenset(t.lower().lstrip(".") for t in allowed_tlds)
+        self.disallowed_tlds = frozenset(t.lower().lstrip(".") for t in disallowed_tlds)
+        if self.allowed_tlds and self.disallowed_tlds:
+            raise ValueError(
+                "Do not define allowed_urls AND disallowed_urls. Define one or the other."
+            )
+        whitelist, blacklist = list(whitelist or []), list(blacklist or [])
+        # If both lists are set, the whitelist is used (same as `URLFilter`)
+        self.is_whitelist = bool(whitelist)
+        patterns = whitelist or blacklist
+        self.url_pattern: Optional[re.Pattern] = (
+            re.compile(r"https?://(?:" + r"|".join(f"(?:{p})" for p in patterns) + r")")
+            if patterns
+            else None
+        )
+        self._netlocs: LocalCache[str, bool] = LocalCache(cache_size)
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "URLAdmission":
+        return cls(
+            allowed_tlds=settings.getlist("ALLOWED_TLDS"),
+            disallowed_tlds=(
+                []
+                if settings.getlist("ALLOWED_TLDS")
+                else settings.getlist("DISALLOWED_TLDS")
+            ),
+            whitelist=settings.getlist("URL_WHITELIST"),
+            blacklist=settings.getlist("URL_BLACKLIST"),
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> "URLAdmission":
+        """Returns the crawler's shared instance, creating it if needed."""
+        admission = getattr(crawler, "url_admission", None)
+        if admission is None:
+            admission = cls.from_settings(crawler.settings)
+            crawler.url_admission = admission
+        return admission
+
+    def _host_allowed(self, hostname: Optional[str]) -> bool:
+        if not hostname:
+            return False
+        _, dot, tld = hostname.rpartition(".")
+        if not dot:
+            return False
+        if self.allowed_tlds:
+            return tld in self.allowed_tlds
+        return tld not in self.disallowed_tlds
+
+    def netloc_allowed(self, scheme: str, netloc: str) -> bool:
+        """Checks the scheme and TLD of a url, using the per-netloc cache."""
+        # we check for http/https on the off chance that we find ftp urls (etc.)
+        if scheme not in ("http", "https"):
+            return False
+        try:
+            return self._netlocs[netloc]
+        except KeyError:
+            pass
+        hostname = netloc.rpartition("@")[2]
+        if hostname.startswith("["):  # ip v6 addresses don't have TLDs
+            allowed = False
+        else:
+            allowed = self._host_allowed(hostname.partition(":")[0].lower())
+        self._netlocs[netloc] = allowed
+        return allowed
+
+    def tld_allowed(self, url: str) -> bool:
+        split_url = urlsplit(url)
+        return self.netloc_allowed(split_url.scheme.lower(), split_url.netloc)
+
+    def url_allowed(self, url: str) -> bool:
+        """Matches the url against `URL_WHITELIST`/`URL_BLACKLIST`."""
+        if self.url_pattern is None:
+            return False
+        return bool(self.url_pattern.match(url)) == self.is_whitelist
+
+    def canonicalize(self, url: str) -> Optional[str]:
+        """Returns the canonical url if it's a valid URI, otherwise `None`."""
+        if not is_valid_uri(url):
+            return None
+        return canonicalize_url(url)
+
+    def check(self, url: str) -> Tuple[Optional[str], Optional[str]]:
+        """Runs every check on the url.
+
+        Returns:
+            Tuple[Optional[str], Optional[str]]: The canonical url and `None` if the url is admitted, otherwise `None` and the reason it was rejected.
+        """
+        try:
+            split_url = urlsplit(url)
+        except ValueError:
+            return None, INVALID
+        if not self.netloc_allowed(split_url.scheme.lower(), split_url.netloc):
+            return None, INVALID_TLD
+        canonical_url = self.canonicalize(url)
+        if canonical_url is None:
+            return None, INVALID
+        if not self.url_allowed(canonical_url):
+            return None, NOT_ALLOWED
+        return canonical_url, None
+
+    def admit(self, url: str) -> Optional[str]:
+        """Returns the canonical url if it's admitted, otherwise `None`."""
+        return self.check(url)[0]
+
+    def admit_many(self, urls: Iterable[str]) -> List[str]:
+        """Returns the canonical form of every admitted url, in order and without duplicates."""
+        admitted = {}
+        for url in urls:
+            try:
+                split_url = urlsplit(url)
+            except ValueError:
+                continue
+            if not self.netloc_allowed(split_url.scheme.lower(), split_url.netloc):
+                continue
+            canonical_url = self.canonicalize(url)
+            if canonical_url is not None and self.url_allowed(canonical_url):
+                admitted[canonical_url] = None
+        return list(admitted)
@@ -1,3 +1,12 @@
+import heapq
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from itertools import groupby
+from pathlib import Path
+from time import perf_counter, time_ns
 from urllib.parse import urlsplit
 from dns import resolver
 from scrapy import Request
@@ -7,8 +16,11 @@ from scrapy.downloadermiddlewares.robotstxt import (
     RobotsTxtMiddleware,
     urlparse_cached,
 )
+from scrapy.dupefilters import RFPDupeFilter
 from scrapy.http import Response
 from scrapy.resolver import CachingThreadedResolver
+from scrapy.statscollectors import StatsCollector
+from scrapy.utils.job import job_dir
 from scrapy.spidermiddlewares.depth import DepthMiddleware
 from scrapy.utils.request import fingerprint
 
@@ -17,12 +29,13 @@ from typing import List, Optional
 from crawler.custom_signals import RECHECK_DB_FOR_NETLOC
 from twisted.internet.defer import CancelledError
 
+from crawler.metrics import Metrics
 from crawler.middleware.misc import SemiPermanentDict, QueueTotal
 
 from scrapy.resolver import CachingThreadedResolver
 from twisted.internet import defer
 from twisted.internet.threads import deferToThread
-from typing import Optional, List, Any
+from typing import Dict, Iterable, Optional, List, Any, Sequence, Set, Tuple
 from scrapy.crawler import Crawler
 
 
@@ -41,6 +54,7 @@ class CustomDNSResolver(CachingThreadedResolver):
             List[str]
         ] = None,  # Custom DNS servers (List of IP addresses)
         auto_fetch_servers: bool = True,  # If True, fetches nearby server IPs using the OpenNIC API
+        metrics: Optional[Metrics] = None,  # Records how long lookups (that miss the cache) take, as the `dns` stage
     ):
         servers = servers or [
             "109.91.184.21",
@@ -67,11 +81,14 @@ class CustomDNSResolver(CachingThreadedResolver):
 
         self.resolver = resolver.Resolver()
         self.resolver.nameservers = servers
+        self.metrics = metrics or Metrics(enabled=False)
 
     def getHostByName(self, name: str, timeout=None):
         if name in dnscache:
             return defer.succeed(dnscache[name])
         d = deferToThread(self.resolve_host, name)
+        if self.metrics.enabled:
+            d.addBoth(self.metrics.observe_since, "dns", perf_counter())
         if dnscache.limit:
             d.addCallback(self._cache_result, name)
         return d
@@ -87,7 +104,12 @@ class CustomDNSResolver(CachingThreadedResolver):
     def from_crawler(cls, crawler: Crawler, reactor):
         servers = crawler.settings.getlist("DNS_SERVERS", [])
         auto_fetch_servers = crawler.settings.getbool("AUTO_FETCH_DNS", True)
-        return cls(reactor, servers=servers, auto_fetch_servers=auto_fetch_servers)
+        return cls(
+            reactor,
+            servers=servers,
+            auto_fetch_servers=auto_fetch_servers,
+            metrics=Metrics.from_crawler(crawler),
+        )
 
 
 class DomainAwareDepthMiddleware(DepthMiddleware):
@@ -127,6 +149,7 @@ class TimedRobotsTxtMiddleware(RobotsTxtMiddleware):
         self._parsers = SemiPermanentDict(
             max_len=concurrent_request_limit * 2, max_age_seconds=7200
         )
+        self.metrics = Metrics.from_crawler(crawler)
 
     def process_request(self, request, spider):
         if request.meta.get("dont_obey_robotstxt"):
@@ -183,6 +206,9 @@ class TimedRobotsTxtMiddleware(RobotsTxtMiddleware):
             dfd = self.crawler.engine.download(robotsreq)
 
             dfd.addCallback(self._parse_robots, netloc, spider)
+            if self.metrics.enabled:
+                # fetching and parsing robots.txt
+                dfd.addBoth(self.metrics.observe_since, "robots", perf_counter())
             if request.meta.get("refresh_robots", False):
 
                 def cb(result, *_, **__):
@@ -219,3 +245,237 @@ class RequestFingerprinter:
         if "normalised" in request.meta:
             fp += b"\x00"
         return fp
+
+
+class BloomFilter:
+    """A bloom filter over 64 bit (already hashed) keys, using double hashing."""
+
+    def __init__(
+        self, capacity: int, hashes: int = 7, bits: Optional[bytearray] = None
+    ):
+        # ~9.6 bits per entry gives a 1% false positive rate at capacity
+        self.size = max(64, int(capacity * 9.6))
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.size = len(self.bits) * 8
+
+    def _positions(self, key: int):
+        h1 = key & 0xFFFFFFFF
+        h2 = (key >> 32) | 1
+        size = self.size
+        return ((h1 + i * h2) % size for i in range(self.hashes))
+
+    def add(self, key: int):
+        bits = self.bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key: int) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class CompactDupeFilter(RFPDupeFilter):
+    """
+    A dupefilter for crawls with millions of urls.
+
+    Fingerprints (from `RequestFingerprinter`, so including the `normalised` marker)
+    are hashed to 8 bytes along with the request's `frontier_lease` (see `crawler.frontier`),
+    so a url is only filtered within a lease, and can be fetched again in a later crawl.
+    They're stored in sorted runs of unsigned 64 bit integers
+    (`JOBDIR/seen/run-*.u64`), which are memory mapped and binary searched.
+    A bloom filter in front of the runs answers most lookups for unseen requests without touching them.
+
+    New fingerprints are kept in memory and written out as a new run every `DUPEFILTER_BATCH_SIZE` requests.
+    Runs are merged whenever the newest run is at least half the size of the one before it,
+    so there are only ever O(log n) runs.
+    Every lease adds its urls again, so `DUPEFILTER_CAPACITY` should allow for the number of crawls kept in JOBDIR.
+
+    Settings:
+        DUPEFILTER_CAPACITY: the number of urls the bloom filter is sized for.
+        DUPEFILTER_BATCH_SIZE: how many new fingerprints are kept in memory before being written out.
+
+    Stats:
+        dupefilter/entries, dupefilter/bytes_per_url, dupefilter/lookups, dupefilter/lookups_per_second
+    """
+
+    RUN_SUFFIX = ".u64"
+    BLOOM_NAME = "bloom.bin"
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        debug: bool = False,
+        *,
+        fingerprinter=None,
+        capacity: int = 10_000_000,
+        batch_size: int = 10_000,
+        stats: Optional[StatsCollector] = None,
+    ) -> None:
+        # the parent would read requests.seen into a set, which is what this avoids
+        super().__init__(None, debug, fingerprinter=fingerprinter)
+        self.dir = Path(path, "seen") if path else None
+        self.batch_size = batch_size
+        self.stats = stats
+        self.pending: Set[int] = set()
+        self.runs: List[Tuple[Optional[Path], Sequence[int]]] = []
+        self._maps: Dict[Path, mmap.mmap] = {}
+        self.lookups = 0
+        self.lookup_time = 0.0
+
+        count = 0
+        if self.dir is not None:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            for run_path in sorted(self.dir.glob(f"run-*{self.RUN_SUFFIX}")):
+                if run := self._map_run(run_path):
+                    self.runs.append((run_path, run))
+                    count += len(run)
+        self.bloom = self._load_bloom(capacity, count)
+        if self.dir is not None and not self.runs:
+            self._import_legacy(Path(path, "requests.seen"))
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        return cls(
+            job_dir(settings),
+            settings.getbool("DUPEFILTER_DEBUG"),
+            fingerprinter=crawler.request_fingerprinter,
+            capacity=settings.getint("DUPEFILTER_CAPACITY", 10_000_000),
+            batch_size=settings.getint("DUPEFILTER_BATCH_SIZE", 10_000),
+            stats=crawler.stats,
+        )
+
+    @staticmethod
+    def hash_fingerprint(fp: bytes) -> int:
+        return int.from_bytes(blake2b(fp, digest_size=8).digest(), "little")
+
+    def request_key(self, request: Request) -> int:
+        fp = self.fingerprinter.fingerprint(request)
+        lease = request.meta.get("frontier_lease")
+        if lease is not None:
+            fp += b"\x01" + str(lease).encode()
+        return self.hash_fingerprint(fp)
+
+    def _map_run(self, run_path: Path) -> Optional[memoryview]:
+        if not run_path.stat().st_size:
+            run_path.unlink()
+            return None
+        with run_path.open("rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[run_path] = m
+        return memoryview(m).cast("Q")
+
+    def _unmap_run(self, run_path: Optional[Path], run: Sequence[int]):
+        if isinstance(run, memoryview):
+            run.release()
+        if (m := self._maps.pop(run_path, None)) is not None:
+            m.close()
+
+    def _load_bloom(self, capacity: int, count: int) -> BloomFilter:
+        # the saved bloom filter is only valid if it was saved with the same runs
+        if self.dir is not None and (bloom_path := self.dir / self.BLOOM_NAME).exists():
+            data = bloom_path.read_bytes()
+            saved_count, hashes = struct.unpack_from("<QI", data)
+            if saved_count == count:
+                return BloomFilter(capacity, hashes, bytearray(data[12:]))
+        bloom = BloomFilter(capacity)
+        for _, run in self.runs:
+            for key in run:
+                bloom.add(key)
+        return bloom
+
+    def _import_legacy(self, seen_path: Path):
+        """Imports the fingerprints in scrapy's `requests.seen`, from before this dupefilter was used."""
+        if not seen_path.exists():
+            return
+        with seen_path.open(encoding="utf-8") as f:
+            for line in f:
+                if line := line.rstrip():
+                    self._add(self.hash_fingerprint(bytes.fromhex(line)))
+        self.flush()
+        seen_path.unlink()
+
+    @staticmethod
+    def _contains(run: Sequence[int], key: int) -> bool:
+        i = bisect_left(run, key)
+        return i < len(run) and run[i] == key
+
+    def _add(self, key: int):
+        self.pending.add(key)
+        self.bloom.add(key)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def request_seen(self, request: Request) -> bool:
+        start = perf_counter()
+        key = self.request_key(request)
+        seen = key in self.bloom and (
+            key in self.pending or any(self._contains(run, key) for _, run in self.runs)
+        )
+        if not seen:
+            self._add(key)
+        self.lookups += 1
+        self.lookup_time += perf_counter() - start
+        return seen
+
+    def _write_run(self, keys: Iterable[int]) -> Tuple[Optional[Path], Sequence[int]]:
+        run = array("Q", keys)
+        if self.dir is None:
+            return None, run
+        # the name sorts after every existing run, so runs are loaded in order
+        run_path = self.dir / f"run-{time_ns():020d}{self.RUN_SUFFIX}"
+        tmp_path = run_path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            run.tofile(f)
+        tmp_path.replace(run_path)
+        return run_path, self._map_run(run_path)
+
+    def flush(self):
+        """Writes the pending fingerprints as a new run, merging runs where needed."""
+        if not self.pending:
+            return
+        self.runs.append(self._write_run(sorted(self.pending)))
+        self.pending.clear()
+        while len(self.runs) > 1 and len(self.runs[-1][1]) * 2 >= len(self.runs[-2][1]):
+            (old_path, older), (new_path, newer) = self.runs[-2:]
+            merged = self._write_run(
+                key for key, _ in groupby(heapq.merge(older, newer))
+            )
+            for run_path, run in self.runs[-2:]:
+                self._unmap_run(run_path, run)
+                if run_path is not None:
+                    run_path.unlink()
+            self.runs[-2:] = [merged]
+        if self.dir is not None:
+            with (self.dir / self.BLOOM_NAME).open("wb") as f:
+                f.write(struct.pack("<QI", self.entries, self.bloom.hashes))
+                f.write(self.bloom.bits)
+        self._update_stats()
+
+    @property
+    def entries(self) -> int:
+        return len(self.pending) + sum(len(run) for _, run in self.runs)
+
+    def _update_stats(self):
+        if self.stats is None:
+            return
+        entries = self.entries
+        self.stats.set_value("dupefilter/entries", entries)
+        self.stats.set_value("dupefilter/lookups", self.lookups)
+        if entries:
+            self.stats.set_value(
+                "dupefilter/bytes_per_url",
+                round((entries * 8 + len(self.bloom.bits)) / entries, 2),
+            )
+        if self.lookup_time:
+            self.stats.set_value(
+                "dupefilter/lookups_per_second", int(self.lookups / self.lookup_time)
+            )
+
+    def close(self, reason: str) -> None:
+        self.flush()
+        self._update_stats()
+        for run_path, run in self.runs:
+            self._unmap_run(run_path, run)
+        self.runs = []
@@ -1,16 +1,23 @@
-import re
 from urllib.parse import urlsplit
-from scrapy import Request, Spider
+from scrapy import Request, Spider, signals
 from scrapy.crawler import Crawler
-from scrapy.exceptions import IgnoreRequest
+from scrapy.exceptions import IgnoreRequest, StopDownload
 
 
 import mimetypes
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from scrapy.http import Response
+from scrapy.http import Headers, Response, TextResponse
+from scrapy.statscollectors import StatsCollector
 
 from crawler.custom_signals import TLD_FILTER_CHECK, URL_FILTER_CHECK
+from crawler.document import ParsedDocument, SelectorUnion
+from crawler.middleware.admission import (
+    INVALID_TLD,
+    NOT_ALLOWED,
+    URLAdmission,
+    is_admitted,
+)
 
 
 class MimetypeFilter:
@@ -55,6 +62,127 @@ class MimetypeFilter:
         raise IgnoreRequest(f"{request.url} has the incorrect mimetype.")
 
 
+class ContentTypeFilter:
+    """
+    Filters downloads based on the `Content-Type` header, as soon as the headers arrive.
+
+    `MimetypeFilter` can only guess the mimetype from the url, so this stops
+    the body of (e.g.) binaries behind extensionless urls from being downloaded.
+    It's an extension, as it works with the `headers_received` and `bytes_received` signals.
+
+    Settings:
+        ALLOWED_MIMETYPES should be a list of allowed mimetypes.
+        DEFAULT_MIMETYPE is the mimetype used when there is no `Content-Type` header.
+        MIMETYPE_MAX_SIZES is a dict of {mimetype: max body size in bytes}.
+            Mimetypes without an entry have no limit (other than `DOWNLOAD_MAXSIZE`).
+            "text/html" responses are truncated at the limit, rather than being dropped.
+
+    Stats:
+        content_type_filter/aborted, content_type_filter/truncated, content_type_filter/bytes_saved
+        (bytes saved can only be counted when the server sends a `Content-Length` header.)
+    """
+
+    TRUNCATED_MIMETYPES = ("text/html",)
+    _meta_key = "content_type_filter"
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        allowed_mimetypes = crawler.settings.getlist("ALLOWED_MIMETYPES")
+        default_mimetype = crawler.settings.get("DEFAULT_MIMETYPE")
+        if not allowed_mimetypes:
+            raise ValueError("ALLOWED_MIMETYPES must be set.")
+        elif default_mimetype is None:
+            raise ValueError("DEFAULT_MIMETYPE must be set.")
+
+        o = cls(
+            allowed_mimetypes,
+            default_mimetype,
+            crawler.settings.getdict("MIMETYPE_MAX_SIZES"),
+            crawler.stats,
+        )
+        crawler.signals.connect(o.headers_received, signals.headers_received)
+        crawler.signals.connect(o.bytes_received, signals.bytes_received)
+        return o
+
+    def __init__(
+        self,
+        allowed_mimetypes: List[str],
+        default_mimetype: str,
+        max_sizes: Dict[str, int],
+        stats: StatsCollector,
+    ) -> None:
+        self.allowed_mimetypes = frozenset(allowed_mimetypes)
+        self.default_mimetype = default_mimetype
+        self.max_sizes = {mimetype: int(size) for mimetype, size in max_sizes.items()}
+        self.stats = stats
+
+    @staticmethod
+    def _expected_size(headers: Headers, body_length) -> int:
+        if isinstance(body_length, int) and body_length >= 0:
+            return body_length
+        try:
+            return int(headers.get(b"Content-Length"))
+        except (TypeError, ValueError):
+            return -1
+
+    def _stop(self, spider: Spider, key: str, saved: int, fail: bool):
+        self.stats.inc_value(f"content_type_filter/{key}", spider=spider)
+        if saved > 0:
+            self.stats.inc_value(
+                "content_type_filter/bytes_saved", saved, spider=spider
+            )
+        raise StopDownload(fail=fail)
+
+    def headers_received(
+        self, headers: Headers, body_length, request: Request, spider: Spider
+    ):
+        request.meta.pop(self._meta_key, None)
+        # robots.txt is handled by `TimedRobotsTxtMiddleware`, whatever its content type
+        if request.meta.get("dont_obey_robotstxt"):
+            return
+        content_type = headers.get(b"Content-Type")
+        mimetype = (
+            content_type.split(b";", 1)[0].strip().lower().decode("latin-1")
+            if content_type
+            else self.default_mimetype
+        )
+        expected_size = self._expected_size(headers, body_length)
+        if mimetype not in self.allowed_mimetypes:
+            spider.log(f"Aborting {request.url}, {mimetype} isn't an allowed mimetype.")
+            self._stop(spider, "aborted", expected_size, fail=True)
+
+        max_size = self.max_sizes.get(mimetype)
+        if max_size is None:
+            return
+        if mimetype not in self.TRUNCATED_MIMETYPES and expected_size > max_size:
+            spider.log(
+                f"Aborting {request.url}, {expected_size} bytes is too large for {mimetype}."
+            )
+            self._stop(spider, "aborted", expected_size, fail=True)
+        # [max size, bytes received so far, expected size, truncate instead of failing]
+        request.meta[self._meta_key] = [
+            max_size,
+            0,
+            expected_size,
+            mimetype in self.TRUNCATED_MIMETYPES,
+        ]
+
+    def bytes_received(self, data: bytes, request: Request, spider: Spider):
+        state = request.meta.get(self._meta_key)
+        if state is None:
+            return
+        state[1] += len(data)
+        max_size, received, expected_size, truncate = state
+        if received > max_size:
+            del request.meta[self._meta_key]
+            self._stop(
+                spider,
+                "truncated" if truncate else "aborted",
+                expected_size - received,
+                fail=not truncate,
+            )
+
+
 class CssFilter:
     # allow_root in CSS_FILTERS exists so I can index libreddit/libred (alt reddit frontend) sites' home page without indexing all of reddit.
     """
@@ -94,16 +222,19 @@ class CssFilter:
                     "Selectors must be tuples containing a string and boolean value."
                 )
         self.selectors = selectors
+        self.union = SelectorUnion([selector for selector, _ in selectors])
 
     def process_response(self, request: Request, response: Response, spider: Spider):
+        if not isinstance(response, TextResponse):
+            return response
+        matched = self.union.first_match(ParsedDocument.from_response(response))
+        if matched is None:
+            return response
         split_url = urlsplit(response.url)
-        for selector, allow_root in self.selectors:
-            if response.css(selector):
-                if allow_root:
-                    return request.replace(url=split_url._replace(path="").geturl())
-                if (not allow_root) or (split_url.path not in ("", "/")):
-                    raise IgnoreRequest(response.url)
-        return response
+        allow_root = self.selectors[matched][1]
+        if allow_root:
+            return request.replace(url=split_url._replace(path="").geturl())
+        raise IgnoreRequest(response.url)
 
 
 class URLFilter:
@@ -114,54 +245,47 @@ class URLFilter:
     The url scheme should not be included in the patterns, it is assumed to be http(s).
     At least one of the lists should be defined.
     If both `URL_WHITELIST` and `URL_BLACKLIST` are set, `URL_WHITELIST` is used.
+
+    The matching is done by the crawler's shared `URLAdmission`.
+    Requests that `URLValidator` already admitted aren't checked again.
     """
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
         whitelist = crawler.settings.getlist("URL_WHITELIST")
         blacklist = crawler.settings.getlist("URL_BLACKLIST")
-        if (whitelist, blacklist) == (None, None):
-            raise ValueError("Either ALLOWED_TLDS or DISALLOWED_TLDS must be set.")
+        if not (whitelist or blacklist):
+            raise ValueError("Either URL_WHITELIST or URL_BLACKLIST must be set.")
 
-        o = cls(whitelist, blacklist)
+        o = cls(whitelist, blacklist, admission=URLAdmission.from_crawler(crawler))
         crawler.signals.connect(o.should_crawl, URL_FILTER_CHECK)
 
         return o
 
-    def __init__(self, whitelist: List[str], blacklist: List[str]) -> None:
-        self.whitelist = (
-            re.compile(r"https?://(" + r"|".join(whitelist) + r")")
-            if whitelist
-            else None
-        )
-        self.blacklist = (
-            re.compile(r"https?://(" + r"|".join(blacklist) + r")")
-            if blacklist
-            else None
+    def __init__(
+        self,
+        whitelist: List[str],
+        blacklist: List[str],
+        admission: Optional[URLAdmission] = None,
+    ) -> None:
+        self.admission = admission or URLAdmission(
+            whitelist=whitelist, blacklist=blacklist
         )
 
     def process_request(self, request: Request, spider: Spider):
         url = request.url
-        spider.log(f"trying to filter request {url} by blacklist ...")
-        if self.whitelist and re.match(self.whitelist, url):
-            return None
-        elif self.blacklist and not re.match(self.blacklist, url):
+        if is_admitted(request) or self.should_crawl(url):
             return None
-        raise IgnoreRequest(f"{url} isn't allowed.")
+        raise IgnoreRequest(f"{url} {NOT_ALLOWED}")
 
     def process_response(self, request: Request, response: Response, spider: Spider):
         url = response.url
-        spider.log(f"trying to filter response {url} by blacklist ...")
         if self.should_crawl(url):
             return response
-        raise IgnoreRequest(f"{url} isn't allowed.")
+        raise IgnoreRequest(f"{url} {NOT_ALLOWED}")
 
     def should_crawl(self, url) -> bool:
-        if self.whitelist and re.match(self.whitelist, url):
-            return True
-        elif self.blacklist and not re.match(self.blacklist, url):
-            return True
-        return False
+        return self.admission.url_allowed(url)
 
 
 class TLDFilter:
@@ -171,53 +295,43 @@ class TLDFilter:
     If `ALLOWED_TLDS` is set, all TLDs are assumed to be invalid by default.
     If `DISALLOWED_TLDS` is set, all TLDs are assumed to be valid by default.
     If both `ALLOWED_TLDS` and `DISALLOWED_TLDS` are set, `ALLOWED_TLDS` is used.
+
+    The TLD lookup is done by the crawler's shared `URLAdmission`.
+    Requests that `URLValidator` already admitted aren't checked again.
     """
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
-        allowed_tlds = crawler.settings.getlist("ALLOWED_TLDS", None)
-        disallowed_tlds = crawler.settings.getlist("DISALLOWED_TLDS", None)
-        if (allowed_tlds, disallowed_tlds) == (None, None):
+        allowed_tlds = crawler.settings.getlist("ALLOWED_TLDS")
+        disallowed_tlds = crawler.settings.getlist("DISALLOWED_TLDS")
+        if not (allowed_tlds or disallowed_tlds):
             raise ValueError("Either ALLOWED_TLDS or DISALLOWED_TLDS must be set.")
-        elif allowed_tlds is not None:
-            allowed_tlds = tuple(allowed_tlds)
-            disallowed_tlds = tuple(disallowed_tlds or [])
-        elif disallowed_tlds is not None:
-            allowed_tlds = tuple(allowed_tlds or [])
-            disallowed_tlds = tuple(disallowed_tlds)
-
-        o = cls(allowed_tlds, disallowed_tlds)
+        elif allowed_tlds:
+            disallowed_tlds = []
+
+        o = cls(
+            tuple(allowed_tlds),
+            tuple(disallowed_tlds),
+            admission=URLAdmission.from_crawler(crawler),
+        )
         crawler.signals.connect(o.should_crawl, TLD_FILTER_CHECK)
 
         return o
 
-    def __init__(self, allowed_tlds: Tuple[str], disallowed_tlds: Tuple[str]):
+    def __init__(
+        self,
+        allowed_tlds: Tuple[str],
+        disallowed_tlds: Tuple[str],
+        admission: Optional[URLAdmission] = None,
+    ):
         self.allowed_tlds = allowed_tlds
         self.disallowed_tlds = disallowed_tlds
-        self.tld_pattern: re.Pattern
-        "Pattern to match netloc against to see if a url has a valid tld"
-        if self.allowed_tlds and self.disallowed_tlds:
-            raise ValueError(
-                "Do not define allowed_urls AND disallowed_urls. Define one or the other."
-            )
-        elif self.allowed_tlds:
-            self.tld_pattern = re.compile(
-                r".*\.(" + r"|".join(self.allowed_tlds) + r")$"
-            )
-        else:
-            self.tld_pattern = re.compile(
-                r".*\.(?!" + r"|".join(self.disallowed_tlds) + r")$"
-            )
+        self.admission = admission or URLAdmission(allowed_tlds, disallowed_tlds)
 
     def process_request(self, request: Request, spider: Spider):
-        if self.should_crawl(request.url):
+        if is_admitted(request) or self.should_crawl(request.url):
             return None
-        raise IgnoreRequest(f"{request.url} doesn't have a valid TLD.")
+        raise IgnoreRequest(f"{request.url} {INVALID_TLD}")
 
     def should_crawl(self, url: str) -> bool:
-        # we check for http/https on the off chance that we find ftp urls (etc.)
-        # it's unlikely but better safe than sorry?
-        if not url.lower().startswith("http"):
-            return False
-        parsed_url = urlsplit(url)
-        return re.match(self.tld_pattern, parsed_url.netloc)
+        return self.admission.tld_allowed(url)
@@ -1,19 +1,35 @@
 import datetime
-from typing import Union
+from typing import Dict, Optional, Union
 from expiringdict import ExpiringDict
 
 
 from collections import OrderedDict, defaultdict
-from time import time
+from heapq import nlargest
+from time import monotonic, time
+from weakref import WeakKeyDictionary
 
-from rfc3986 import is_valid_uri
 from scrapy import Request, Spider
 from scrapy.crawler import Crawler, signals
-from scrapy.downloadermiddlewares.robotstxt import urlparse_cached
-from scrapy.exceptions import IgnoreRequest
+from scrapy.core.downloader import Downloader, Slot
+from scrapy.downloadermiddlewares.robotstxt import RobotsTxtMiddleware, urlparse_cached
+from scrapy.downloadermiddlewares.stats import get_header_size, get_status_size
+from scrapy.exceptions import IgnoreRequest, NotConfigured, StopDownload
 from scrapy.http import Response
+from scrapy.statscollectors import StatsCollector
+from scrapy.utils.request import request_httprepr
 from scrapy.utils.url import canonicalize_url
 from twisted.internet import reactor
+from twisted.internet.defer import TimeoutError as DeferTimeoutError
+from twisted.internet.error import TCPTimedOutError, TimeoutError
+from twisted.internet.task import deferLater
+
+from crawler.metrics import Histogram
+from crawler.middleware.admission import (
+    ADMITTED_META_KEY,
+    INVALID,
+    URLAdmission,
+    is_admitted,
+)
 
 
 class SemiPermanentDict(OrderedDict):
@@ -60,14 +76,66 @@ class SemiPermanentDict(OrderedDict):
                     break
 
 
+class TokenBucket:
+    """
+    A token bucket, where each token is a byte.
+
+    Tokens are added continuously at `rate` bytes/sec, up to `capacity`.
+    Taking more tokens than are available is allowed, the bucket just goes into debt.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def refill(self) -> float:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, amount: float) -> float:
+        """Takes `amount` tokens, returning how many seconds it will take to pay off any debt."""
+        self.refill()
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def give(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
 class BandwidthLimit:
     """
-    Keeps track of bandwdith using statscollector.
+    Spreads the bandwidth budget evenly over the interval, using token buckets.
+
+    Every request reserves the average transfer size from the global bucket (and its host's bucket, if enabled).
+    Once the response arrives, the reservation is swapped for the real request + response size.
+    If a bucket is in debt, the request waits until the debt is paid off.
+    As waiting requests count against `CONCURRENT_REQUESTS`, the crawl slows down smoothly rather than stopping.
+
+    Settings:
+        BANDWIDTH_LIMIT: bytes allowed per interval.
+        BANDWIDTH_INTERVAL_SECONDS: the length of the interval.
+        BANDWIDTH_BURST_SECONDS: how many seconds of budget can be saved up for bursts (default: 1 hour).
+        BANDWIDTH_HOST_LIMIT: bytes allowed per host per interval (default: 0, no per-host limit).
+
+    A host's bucket is dropped once it's full again (a new bucket would be the same), so only recently used hosts are kept.
 
     Works correctly at position 849.
     """
 
-    def __init__(self, limit: int, interval: Union[int, datetime.timedelta]) -> None:
+    _meta_key = "bandwidth_reserved"
+
+    def __init__(
+        self,
+        limit: int,
+        interval: Union[int, datetime.timedelta],
+        burst_seconds: int = 3600,
+        host_limit: int = 0,
+        stats: Optional[StatsCollector] = None,
+    ) -> None:
         self.limit = limit
         if isinstance(interval, int):
             self.interval = datetime.timedelta(seconds=interval)
@@ -77,9 +145,18 @@ class BandwidthLimit:
             raise TypeError(f"interval ({interval}) should be datetime.delta or int.")
         self._inbound = 0
         self._outbound = 0
-        self.previous_interval: datetime.datetime = None
-        self.next_interval: datetime.datetime = None
-        self.paused = False
+        self.stats = stats
+
+        seconds = self.interval.total_seconds()
+        self.rate = limit / seconds
+        self.bucket = TokenBucket(self.rate, self.rate * burst_seconds)
+        self.host_limit = host_limit
+        self.host_rate = host_limit / seconds
+        self.host_burst_seconds = burst_seconds
+        # least recently used first
+        self.host_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # estimate of a request + response's size, used for reservations
+        self.average_size = 50_000.0
 
     @property
     def bandwidth_total(self) -> int:
@@ -93,40 +170,326 @@ class BandwidthLimit:
             raise ValueError(f"BANDWIDTH_LIMIT must be set.")
         elif interval == 0:
             raise ValueError(f"BANDWIDTH_INTERVAL_SECONDS must be set.")
-        return cls(limit, interval)
+        return cls(
+            limit,
+            interval,
+            burst_seconds=crawler.settings.getint("BANDWIDTH_BURST_SECONDS", 3600),
+            host_limit=crawler.settings.getint("BANDWIDTH_HOST_LIMIT", 0),
+            stats=crawler.stats,
+        )
 
-    def process_response(self, request: Request, response: Response, spider: Spider):
-        stats = spider.crawler.stats
-        self._inbound += stats.get_value("downloader/response_bytes")
-        self._outbound += stats.get_value("downloader/request_bytes")
-        if self.paused:
-            pass
-        elif self.previous_interval is None:
-            self.previous_interval = stats.get_value("start_time", None)
-            self.next_interval = self.previous_interval + self.interval
-        elif datetime.datetime.now(datetime.timezone.utc) > self.next_interval:
-            self.previous_interval = self.next_interval
-            self.next_interval += self.interval
-            self._inbound = 0
-            self._outbound = 0
+    def _evict_idle_buckets(self):
+        # the least recently used buckets have had the longest to refill, so stop at the first one that isn't full
+        while self.host_buckets:
+            bucket = next(iter(self.host_buckets.values()))
+            if bucket.refill() < bucket.capacity:
+                break
+            self.host_buckets.popitem(last=False)
+
+    def _host_bucket(self, request: Request) -> Optional[TokenBucket]:
+        if not self.host_limit:
+            return None
+        self._evict_idle_buckets()
+        netloc = urlparse_cached(request).netloc
+        bucket = self.host_buckets.get(netloc)
+        if bucket is None:
+            bucket = TokenBucket(
+                self.host_rate, self.host_rate * self.host_burst_seconds
+            )
+            self.host_buckets[netloc] = bucket
         else:
-            if self.bandwidth_total > self.limit:
-                now = datetime.datetime.now(datetime.timezone.utc)
-                seconds_until_next_interval = int(
-                    (self.next_interval - now).total_seconds()
-                )
-                self.paused = True
-                spider.crawler.engine.pause()
-                reactor.callLater(
-                    seconds_until_next_interval, spider.crawler.engine.unpause
+            self.host_buckets.move_to_end(netloc)
+        return bucket
+
+    def _settle(self, request: Request, used: int):
+        reserved = request.meta.pop(self._meta_key, None)
+        if reserved is None:
+            return
+        difference = reserved - used
+        self.bucket.give(difference)
+        if (host_bucket := self._host_bucket(request)) is not None:
+            host_bucket.give(difference)
+
+    def process_request(self, request: Request, spider: Spider):
+        if self._meta_key in request.meta:
+            return None
+        reserved = self.average_size
+        request.meta[self._meta_key] = reserved
+        delay = self.bucket.take(reserved)
+        if (host_bucket := self._host_bucket(request)) is not None:
+            delay = max(delay, host_bucket.take(reserved))
+        if self.stats is not None:
+            self.stats.set_value(
+                "bandwidth/tokens", int(self.bucket.tokens), spider=spider
+            )
+        if delay > 0:
+            if self.stats is not None:
+                self.stats.inc_value("bandwidth/delayed_requests", spider=spider)
+                self.stats.inc_value("bandwidth/delay_seconds", delay, spider=spider)
+            return deferLater(reactor, delay, lambda: None)
+        return None
+
+    def process_response(self, request: Request, response: Response, spider: Spider):
+        inbound = (
+            len(response.body)
+            + get_header_size(response.headers)
+            + get_status_size(response.status)
+            + 4
+        )
+        outbound = len(request_httprepr(request))
+        self._inbound += inbound
+        self._outbound += outbound
+        used = inbound + outbound
+        self.average_size = 0.95 * self.average_size + 0.05 * used
+        self._settle(request, used)
+        return response
+
+    def process_exception(self, request: Request, exception, spider: Spider):
+        # the request never went through, so nothing (of note) was used
+        self._settle(request, 0)
+
+
+class HostState:
+    """Latency and failure rates (as EWMAs) for one downloader slot, and the parameters chosen from them."""
+
+    def __init__(self, key: str, concurrency: int, delay: float) -> None:
+        # the slot's key (its host, or IP)
+        self.key = key
+        self.concurrency = concurrency
+        self.delay = delay
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.timeout_rate = 0.0
+        self.backoff = 1.0
+        self.successes = 0
+        self.crawl_delay = 0.0
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        return {
+            "delay": self.delay,
+            "concurrency": self.concurrency,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "timeout_rate": self.timeout_rate,
+            "backoff": self.backoff,
+        }
+
+
+class AdaptiveThrottle:
+    """
+    Adjusts each downloader slot's (i.e. host/IP's) delay and concurrency, based on how it's coping.
+
+    Each slot's latency, error rate (5xx/429 responses and connection errors) and timeout rate are tracked as EWMAs.
+        - After a full round of fast, successful responses, concurrency goes up by 1.
+        - Every error or timeout halves the concurrency and doubles the backoff.
+        - The delay is `latency / concurrency`, multiplied by the backoff.
+    Everything is kept within the configured bounds, and the delay never goes below the robots.txt crawl-delay.
+
+    Each slot's state is kept for as long as scrapy keeps the slot.
+    One stat per host would flood the stats (and the metrics exported from them) on a broad crawl, so the stats (under `adaptive_throttle/`) hold
+    totals, a histogram of the chosen delays (`adaptive_throttle/delay`), and the parameters of the `ADAPTIVE_STATS_HOSTS` slowest hosts
+    (`adaptive_throttle/slowest_hosts`, by delay), which are updated every `ADAPTIVE_STATS_INTERVAL` seconds and when the spider closes.
+
+    Settings:
+        ADAPTIVE_THROTTLE_ENABLED: set to False to disable the middleware.
+        ADAPTIVE_MIN_DELAY, ADAPTIVE_MAX_DELAY: delay bounds (seconds).
+        ADAPTIVE_MIN_CONCURRENCY, ADAPTIVE_MAX_CONCURRENCY: concurrency bounds.
+        ADAPTIVE_START_CONCURRENCY: the concurrency slots start at.
+        ADAPTIVE_TARGET_LATENCY: concurrency only goes up while the latency is below this (seconds).
+        ADAPTIVE_EWMA_ALPHA: the weight given to the newest sample.
+        ADAPTIVE_STATS_HOSTS: how many of the slowest hosts' parameters are kept in the stats.
+        ADAPTIVE_STATS_INTERVAL: how often they're updated (seconds).
+    """
+
+    TIMEOUT_EXCEPTIONS = (TimeoutError, TCPTimedOutError, DeferTimeoutError)
+    IGNORED_EXCEPTIONS = (IgnoreRequest, StopDownload)
+    MAX_BACKOFF = 32.0
+
+    def __init__(
+        self,
+        crawler: Crawler,
+        min_delay: float,
+        max_delay: float,
+        min_concurrency: int,
+        max_concurrency: int,
+        start_concurrency: int,
+        target_latency: float,
+        alpha: float,
+        stats_hosts: int = 10,
+        stats_interval: float = 60,
+    ) -> None:
+        if not (0 < alpha <= 1):
+            raise ValueError(f"ADAPTIVE_EWMA_ALPHA ({alpha}) should be in (0, 1].")
+        if not (1 <= min_concurrency <= max_concurrency):
+            raise ValueError(
+                "ADAPTIVE_MIN_CONCURRENCY should be at least 1 and no more than ADAPTIVE_MAX_CONCURRENCY."
+            )
+        self.crawler = crawler
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.start_concurrency = min(
+            max(start_concurrency, min_concurrency), max_concurrency
+        )
+        self.target_latency = target_latency
+        self.alpha = alpha
+        # by downloader slot, so a slot's state goes when scrapy drops the idle slot
+        self.hosts: "WeakKeyDictionary[Slot, HostState]" = WeakKeyDictionary()
+        self.stats_hosts = stats_hosts
+        self.stats_interval = stats_interval
+        self._published = monotonic()
+        # a delay isn't a stage's timing, so it's kept apart from the `Metrics` histograms
+        self.delays = Histogram()
+        crawler.stats.set_value("adaptive_throttle/delay", self.delays)
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED", True):
+            raise NotConfigured
+        max_concurrency = settings.getint(
+            "ADAPTIVE_MAX_CONCURRENCY",
+            settings.getint("CONCURRENT_REQUESTS_PER_IP")
+            or settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN"),
+        )
+        o = cls(
+            crawler,
+            min_delay=settings.getfloat("ADAPTIVE_MIN_DELAY", 0.5),
+            max_delay=settings.getfloat("ADAPTIVE_MAX_DELAY", 60),
+            min_concurrency=settings.getint("ADAPTIVE_MIN_CONCURRENCY", 1),
+            max_concurrency=max_concurrency,
+            start_concurrency=settings.getint("ADAPTIVE_START_CONCURRENCY", 2),
+            target_latency=settings.getfloat("ADAPTIVE_TARGET_LATENCY", 2),
+            alpha=settings.getfloat("ADAPTIVE_EWMA_ALPHA", 0.3),
+            stats_hosts=settings.getint("ADAPTIVE_STATS_HOSTS", 10),
+            stats_interval=settings.getfloat("ADAPTIVE_STATS_INTERVAL", 60),
+        )
+        crawler.signals.connect(o.spider_closed, signals.spider_closed)
+        return o
+
+    def _ewma(self, old: Optional[float], sample: float) -> float:
+        if old is None:
+            return sample
+        return (1 - self.alpha) * old + self.alpha * sample
+
+    def _robots_crawl_delay(self, request: Request) -> Optional[float]:
+        for mw in self.crawler.engine.downloader.middleware.middlewares:
+            if isinstance(mw, RobotsTxtMiddleware):
+                parser = mw._parsers.get(urlparse_cached(request).netloc)
+                crawl_delay = getattr(getattr(parser, "rp", None), "crawl_delay", None)
+                if crawl_delay is None:
+                    return None
+                user_agent = request.headers.get(
+                    "User-Agent", self.crawler.settings.get("USER_AGENT")
                 )
+                if isinstance(user_agent, bytes):
+                    user_agent = user_agent.decode("utf-8", "replace")
+                return crawl_delay(user_agent)
+        return None
+
+    def _update(
+        self,
+        request: Request,
+        spider: Spider,
+        latency: Optional[float] = None,
+        error: bool = False,
+        timeout: bool = False,
+    ):
+        key = request.meta.get(Downloader.DOWNLOAD_SLOT)
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        state = self.hosts.get(slot)
+        if state is None:
+            state = self.hosts[slot] = HostState(key, self.start_concurrency, slot.delay)
+
+        if latency is not None:
+            state.latency = self._ewma(state.latency, latency)
+        state.error_rate = self._ewma(state.error_rate, float(error))
+        state.timeout_rate = self._ewma(state.timeout_rate, float(timeout))
+        if (crawl_delay := self._robots_crawl_delay(request)) is not None:
+            state.crawl_delay = max(state.crawl_delay, crawl_delay)
+
+        if error or timeout:
+            state.successes = 0
+            state.concurrency = max(self.min_concurrency, state.concurrency // 2)
+            state.backoff = min(self.MAX_BACKOFF, state.backoff * 2)
+            self.crawler.stats.inc_value("adaptive_throttle/backoffs", spider=spider)
+        else:
+            state.successes += 1
+            state.backoff = max(1.0, state.backoff * 0.9)
+            if (
+                state.successes >= state.concurrency
+                and (state.latency or 0) <= self.target_latency
+            ):
+                state.successes = 0
+                if state.concurrency < self.max_concurrency:
+                    state.concurrency += 1
+                    self.crawler.stats.inc_value(
+                        "adaptive_throttle/concurrency_increases", spider=spider
+                    )
+
+        delay = (state.latency or 0) / state.concurrency * state.backoff
+        state.delay = max(
+            min(max(delay, self.min_delay), self.max_delay), state.crawl_delay
+        )
+        slot.concurrency = state.concurrency
+        slot.delay = state.delay
+
+        self.crawler.stats.set_value(
+            "adaptive_throttle/hosts", len(self.hosts), spider=spider
+        )
+        self.delays.observe(state.delay)
+        if monotonic() - self._published >= self.stats_interval:
+            self.publish_slowest_hosts(spider)
+
+    def publish_slowest_hosts(self, spider: Spider):
+        """Puts the parameters of the `stats_hosts` slowest hosts (by delay) in the stats."""
+        self._published = monotonic()
+        slowest = nlargest(
+            self.stats_hosts, list(self.hosts.values()), key=lambda state: state.delay
+        )
+        self.crawler.stats.set_value(
+            "adaptive_throttle/slowest_hosts",
+            {state.key: state.to_dict() for state in slowest},
+            spider=spider,
+        )
+
+    def spider_closed(self, spider: Spider):
+        self.publish_slowest_hosts(spider)
+
+    def process_response(self, request: Request, response: Response, spider: Spider):
+        self._update(
+            request,
+            spider,
+            latency=request.meta.get("download_latency"),
+            error=response.status >= 500 or response.status == 429,
+        )
         return response
 
+    def process_exception(self, request: Request, exception, spider: Spider):
+        if isinstance(exception, self.IGNORED_EXCEPTIONS):
+            return None
+        timeout = isinstance(exception, self.TIMEOUT_EXCEPTIONS)
+        # a timed out request took (at least) as long as the timeout
+        latency = request.meta.get("download_timeout") if timeout else None
+        self._update(
+            request, spider, latency=latency, error=not timeout, timeout=timeout
+        )
+        return None
+
 
 class URLValidator:
     """This middleware validates and normalises request and response urls.
 
-    (Uses scrapy.utils.url.canonincalize_url)"""
+    (Uses scrapy.utils.url.canonincalize_url)
+
+    Requests are run through every check of the crawler's shared `URLAdmission`,
+    so `URLFilter` and `TLDFilter` don't have to parse the url again."""
+
+    def __init__(self, admission: URLAdmission) -> None:
+        self.admission = admission
 
     @staticmethod
     def format_url(url: str) -> str:
@@ -134,23 +497,28 @@ class URLValidator:
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
-        return cls()
+        return cls(URLAdmission.from_crawler(crawler))
 
     def process_request(self, request: Request, spider: Spider):
-        if is_valid_uri(request.url):
-            normalised_url = self.format_url(request.url)
-            if request.url == normalised_url:
-                return None
-            request = request.replace(url=normalised_url)
-            request.meta["normalised"] = True
-            return request
-        raise IgnoreRequest(f"{request.url} is invalid")
+        if is_admitted(request):
+            return None
+        normalised_url, reason = self.admission.check(request.url)
+        if normalised_url is None:
+            spider.crawler.stats.inc_value("url_admission/rejected", spider=spider)
+            raise IgnoreRequest(f"{request.url} {reason}")
+        if request.url == normalised_url:
+            request.meta[ADMITTED_META_KEY] = normalised_url
+            return None
+        request = request.replace(url=normalised_url)
+        request.meta["normalised"] = True
+        request.meta[ADMITTED_META_KEY] = normalised_url
+        return request
 
     def process_response(self, request: Request, response: Response, spider: Spider):
-        if is_valid_uri(response.url):
-            response = response.replace(url=self.format_url(response.url))
+        if (normalised_url := self.admission.canonicalize(response.url)) is not None:
+            response = response.replace(url=normalised_url)
             return response
-        raise IgnoreRequest(f"{response.url} is invalid")
+        raise IgnoreRequest(f"{response.url} {INVALID}")
 
 
 class QueueTotal:
@@ -194,4 +562,4 @@ class QueueTotal:
         self.totals[netloc] -= 1
         spider.log(
             f"there are currently {self.totals[netloc]} requests running for {netloc}"
-        )
\ No newline at end of file
+        )
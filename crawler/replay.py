@@ -0,0 +1,180 @@
+"""
+Replays archived responses (see `crawler.warc`) through extraction and indexing, without touching the network,
+e.g. to apply an improvement to text extraction to every page that's been crawled.
+
+Pages go through the same steps as when they're crawled: `CssFilter`'s selectors, then `page_record` (as `SearchDB` does),
+then they're upserted into the index. Responses are read in the order they were archived (oldest file first),
+so each page ends up as its latest archived version, dated when it was fetched.
+Extraction runs in a pool of `procs` processes, and the index is written by a `MyMpWriter`, so analysis is spread over `procs` processes too.
+
+Run it while the crawler is stopped (it holds the index's lock), from the project root:
+    python -m crawler.replay [WARC files or directories] [--index PATH] [--procs N]
+"""
+
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from time import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from scrapy import Request
+from scrapy.http import Headers, TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import get_project_settings
+
+from crawler.database import page_record
+from crawler.document import ParsedDocument, SelectorUnion
+from crawler.warc import ArchivedResponse, iter_responses, warc_files
+from crawler.whoosh_backend import get_index
+
+# set in each extraction process by `_init_worker`
+_css_filters: Optional[SelectorUnion] = None
+
+
+def _init_worker(selectors: List[str]):
+    global _css_filters
+    _css_filters = SelectorUnion(selectors) if selectors else None
+
+
+def extract(archived: ArchivedResponse) -> Optional[Dict[str, Any]]:
+    """Returns the page's record (for `MyIndexWriter.update_documents`), or None if it isn't a page, or `CssFilter` would drop it."""
+    headers = Headers()
+    for name, value in archived.headers:
+        headers.appendlist(name, value)
+    respcls = responsetypes.from_args(
+        headers=headers, url=archived.url, body=archived.body
+    )
+    if not issubclass(respcls, TextResponse):
+        return None
+    response = respcls(
+        archived.url,
+        status=archived.status,
+        headers=headers,
+        body=archived.body,
+        request=Request(archived.url, meta={"depth": archived.depth}),
+    )
+    if (
+        _css_filters is not None
+        and _css_filters.first_match(ParsedDocument.from_response(response)) is not None
+    ):
+        return None
+    fields, fields_if_exists, comparison_functions = page_record(
+        response, archived.date
+    )
+    return dict(
+        fields,
+        fields_if_exists=fields_if_exists,
+        comparison_functions=comparison_functions,
+    )
+
+
+def _extract_many(archived: List[ArchivedResponse]) -> List[Optional[Dict[str, Any]]]:
+    return [extract(response) for response in archived]
+
+
+def replay(
+    paths: Iterable[str],
+    storage_path: Optional[str] = None,
+    procs: Optional[int] = None,
+    batch_size: int = 1000,
+    commit_every: int = 50_000,
+    timeout: float = 60,
+) -> Tuple[int, int]:
+    """Replays the responses in the WARC files (or directories of them) into the index.
+
+    Responses are read in batches of `batch_size` per process, extracted in parallel, and upserted together.
+    The index is committed every `commit_every` pages, and before a page that's already been replayed since the last commit
+    (a writer can't replace its own uncommitted documents).
+
+    Returns:
+        Tuple[int, int]: The number of responses read, and the number of pages indexed.
+    """
+    procs = procs or os.cpu_count() or 1
+    settings = get_project_settings()
+    selectors = [selector for selector, _ in settings.getlist("CSS_FILTERS")]
+    ix = get_index(storage_path)
+
+    def new_writer():
+        return (
+            ix.writer(procs=procs, timeout=timeout, multisegment=True)
+            if procs > 1
+            else ix.writer(timeout=timeout)
+        )
+
+    def responses():
+        for path in warc_files(paths):
+            yield from iter_responses(path)
+
+    read = indexed = 0
+    uncommitted = set()
+    writer = new_writer()
+    try:
+        with ProcessPoolExecutor(
+            procs, initializer=_init_worker, initargs=(selectors,)
+        ) as executor:
+            remaining = responses()
+            while archived := list(islice(remaining, batch_size * procs)):
+                read += len(archived)
+                chunks = [
+                    archived[i : i + batch_size]
+                    for i in range(0, len(archived), batch_size)
+                ]
+                records = [
+                    record
+                    for records in executor.map(_extract_many, chunks)
+                    for record in records
+                    if record is not None
+                ]
+                urls = {record["url"] for record in records}
+                if len(uncommitted) >= commit_every or not uncommitted.isdisjoint(urls):
+                    writer.commit()
+                    writer = new_writer()
+                    uncommitted = set()
+                writer.update_documents(records)
+                uncommitted |= urls
+                indexed += len(records)
+    except BaseException:
+        writer.cancel()
+        raise
+    writer.commit()
+    ix.close()
+    return read, indexed
+
+
+if __name__ == "__main__":
+    settings = get_project_settings()
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="WARC files, or directories of them (defaults to the `WARC_DIR` setting).",
+    )
+    parser.add_argument(
+        "--index",
+        default=None,
+        help="The index's path (defaults to the `INDEX_PATH` setting).",
+    )
+    parser.add_argument(
+        "--procs",
+        type=int,
+        default=None,
+        help="The number of processes extracting (and analyzing) pages (defaults to the number of cores).",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="How many responses each process extracts at once.",
+    )
+    args = parser.parse_args()
+    start = time()
+    read, indexed = replay(
+        args.paths or [settings.get("WARC_DIR", "warc")],
+        args.index,
+        args.procs,
+        args.batch_size,
+    )
+    print(
+        f"Replayed {read} responses ({indexed} pages indexed) in {time() - start:.1f}s."
+    )
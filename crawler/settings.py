@@ -30,6 +30,20 @@ DOWNLOAD_DELAY = 3
 # CONCURRENT_REQUESTS_PER_DOMAIN = 16
 CONCURRENT_REQUESTS_PER_IP = 16
 
+# Per host delay and concurrency are adjusted by `AdaptiveThrottle`, within these bounds.
+# DOWNLOAD_DELAY is used until a host has responded, robots.txt crawl-delays are always respected.
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_MIN_DELAY = 0.5
+ADAPTIVE_MAX_DELAY = 60
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = CONCURRENT_REQUESTS_PER_IP
+ADAPTIVE_START_CONCURRENCY = 2
+ADAPTIVE_TARGET_LATENCY = 2
+ADAPTIVE_EWMA_ALPHA = 0.3
+# the parameters of this many of the slowest hosts are in the stats (`adaptive_throttle/slowest_hosts`), updated this often (seconds)
+ADAPTIVE_STATS_HOSTS = 10
+ADAPTIVE_STATS_INTERVAL = 60
+
 # Disable cookies (enabled by default)
 COOKIES_ENABLED = False
 
@@ -46,6 +60,7 @@ COOKIES_ENABLED = False
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
    "crawler.database.SearchDB": 99,
+   "crawler.frontier.FrontierMiddleware": 98,
    "scrapy.spidermiddlewares.depth.DepthMiddleware": None,
    "crawler.middleware.defaults.DomainAwareDepthMiddleware": 900,
 }
@@ -59,8 +74,12 @@ DOWNLOADER_MIDDLEWARES = {
     "crawler.middleware.filters.TLDFilter": 3,
     "crawler.middleware.filters.MimetypeFilter": 899,
     "crawler.middleware.misc.BandwidthLimit": 849,
+    # As close to the downloader as possible, to see raw latencies and errors
+    "crawler.middleware.misc.AdaptiveThrottle": 950,
     # Middleware that parses responses should be at 99 (299?) or lower (to ensure the response is fully loaded)
     "crawler.middleware.filters.CssFilter": 97,
+    # Archives responses once they're decompressed (if WARC_ENABLED)
+    "crawler.warc.WarcArchive": 580,
     
     "scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware": None,
     "crawler.middleware.defaults.TimedRobotsTxtMiddleware": 100,
@@ -69,6 +88,8 @@ DOWNLOADER_MIDDLEWARES = {
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 EXTENSIONS = {
     # "crawler.middleware.misc.QueueTotal": 98
+    "crawler.middleware.filters.ContentTypeFilter": 500,
+    "crawler.metrics.MetricsExport": 0,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -95,6 +116,9 @@ EXTENSIONS = {
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 REQUEST_FINGERPRINTER_CLASS = "crawler.middleware.defaults.RequestFingerprinter"
+DUPEFILTER_CLASS = "crawler.middleware.defaults.CompactDupeFilter"
+DUPEFILTER_CAPACITY = 10_000_000    # ~12 MB bloom filter
+DUPEFILTER_BATCH_SIZE = 10_000
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
 
@@ -102,6 +126,49 @@ DEPTH_LIMIT = 5
 
 JOBDIR = "crawl_dir"
 INDEX_PATH = "records"
+# Split new indexes into this many sub-indexes, which are searched in parallel (an existing index keeps its layout)
+INDEX_SHARDS = 1
+# Index word bigrams, so phrase searches are faster (see `PhraseSchema`), at the cost of a bigger index.
+# Changing it needs the index to be rebuilt while the crawl is stopped (`python -m crawler.whoosh_backend rebuild`)
+INDEX_PHRASE_FIELDS = False
+# Changes to the index are queued, and committed in batches by one thread (see crawler/index_writer.py)
+INDEX_WRITER_BATCH_SIZE = 100
+INDEX_WRITER_COMMIT_INTERVAL = 5
+INDEX_WRITER_MAX_QUEUE = 10_000
+# Pages are committed without merging segments, they're merged in the background once the crawl is quiet (see `MergeScheduler`)
+INDEX_MERGE_ENABLED = True
+INDEX_MERGE_FACTOR = 10
+INDEX_MERGE_MAX_DELETED_RATIO = 0.2
+INDEX_MERGE_IDLE_SECONDS = 30
+INDEX_MERGE_MAX_SEGMENTS = 50
+# How long the writer waits for the index's lock (e.g. while another process writes to it)
+INDEX_WRITE_TIMEOUT = 60
+# Pages that have been dead (4xx/5xx) for this long are deleted from the index when a crawl starts (0 to keep them forever)
+DEAD_PAGE_TTL = 60 * 60 * 24 * 28  # 4 weeks
+
+# Append every response to gzipped WARC files in WARC_DIR (rotated at WARC_MAX_SIZE bytes), so pages can be
+# reprocessed later without refetching them (`python -m crawler.replay`, see crawler/replay.py)
+WARC_ENABLED = False
+WARC_DIR = "warc"
+WARC_MAX_SIZE = 1_000_000_000
+
+FRONTIER_PATH = "frontier.db"
+FRONTIER_LEASE_SECONDS = 60 * 60 * 24       # 1 day
+FRONTIER_BATCH_SIZE = 1000
+# FRONTIER_REVISIT_SECONDS defaults to WAIT_TIME
+
+# The number of crawler processes `main.py` starts, each one crawls the netlocs that hash to it (see crawler/sharding.py)
+SHARD_COUNT = 1
+
+# Per-stage timing histograms (dns, robots, download, extract, links, analyze, commit), kept in the stats as `timing/<stage>` (see crawler/metrics.py)
+METRICS_ENABLED = False
+# Exported every METRICS_EXPORT_INTERVAL seconds, as JSON if the path ends with .json, otherwise in Prometheus' text format (None to not export them)
+METRICS_EXPORT_PATH = None
+METRICS_EXPORT_INTERVAL = 60
+# Samples every thread's stack, and writes them (in the collapsed format, for flame graphs) along with the metrics
+METRICS_PROFILE_ENABLED = False
+METRICS_PROFILE_INTERVAL = 0.01
+METRICS_PROFILE_PATH = "profile.folded"
 
 DNS_RESOLVER = "crawler.middleware.defaults.CustomDNSResolver"
 DNS_TIMEOUT = 5
@@ -158,6 +225,8 @@ CSS_FILTERS = [
 
 BANDWIDTH_LIMIT = 1000 * 1000 * 1000 * 175      # 175 GB
 BANDWIDTH_INTERVAL_SECONDS = 60 * 60 * 24 * 7   # 1 week
+BANDWIDTH_BURST_SECONDS = 60 * 60               # up to 1 hour of unused budget can be used in a burst
+BANDWIDTH_HOST_LIMIT = 0                        # per host budget each interval (0 = no limit)
 START_URL_MAX_AGE = BANDWIDTH_INTERVAL_SECONDS
 WAIT_TIME = 60 * 60 * 24 * 7 # 1 week
 
@@ -167,5 +236,11 @@ ALLOWED_MIMETYPES = [
     "text/plain"
 ]
 DEFAULT_MIMETYPE = "text/html"
+# Maximum body size per (Content-Type header) mimetype, larger html pages are truncated, anything else is dropped
+MIMETYPE_MAX_SIZES = {
+    "text/html": 1000 * 1000 * 2,   # 2 MB
+    "text/xml": 1000 * 1000 * 2,    # 2 MB
+    "text/plain": 1000 * 1000,      # 1 MB
+}
 
 QUEUETOTAL_ENABLED = True
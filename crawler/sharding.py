@@ -0,0 +1,112 @@
+"""
+Helpers for crawling with several processes ("shards") at once.
+
+Every netloc belongs to exactly one shard, picked by hashing it.
+Shards share the frontier (see `crawler.frontier.Frontier`), which routes discovered urls to their shard,
+but each shard has its own JOBDIR and index, so they never wait on each other's locks.
+At the end of each crawl, a shard merges its index into the main one (`merge_index`).
+
+Start the shards with `python main.py --shards N`.
+"""
+
+from itertools import islice
+from pathlib import Path
+from shutil import rmtree
+from typing import Any, Dict
+from urllib.parse import urlsplit
+from zlib import crc32
+
+from scrapy.settings import BaseSettings
+
+
+def host_hash(url: str) -> int:
+    """A stable (between processes and runs) hash of the url's netloc."""
+    return crc32(urlsplit(url).netloc.lower().encode())
+
+
+def shard_of(url: str, shards: int) -> int:
+    return host_hash(url) % shards
+
+
+def shard_settings(settings: BaseSettings, shard: int, shards: int) -> Dict[str, Any]:
+    """Returns the settings to override for the given shard."""
+    if not (0 <= shard < shards):
+        raise ValueError(f"Shard {shard} doesn't exist, there are {shards} shards.")
+    index_path = settings.get("INDEX_PATH")
+    overrides = {
+        "SHARD_INDEX": shard,
+        "SHARD_COUNT": shards,
+        "SHARD_MERGE_INDEX_PATH": index_path,
+        "INDEX_PATH": f"{index_path}-shard-{shard}",
+        "JOBDIR": str(Path(settings.get("JOBDIR"), f"shard-{shard}")),
+    }
+    # each shard exports its own metrics, e.g. metrics.prom -> metrics-shard-0.prom
+    for name in ("METRICS_EXPORT_PATH", "METRICS_PROFILE_PATH"):
+        if path := settings.get(name):
+            path = Path(path)
+            overrides[name] = str(
+                path.with_name(f"{path.stem}-shard-{shard}{path.suffix}")
+            )
+    return overrides
+
+
+def merge_index(
+    source_path: str, target_path: str, timeout: float = 60, attempts: int = 10
+) -> int:
+    """Merges every document in the source index into the target index, then deletes the source index.
+
+    Documents are upserted the same way `SearchDB.add_page_record` does it.
+    Shards tend to finish together, so the target index is often locked by another shard's merge.
+    Opening its writer waits up to `timeout` seconds for the lock, and is tried `attempts` times.
+    If the lock is never released, `LockError` is raised and the source index is kept, to be merged after the next crawl.
+
+    Returns:
+        int: The number of documents merged.
+    """
+    from whoosh.index import LockError
+
+    from crawler.whoosh_backend import get_index, iter_documents
+
+    if not Path(source_path).exists():
+        return 0
+    source = get_index(str(Path(source_path).absolute()))
+    target = get_index(str(Path(target_path).absolute()))
+
+    def documents():
+        for fields in iter_documents(source):
+            exists_fields = fields.copy()
+            del exists_fields["created_at"]
+            if fields["dead_since"]:
+                # same as `SearchDB.add_page_record`, dead pages keep their old content
+                for name in ["depth", "title", "content", "description"]:
+                    del exists_fields[name]
+            yield dict(
+                fields,
+                fields_if_exists=exists_fields,
+                comparison_functions={"depth": min},
+            )
+
+    for attempt in range(1, attempts + 1):
+        try:
+            writer = target.writer(timeout=timeout)
+            break
+        except LockError:
+            if attempt == attempts:
+                source.close()
+                raise
+    merged = 0
+    remaining = documents()
+    try:
+        # in batches, so the whole index isn't held in memory
+        while batch := list(islice(remaining, 1000)):
+            writer.update_documents(batch)
+            merged += len(batch)
+        writer.commit()
+    except BaseException:
+        # releases the target's lock, the source is kept to be merged again
+        writer.cancel()
+        source.close()
+        raise
+    source.close()
+    rmtree(source_path)
+    return merged
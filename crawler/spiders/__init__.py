@@ -1,10 +1,15 @@
 from typing import Any, List
-from urllib.parse import urljoin
 
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.http import TextResponse
 
 from crawler.custom_signals import GET_START_URLS, URL_EXISTS
+from crawler.document import ParsedDocument
+from crawler.frontier import Frontier, FrontierEntry
+from crawler.metrics import Metrics
+from crawler.middleware.admission import URLAdmission
 
 
 class OpenNICSpider(scrapy.Spider):
@@ -12,7 +17,46 @@ class OpenNICSpider(scrapy.Spider):
     def __init__(self, name: str | None = None, **kwargs: Any):
         super().__init__(name or "crawler", **kwargs)
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signals.spider_idle)
+        return spider
+
     def start_requests(self):
+        frontier = Frontier.from_crawler(self.crawler)
+        if not len(frontier):
+            # the first crawl has nothing in the frontier, so it's seeded from the index/grep.geek
+            frontier.add(FrontierEntry(url) for url in self.seed_urls())
+        for entry in frontier.iter_due():
+            yield self.frontier_request(entry)
+
+    def frontier_request(self, entry: FrontierEntry) -> scrapy.Request:
+        # the dupefilter keys on the lease, so urls fetched under an earlier lease aren't dropped
+        meta = {"depth": entry.depth, "frontier_lease": entry.lease}
+        if entry.referrer:
+            meta["referrer"] = entry.referrer
+        return scrapy.Request(
+            url=entry.url,
+            callback=self.parse,
+            priority=entry.priority,
+            meta=meta,
+        )
+
+    def spider_idle(self):
+        # urls can become due during the crawl (e.g. when other shards route urls to this one)
+        frontier = Frontier.from_crawler(self.crawler)
+        # other shards are checked first, so any urls they sent before going idle are seen below
+        busy_shards = frontier.busy_shards()
+        due = frontier.due()
+        for entry in due:
+            self.crawler.engine.crawl(self.frontier_request(entry))
+        if due or busy_shards:
+            frontier.heartbeat(idle=not due)
+            raise DontCloseSpider
+        frontier.leave()
+
+    def seed_urls(self) -> List[str]:
         base_urls = self.crawler.signals.send_catch_log(GET_START_URLS)
         if not base_urls:
             raise ValueError("Do you have the SQLPipeline middleware configured?")
@@ -28,16 +72,15 @@ class OpenNICSpider(scrapy.Spider):
             ]
             if not self.crawler.signals.send_catch_log(URL_EXISTS, url=url)[0][1]
         ]
-        urls = grep_geek_urls + base_urls
-        for url in urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+        return grep_geek_urls + base_urls
 
     def parse(self, response):
         if isinstance(response, TextResponse):
-            urls: List[str] = [
-                urljoin(response.url, href)
-                for href in response.css("[href]::attr(href)").getall()
-            ]
+            # links that would be filtered out anyway never become requests
+            with Metrics.from_crawler(self.crawler).time("links"):
+                urls: List[str] = URLAdmission.from_crawler(self.crawler).admit_many(
+                    ParsedDocument.from_response(response).links
+                )
             yield from response.follow_all(
                 urls, callback=self.parse, meta={"referrer": response.url}
             )
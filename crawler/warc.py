@@ -0,0 +1,267 @@
+"""
+Archiving raw responses in WARC files, so pages can be reprocessed (see `crawler.replay`) without fetching them again.
+
+Files are gzipped one record per gzip member (as `.warc.gz` files usually are), and rotated once they reach a size.
+A file is written as `<name>.warc.gz.open`, and only renamed to `<name>.warc.gz` once it's closed, so it's clear which files are complete.
+If the crawler is killed, its last file is left with the `.open` extension, but `warc_files` still returns it
+(reading one that's still being written is safe too, a partial last record is skipped, see `iter_records`).
+File names start with the time they were opened, so sorting them sorts them by time.
+"""
+
+import gzip
+import os
+from datetime import datetime, timezone
+from http import HTTPStatus
+from typing import Dict, Generator, Iterable, List, NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+from scrapy import Request, Spider, signals
+from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Response
+
+EXTENSION = ".warc.gz"
+OPEN_EXTENSION = ".open"
+# headers that describe how the body was sent, which no longer apply to the (decoded) body that's archived
+_TRANSFER_HEADERS = {b"content-encoding", b"transfer-encoding", b"content-length"}
+
+
+class WarcRecord(NamedTuple):
+    headers: Dict[str, str]
+    payload: bytes
+
+
+class ArchivedResponse(NamedTuple):
+    url: str
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+    # when it was fetched (local time, like the index's dates)
+    date: datetime
+    depth: int
+
+
+class WarcWriter:
+    """
+    Appends records to WARC files in `directory`, starting a new file once the current one is `max_size` bytes (compressed).
+
+    Each file starts with a `warcinfo` record.
+    """
+
+    def __init__(
+        self, directory: str, prefix: str = "crawl", max_size: int = 1_000_000_000
+    ) -> None:
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.files = 0
+        self._file = None
+        self._path: Optional[str] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        now = datetime.now(timezone.utc)
+        name = f"{self.prefix}-{now:%Y%m%d%H%M%S%f}-{os.getpid()}-{self.files:05d}{EXTENSION}"
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path + OPEN_EXTENSION, "wb")
+        self.files += 1
+        info = "software: search_libre\r\nformat: WARC File Format 1.0\r\n".encode()
+        self._write_record(
+            "warcinfo",
+            {"WARC-Filename": name, "Content-Type": "application/warc-fields"},
+            info,
+        )
+
+    def _write_record(
+        self, record_type: str, headers: Dict[str, str], payload: bytes
+    ) -> int:
+        lines = [
+            "WARC/1.0",
+            f"WARC-Type: {record_type}",
+            f"WARC-Record-ID: <urn:uuid:{uuid4()}>",
+            f"WARC-Date: {datetime.now(timezone.utc):%Y-%m-%dT%H:%M:%SZ}",
+        ]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Content-Length: {len(payload)}")
+        record = "\r\n".join(lines).encode() + b"\r\n\r\n" + payload + b"\r\n\r\n"
+        data = gzip.compress(record, compresslevel=6)
+        self._file.write(data)
+        return len(data)
+
+    def write(self, record_type: str, headers: Dict[str, str], payload: bytes) -> int:
+        """Appends a record (rotating the file first if it's full).
+
+        Returns:
+            int: The number of (compressed) bytes written.
+        """
+        if self._file is not None and self._file.tell() >= self.max_size:
+            self.close()
+        if self._file is None:
+            self._open()
+        return self._write_record(record_type, headers, payload)
+
+    def write_response(
+        self,
+        url: str,
+        status: int,
+        headers: Iterable[Tuple[bytes, bytes]],
+        body: bytes,
+        depth: int = 0,
+    ) -> int:
+        """Appends a `response` record, with the response as an HTTP message (and its crawl depth in a `Crawl-Depth` header)."""
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ""
+        message = [f"HTTP/1.1 {status} {reason}".encode()]
+        message += [
+            name + b": " + value
+            for name, value in headers
+            if name.lower() not in _TRANSFER_HEADERS
+        ]
+        message.append(b"Content-Length: " + str(len(body)).encode())
+        payload = b"\r\n".join(message) + b"\r\n\r\n" + body
+        return self.write(
+            "response",
+            {
+                "WARC-Target-URI": url,
+                "Content-Type": "application/http; msgtype=response",
+                "Crawl-Depth": str(depth),
+            },
+            payload,
+        )
+
+    def close(self):
+        """Closes the current file (if any), marking it as complete."""
+        if self._file is not None:
+            self._file.close()
+            os.replace(self._path + OPEN_EXTENSION, self._path)
+            self._file = None
+            self._path = None
+
+
+def warc_files(paths: Iterable[str]) -> List[str]:
+    """Returns the WARC files in `paths` (files, or directories to look in), oldest first.
+
+    Files that were never closed (e.g. the crawler was killed, or is still writing them) are included,
+    otherwise everything archived in them (up to `WARC_MAX_SIZE`) would never be replayed.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.endswith((EXTENSION, EXTENSION + OPEN_EXTENSION))
+            ]
+        else:
+            files.append(path)
+    return sorted(files, key=os.path.basename)
+
+
+def iter_records(path: str) -> Generator[WarcRecord, None, None]:
+    """Yields every record in a (gzipped) WARC file.
+
+    If the file ends with a partial record (e.g. the crawler was killed while writing it), it's skipped.
+    """
+    with gzip.open(path, "rb") as f:
+        try:
+            while line := f.readline():
+                if not line.strip():
+                    continue
+                if not line.startswith(b"WARC/"):
+                    raise ValueError(f"{path} isn't a WARC file (or is corrupted).")
+                headers = {}
+                while (line := f.readline()).strip():
+                    name, _, value = line.decode("utf-8").partition(":")
+                    headers[name.strip()] = value.strip()
+                length = int(headers.get("Content-Length", 0))
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                yield WarcRecord(headers, payload)
+        except (EOFError, gzip.BadGzipFile):
+            pass
+
+
+def iter_responses(path: str) -> Generator[ArchivedResponse, None, None]:
+    """Yields the responses archived in a WARC file, in the order they were written."""
+    for record in iter_records(path):
+        if record.headers.get("WARC-Type") != "response":
+            continue
+        head, _, body = record.payload.partition(b"\r\n\r\n")
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        headers = []
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers.append((name.strip(), value.strip()))
+        date = datetime.strptime(record.headers["WARC-Date"], "%Y-%m-%dT%H:%M:%SZ")
+        yield ArchivedResponse(
+            url=record.headers["WARC-Target-URI"],
+            status=int(status_line.split(" ", 2)[1]),
+            headers=headers,
+            body=body,
+            date=date.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None),
+            depth=int(record.headers.get("Crawl-Depth", 0)),
+        )
+
+
+class WarcArchive:
+    """
+    Downloader middleware that appends every response to rotating WARC files (see `WarcWriter`),
+    so extraction changes can be applied to pages already crawled by replaying them (see `crawler.replay`), instead of refetching them.
+
+    Responses are archived as the spider gets them: decompressed (so without their `Content-Encoding`),
+    and only if they got past `MimetypeFilter`.
+
+    Settings:
+        WARC_ENABLED: whether to archive responses.
+        WARC_DIR: the directory the files are written to (every shard can share it, file names include the process's id).
+        WARC_MAX_SIZE: files are rotated once they're this big (compressed), in bytes.
+
+    Stats:
+        warc/records, warc/bytes (compressed), warc/files
+
+    Works correctly at position 580 (lower than `HttpCompressionMiddleware`'s 590, so it gets responses once they're decompressed).
+    """
+
+    def __init__(self, writer: WarcWriter, stats=None) -> None:
+        self.writer = writer
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        if not settings.getbool("WARC_ENABLED", False):
+            raise NotConfigured
+        o = cls(
+            WarcWriter(
+                settings.get("WARC_DIR", "warc"),
+                max_size=settings.getint("WARC_MAX_SIZE", 1_000_000_000),
+            ),
+            crawler.stats,
+        )
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def process_response(self, request: Request, response: Response, spider: Spider):
+        files = self.writer.files
+        written = self.writer.write_response(
+            response.url,
+            response.status,
+            (
+                (name, value)
+                for name, values in response.headers.items()
+                for value in values
+            ),
+            response.body,
+            request.meta.get("depth", 0),
+        )
+        if self.stats is not None:
+            self.stats.inc_value("warc/records", spider=spider)
+            self.stats.inc_value("warc/bytes", written, spider=spider)
+            self.stats.inc_value("warc/files", self.writer.files - files, spider=spider)
+        return response
+
+    def spider_closed(self, spider: Spider):
+        self.writer.close()
@@ -0,0 +1,87 @@
+"""
+The search index.
+
+- `schema`: the index's fields (`MySchema`, or `PhraseSchema`) and analyzers
+- `index`: opening the index (`get_index`), sharded (`ShardedIndex`) or not (`MyFileIndex`)
+- `query`: parsing search terms (`parse_query`), and the faster phrase and wildcard queries
+- `highlight`: the results' snippets
+- `filters`: cached bitmaps of the documents searches skip (e.g. dead pages)
+- `searching`: `search`, `search_packed` and `warmup`
+- `suggestions` and `spelling`: type-ahead suggestions (`suggest`) and "did you mean" (`correct_query`)
+- `packed`: the packed result format for `web.rs`
+- `writing`: the index's writers, and the merge policy they commit with
+- `maintenance`: merging, purging, exporting and rebuilding the index
+- `service`: the search service (`serve`) and its client
+
+Importing the package only imports what searching needs, so processes that only search (e.g. `web.rs`) start faster.
+The names of `writing`, `maintenance` and `service` (which import whoosh's multiprocessing writer, sockets...) can be imported
+from the package too, but their module is only imported when one of them is first used.
+"""
+
+from importlib import import_module
+
+from crawler.whoosh_backend.filters import SEGMENT_FILTERS, dead_docnums, reader_filter, segment_filter
+from crawler.whoosh_backend.highlight import MyFormatter, MyHighlighter, set_matched_filter_phrases
+from crawler.whoosh_backend.index import MyFileIndex, MySearcher, ShardedIndex, ShardedWriter, get_index
+from crawler.whoosh_backend.packed import PACKED_MAGIC, PACKED_VERSION, pack_results, unpack_results
+from crawler.whoosh_backend.query import (
+    WILDCARD_MAX_TERMS,
+    KGramIndex,
+    KGramWildcard,
+    KGramWildcardPlugin,
+    ShinglePhrase,
+    SimpleParser,
+    parse_query,
+    query_is_valid,
+    query_parser,
+)
+from crawler.whoosh_backend.schema import (
+    DEFAULT_ANALYZER,
+    INTRAWORD,
+    SANITIZATION,
+    SHINGLE_ANALYZER,
+    AllFilters,
+    DuplicateFilter,
+    MultiFilter,
+    MySchema,
+    PhraseSchema,
+    PunctuationFilter,
+    WhitespaceTokenizer,
+)
+from crawler.whoosh_backend.searching import (
+    METRICS,
+    WARMUP_EXTENSIONS,
+    enable_metrics,
+    hit_to_result,
+    search,
+    search_many,
+    search_packed,
+    warmup,
+)
+from crawler.whoosh_backend.spelling import SpellingCorrector, SpellingDictionary, correct_query
+from crawler.whoosh_backend.suggestions import Suggester, SuggestionTable, suggest
+
+# the names that are only imported (from their module) when they're first used
+_LAZY_NAMES = {
+    "writing": ("TieredMergePolicy", "MyIndexWriter", "MyMpWriter"),
+    "maintenance": (
+        "MergeScheduler",
+        "compact",
+        "export_documents",
+        "iter_documents",
+        "iter_exported",
+        "merge_segments",
+        "purge_dead",
+        "rebuild",
+    ),
+    "service": ("SearchClient", "recv_frame", "send_frame", "serve"),
+}
+_LAZY_MODULES = {name: module for module, names in _LAZY_NAMES.items() for name in names}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f"{__name__}.{_LAZY_MODULES[name]}"), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,173 @@
+"""
+Tools for the search index, run from the project root:
+    python -m crawler.whoosh_backend {serve,warmup,compact,export,rebuild} [--index PATH] ...
+"""
+
+from argparse import ArgumentParser, BooleanOptionalAction
+from time import time
+
+from crawler.whoosh_backend.maintenance import compact, export_documents, rebuild
+from crawler.whoosh_backend.schema import MySchema, PhraseSchema
+from crawler.whoosh_backend.searching import warmup
+from crawler.whoosh_backend.service import serve
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Tools for the search index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser(
+        "serve",
+        help="Serve searches over a Unix socket, from a pool of worker processes.",
+    )
+    serve_parser.add_argument(
+        "--index",
+        default=None,
+        help="The index's path (defaults to the `INDEX_PATH` setting).",
+    )
+    serve_parser.add_argument(
+        "--socket", default="search.sock", help="The Unix socket's path."
+    )
+    serve_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of worker processes (defaults to the number of cores).",
+    )
+    serve_parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Record how long each stage of searching takes, and export it to this path (as JSON if it ends with .json, otherwise in Prometheus' text format), with the worker's number added.",
+    )
+    serve_parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="How often the metrics are exported, in seconds.",
+    )
+    serve_parser.add_argument(
+        "--profile",
+        default=None,
+        help="Sample the workers' stacks, and write them (in the collapsed format, for flame graphs) to this path, with the worker's number added.",
+    )
+    serve_parser.add_argument(
+        "--warmup-queries",
+        default=None,
+        help="A file of queries (one per line) each worker searches before accepting connections.",
+    )
+    warmup_parser = commands.add_parser(
+        "warmup",
+        help="Load everything searches need (and read the index's term dictionaries and columns into the OS' cache), and report how long it took.",
+    )
+    warmup_parser.add_argument(
+        "--index",
+        default=None,
+        help="The index's path (defaults to the `INDEX_PATH` setting).",
+    )
+    warmup_parser.add_argument(
+        "--queries",
+        default=None,
+        help="A file of queries (one per line) to search after warming up.",
+    )
+    compact_parser = commands.add_parser(
+        "compact",
+        help="Merge the index's segments, dropping deleted documents, and report the space reclaimed.",
+    )
+    compact_parser.add_argument(
+        "--index",
+        default=None,
+        help="The index's path (defaults to the `INDEX_PATH` setting).",
+    )
+    compact_parser.add_argument(
+        "--max-segments",
+        type=int,
+        default=1,
+        help="The most segments to leave (per shard).",
+    )
+    compact_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="How long to wait for the index's writers, in seconds.",
+    )
+    export_parser = commands.add_parser(
+        "export",
+        help="Write every document in the index to a gzipped JSON lines file.",
+    )
+    export_parser.add_argument(
+        "--index",
+        default=None,
+        help="The index's path (defaults to the `INDEX_PATH` setting).",
+    )
+    export_parser.add_argument(
+        "--output", default="records.jsonl.gz", help="The file to write to."
+    )
+    rebuild_parser = commands.add_parser(
+        "rebuild",
+        help="Reindex every document with the current schema and analyzers, in parallel, then swap the new index in.",
+    )
+    rebuild_parser.add_argument(
+        "--index",
+        default=None,
+        help="The index's path (defaults to the `INDEX_PATH` setting).",
+    )
+    rebuild_parser.add_argument(
+        "--source",
+        default=None,
+        help="An export (see `export`) or an index's path to read the documents from (defaults to the index itself).",
+    )
+    rebuild_parser.add_argument(
+        "--procs",
+        type=int,
+        default=None,
+        help="The number of processes analyzing documents (defaults to the number of cores).",
+    )
+    rebuild_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="How long to wait for the index's writers before swapping the new index in, in seconds.",
+    )
+    rebuild_parser.add_argument(
+        "--phrase-fields",
+        action=BooleanOptionalAction,
+        default=None,
+        help="Whether the new index has the bigram fields for phrases (defaults to the `INDEX_PHRASE_FIELDS` setting, or the index's own with --index).",
+    )
+    args = parser.parse_args()
+    if args.command == "export":
+        start = time()
+        exported = export_documents(args.output, args.index)
+        print(f"Exported {exported} documents to {args.output} in {time() - start:.1f}s.")
+    elif args.command == "rebuild":
+        start = time()
+        schema = None if args.phrase_fields is None else PhraseSchema if args.phrase_fields else MySchema
+        added = rebuild(args.source, args.index, args.procs, args.timeout, schema)
+        print(f"Rebuilt the index with {added} documents in {time() - start:.1f}s.")
+    elif args.command == "compact":
+        stats = compact(args.index, args.max_segments, args.timeout)
+        print(
+            f"{stats['segments_before']} segments -> {stats['segments_after']}, "
+            f"{stats['deleted_before'] - stats['deleted_after']} deleted documents dropped, "
+            f"{stats['bytes_reclaimed']:,} bytes reclaimed ({stats['bytes_before']:,} -> {stats['bytes_after']:,})."
+        )
+    elif args.command == "warmup":
+        timings = warmup(args.index, args.queries)
+        steps = ", ".join(
+            f"{step} {seconds * 1000:.0f}ms"
+            for step, seconds in timings.items()
+            if step not in ("bytes", "searched", "total")
+        )
+        print(
+            f"Warmed up in {timings['total']:.2f}s ({steps}), "
+            f"{timings['bytes']:,.0f} bytes read, {timings['searched']:.0f} queries searched."
+        )
+    elif args.command == "serve":
+        serve(
+            args.index,
+            args.socket,
+            args.workers,
+            args.metrics,
+            args.metrics_interval,
+            args.profile,
+            args.warmup_queries,
+        )
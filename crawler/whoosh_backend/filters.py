@@ -0,0 +1,84 @@
+"""
+Bitmaps of the documents that match a filter (e.g. the dead pages), cached per segment, for masking them out of searches.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from whoosh.columns import EmptyColumnReader
+from whoosh.idsets import BitSet
+from whoosh.reading import SegmentReader
+
+
+def _dead_docnums(reader: SegmentReader) -> Iterable[int]:
+    column = reader.column_reader("dead_since", translate=False)
+    if isinstance(column, EmptyColumnReader):  # no page in the segment is dead
+        return ()
+    alive = reader.schema["dead_since"].column_type.default_value()
+    return (docnum for docnum, value in enumerate(column) if value != alive)
+
+
+# The filters that get a cached bitmap per segment (see `segment_filter`), and the functions returning a segment's docnums that match them
+SEGMENT_FILTERS: Dict[str, Callable[[SegmentReader], Iterable[int]]] = {
+    "dead": _dead_docnums,
+}
+
+
+def segment_filter(reader: SegmentReader, name: str) -> BitSet:
+    """Returns a bitmap of the segment's (local) docnums that match the filter (see `SEGMENT_FILTERS`).
+
+    Segments only change by having documents deleted (which searches skip anyway), so each bitmap is only built once.
+    """
+    key = (reader.segment().segment_id(), name)
+    bitmap = _segment_filters.get(key)
+    if bitmap is not None:
+        _segment_filters.move_to_end(key)
+        return bitmap
+    bitmap = BitSet(SEGMENT_FILTERS[name](reader), size=reader.doc_count_all())
+    _segment_filters[key] = bitmap
+    while len(_segment_filters) > 256:
+        _segment_filters.popitem(last=False)
+    return bitmap
+
+
+def reader_filter(reader, name: str) -> Optional[BitSet]:
+    """Returns a bitmap of the reader's (global) docnums that match the filter, or `None` if none do.
+
+    It's made from the segments' bitmaps, and cached for as long as the reader's segments are the same (i.e. per generation).
+    """
+    leaves = [(leaf, offset) for leaf, offset in reader.leaf_readers() if leaf.doc_count_all()]
+    key = (name, tuple((leaf.segment().segment_id(), offset) for leaf, offset in leaves))
+    if key in _reader_filters:
+        _reader_filters.move_to_end(key)
+        return _reader_filters[key]
+    docnums = [
+        offset + docnum
+        for leaf, offset in leaves
+        for docnum in segment_filter(leaf, name)
+    ]
+    bitmap = BitSet(docnums, size=reader.doc_count_all()) if docnums else None
+    _reader_filters[key] = bitmap
+    while len(_reader_filters) > 16:
+        _reader_filters.popitem(last=False)
+    return bitmap
+
+
+_segment_filters: "OrderedDict[Tuple[str, str], BitSet]" = OrderedDict()
+_reader_filters: "OrderedDict[Tuple, Optional[BitSet]]" = OrderedDict()
+
+
+def dead_docnums(reader, ttl: float, now: Optional[datetime] = None) -> List[int]:
+    """Returns the reader's docnums of the pages that have been dead (see `dead_since`) for more than `ttl` seconds."""
+    cutoff = (now or datetime.now()) - timedelta(seconds=ttl)
+    expired = []
+    for leaf, offset in reader.leaf_readers():
+        if not leaf.doc_count_all():
+            continue
+        dead_since = leaf.column_reader("dead_since")
+        expired.extend(
+            offset + docnum
+            for docnum in segment_filter(leaf, "dead")
+            if not leaf.is_deleted(docnum) and dead_since[docnum] < cutoff
+        )
+    return expired
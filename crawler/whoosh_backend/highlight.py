@@ -0,0 +1,80 @@
+"""
+How search results' snippets are highlighted (`MyHighlighter`, which `MySearcher` gives its results).
+"""
+
+from html import escape as html_escape
+
+from typing_extensions import override
+from whoosh.highlight import (
+    FIRST,
+    Formatter,
+    Highlighter,
+    PinpointFragmenter,
+    get_text,
+    set_matched_filter_phrases as whoosh_set_matched_filter_phrases,
+)
+
+
+def set_matched_filter_phrases(*args, analyzer=None, analyzer_kwargs={}, **kwargs):
+    # we make this so we can pass text as a predefined list without getting errors because we tried to split the list
+    # (the default `matched_filter_phrases` function uses split by default to get tokens from text)
+    # doing it this way means there's no need to copy the entire original function with only minor tweaks here.
+    class ListWrapper(list):
+        def __init__(self, baseList):
+            super().__init__()
+            self.extend(baseList)
+
+        def split(self):
+            return self
+
+    if "text" in kwargs:
+        text = kwargs["text"]
+        text_in_kwargs = True
+    else:
+        text = args[1]
+        text_in_kwargs = False
+
+    if analyzer is not None:
+        text = ListWrapper([t.text for t in analyzer(text, **analyzer_kwargs)])
+        if text_in_kwargs:
+            kwargs["text"] = text
+        else:
+            args = list(args)
+            if "tokens" in kwargs:
+                args[0] = text
+            else:
+                args[1] = text
+
+    return whoosh_set_matched_filter_phrases(*args, **kwargs)
+
+
+class MyFormatter(Formatter):
+    def __init__(
+        self,
+        tagname="strong",
+        between="...",
+    ):
+        self.tagname = tagname
+        self.between = between
+
+    @override
+    def _text(self, text):
+        return html_escape(text)
+
+    @override
+    def format_token(self, text, token, replace=False):
+        ttext = self._text(get_text(text, token, replace))
+
+        return f"<{self.tagname}>{html_escape(ttext)}</{self.tagname}>"
+
+
+class MyHighlighter(Highlighter):
+    def __init__(
+        self,
+        fragmenter=PinpointFragmenter(surround=25),
+        scorer=None,
+        formatter=MyFormatter(),
+        always_retokenize=False,
+        order=FIRST,
+    ):
+        super().__init__(fragmenter, scorer, formatter, always_retokenize, order)
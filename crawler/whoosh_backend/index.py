@@ -0,0 +1,421 @@
+"""
+Opening the index (`get_index`), which is either one `MyFileIndex`, or a `ShardedIndex` split into several of them.
+"""
+
+from bisect import bisect_right
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Generator, Iterable, List, Literal, Optional, Tuple, Union, overload
+from zlib import crc32
+
+from typing_extensions import override
+from whoosh.collectors import FilterCollector, TermsCollector
+from whoosh.index import FileIndex
+from whoosh.query import Query
+from whoosh.reading import MultiReader
+from whoosh.searching import Searcher
+
+from crawler.whoosh_backend.highlight import MyHighlighter
+from crawler.whoosh_backend.schema import MySchema, PhraseSchema
+
+if TYPE_CHECKING:
+    from crawler.whoosh_backend.writing import MyIndexWriter, MyMpWriter
+
+
+class _TermsCollector(TermsCollector):
+    """A `TermsCollector` that only claims to count exactly if its child does.
+
+    Otherwise, a `FilterCollector` around it counts every matching document, including the ones it filtered out."""
+
+    @override
+    def computes_count(self):
+        return self.child.computes_count()
+
+
+class MySearcher(Searcher):
+    """Returns results with `MyHighlighter` as the default highlighter."""
+
+    @override
+    def collector(self, **kwargs):
+        collector = super().collector(**kwargs)
+        if isinstance(collector, FilterCollector) and isinstance(
+            collector.child, TermsCollector
+        ):
+            collector.child = _TermsCollector(collector.child.child)
+        return collector
+
+    @override
+    def search(self, q, **kwargs):
+        results = super().search(q, **kwargs)
+        results.highlighter = MyHighlighter()
+        return results
+
+    @override
+    def search_page(self, query, pagenum, pagelen=10, **kwargs):
+        results = super().search_page(query, pagenum, pagelen, **kwargs)
+        results.highlighter = MyHighlighter()
+        return results
+
+
+class MyFileIndex(FileIndex):
+    @staticmethod
+    def create_in(dirname, schema, indexname=None, mmap=True) -> "MyFileIndex":
+        """Convenience function to create an index in a directory. Takes care of
+        creating a FileStorage object for you.
+
+        :param dirname: the path string of the directory in which to create the
+            index.
+        :param schema: a :class:`whoosh.fields.Schema` object describing the
+            index's fields.
+        :param indexname: the name of the index to create; you only need to specify
+            this if you are creating multiple indexes within the same storage
+            object.
+        :param mmap: whether the index's files are memory mapped (see `open_dir`).
+        :returns: :class:`Index`
+        """
+
+        from whoosh.filedb.filestore import FileStorage
+        from whoosh.index import _DEF_INDEX_NAME
+
+        if not indexname:
+            indexname = _DEF_INDEX_NAME
+        storage = FileStorage(dirname, supports_mmap=mmap)
+        return MyFileIndex.create(storage, schema, indexname)
+
+    @staticmethod
+    def open_dir(dirname, indexname=None, readonly=False, schema=None, mmap=True):
+        """Convenience function for opening an index in a directory. Takes care of
+        creating a FileStorage object for you. dirname is the filename of the
+        directory in containing the index. indexname is the name of the index to
+        create; you only need to specify this if you have multiple indexes within
+        the same storage object.
+
+        :param dirname: the path string of the directory in which to create the
+            index.
+        :param indexname: the name of the index to create; you only need to specify
+            this if you have multiple indexes within the same storage object.
+        :param mmap: whether the index's files are memory mapped. Readers of a memory mapped
+            index copy each segment they open into memory, see `_open_index`.
+        """
+
+        from whoosh.filedb.filestore import FileStorage
+        from whoosh.index import _DEF_INDEX_NAME
+
+        if indexname is None:
+            indexname = _DEF_INDEX_NAME
+        storage = FileStorage(dirname, readonly=readonly, supports_mmap=mmap)
+        return MyFileIndex(storage, schema=schema, indexname=indexname)
+
+    @overload
+    def writer(
+        self, procs: Union[Literal[0], Literal[1]] = 1, **kwargs
+    ) -> "MyIndexWriter": ...
+
+    @override
+    def writer(self, procs: int = 1, **kwargs) -> "MyMpWriter":
+        """
+        Returns MyIndexWriter if `procs` is 1, otherwise returns `MyMpWriter` (an `MpWriter`, as usual).
+        """
+        from crawler.whoosh_backend.writing import MyIndexWriter, MyMpWriter
+
+        if procs > 1:
+            return MyMpWriter(self, procs=procs, **kwargs)
+        else:
+            return MyIndexWriter(self, **kwargs)
+
+    @override
+    def searcher(self, **kwargs) -> MySearcher:
+        return MySearcher(self.reader(), fromindex=self, **kwargs)
+
+    def get_docnums_and_results(
+        self, q: Query = None, limit: int = None
+    ) -> Generator[Tuple[int, Dict[str, Any]], None, None] | None:
+        """Returns a generator of tuples containing a result's docnum and its fields.
+
+        If passed a query, the generator will only include results that match this query.
+        If kwargs are present, they are passed to the query.
+
+        If no query is present, the generator includes every result in the index.
+
+        Args:
+            q (Query, optional): The query to match results on. Defaults to None.
+            limit (int, optional): The maximum amount of results to return. Defaults to as many as possible (no limit).
+
+        Yields:
+            Generator[Tuple[int, Dict[str, Any]], None, None] | None: Returns a generator of tuples containing a result's docnum and its fields
+        """
+        with self.searcher() as s:
+            yield from (
+                (
+                    (docnum, s.ixreader.stored_fields(docnum))
+                    for docnum in (
+                        s.search(q, limit=limit or s.doc_count_all()).docs()
+                        if q
+                        else s.document_numbers()
+                    )
+                )
+                if s.doc_count()
+                else []
+            )
+
+
+def get_index(
+    storage_path: Optional[str] = None,
+    schema=None,
+    shards: Optional[int] = None,
+    mmap: bool = True,
+) -> Union[MyFileIndex, "ShardedIndex"]:
+    """Get a file index, based on either:
+        1. The `INDEX_PATH` value in the scrapy project's settings.
+        2. The path passed to the function (`storage_path`)
+
+    If no path is given, `ValueError` is raised.
+    If a path is given but it doesn't exist, the index is created at that path and returned.
+
+    If the path holds a sharded index, or `shards` (or the `INDEX_SHARDS` setting) is more than 1, a `ShardedIndex` is returned.
+    If `mmap` is False, the index's files aren't memory mapped (see `MyFileIndex.open_dir`).
+
+    `schema` defaults to the one the index was built with (see `_schema_class`), or for a new index,
+    to the one the `INDEX_PHRASE_FIELDS` setting picks when no path is given, and `MySchema` otherwise.
+    If an existing index has phrase fields and `schema` doesn't (or the other way around), `ValueError` is raised:
+    the index needs to be rebuilt (see `rebuild`), as phrases can only use the fields if every document has them.
+    """
+    if storage_path is None:
+        storage_path, default_shards = _index_settings()
+        if shards is None:
+            shards = default_shards
+        if schema is None:
+            schema = _schema_setting()
+    if ShardedIndex.is_sharded(storage_path) or (shards or 1) > 1:
+        return ShardedIndex(storage_path, shards=shards, schema=schema, mmap=mmap)
+    if not os.path.exists(storage_path):
+        os.mkdir(storage_path)
+        return MyFileIndex.create_in(storage_path, schema=(schema or MySchema)(), mmap=mmap)
+    # opened with the schema it was written with first
+    index = MyFileIndex.open_dir(storage_path, mmap=mmap)
+    built_with = _schema_class(index.schema)
+    if schema is None:
+        schema = built_with
+    elif _phrase_fields(schema()) != _phrase_fields(built_with()):
+        raise ValueError(
+            f"{storage_path} was built {'with' if _phrase_fields(built_with()) else 'without'} phrase fields, "
+            f"it needs to be rebuilt to change that (see `INDEX_PHRASE_FIELDS`)."
+        )
+    return MyFileIndex(index.storage, schema=schema(), indexname=index.indexname)
+
+
+def _phrase_fields(schema) -> List[str]:
+    return [name for name in schema.names() if name.startswith("phrase_")]
+
+
+def _schema_class(schema):
+    """Returns `PhraseSchema` if the (stored) schema has phrase fields, and `MySchema` otherwise."""
+    return PhraseSchema if _phrase_fields(schema) else MySchema
+
+
+def _schema_setting():
+    """Returns the schema new indexes get, `PhraseSchema` if the `INDEX_PHRASE_FIELDS` setting is on."""
+    from scrapy.utils.project import get_project_settings
+
+    return PhraseSchema if get_project_settings().getbool("INDEX_PHRASE_FIELDS") else MySchema
+
+
+def _index_settings() -> Tuple[str, int]:
+    """Returns the (absolute) `INDEX_PATH` and `INDEX_SHARDS` values in the scrapy project's settings."""
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    storage_path = settings.get("INDEX_PATH", None)
+    if storage_path is None:
+        raise ValueError(
+            "Please define the `INDEX_PATH` value in the scrapy project's settings or pass the path to the function via `storage_path`."
+        )
+    return str(Path(storage_path).absolute()), settings.getint("INDEX_SHARDS", 1)
+
+
+class ShardedWriter:
+    """
+    Routes writes to the writers of a `ShardedIndex`'s shards.
+
+    Documents go to the shard their url hashes to, and shard writers are only opened when they're first needed.
+    Docnums are the ones used by `ShardedIndex.searcher()` (i.e. global, offset by shard).
+    """
+
+    def __init__(self, index: "ShardedIndex", **kwargs) -> None:
+        self.index = index
+        self.kwargs = kwargs
+        self.writers: Dict[int, "MyIndexWriter"] = {}
+        self._offsets: Optional[List[int]] = None
+
+    def _writer(self, shard: int) -> "MyIndexWriter":
+        if shard not in self.writers:
+            self.writers[shard] = self.index.indexes[shard].writer(**self.kwargs)
+        return self.writers[shard]
+
+    def _shard_and_docnum(self, docnum: int) -> Tuple[int, int]:
+        if self._offsets is None:
+            self._offsets = self.index.doc_offsets()
+        shard = max(0, bisect_right(self._offsets, docnum) - 1)
+        return shard, docnum - self._offsets[shard]
+
+    def update_document(self, **fields):
+        self._writer(self.index.shard_for(fields["url"])).update_document(**fields)
+
+    def update_documents(self, documents: Iterable[Dict[str, Any]]) -> int:
+        by_shard: Dict[int, List[Dict[str, Any]]] = {}
+        for document in documents:
+            by_shard.setdefault(self.index.shard_for(document["url"]), []).append(
+                document
+            )
+        return sum(
+            self._writer(shard).update_documents(shard_documents)
+            for shard, shard_documents in by_shard.items()
+        )
+
+    def add_document(self, **fields):
+        self._writer(self.index.shard_for(fields["url"])).add_document(**fields)
+
+    def delete_document(self, docnum: int, delete: bool = True):
+        shard, docnum = self._shard_and_docnum(docnum)
+        self._writer(shard).delete_document(docnum, delete)
+
+    def delete_by_term(self, fieldname: str, text, searcher=None) -> int:
+        if fieldname == "url":
+            shards = [self.index.shard_for(text)]
+        else:
+            shards = range(len(self.index.indexes))
+        return sum(self._writer(i).delete_by_term(fieldname, text) for i in shards)
+
+    def commit(self, **kwargs):
+        # committed writers are removed as they go, so `cancel` after a failed commit only cancels the rest
+        while self.writers:
+            _, writer = self.writers.popitem()
+            writer.commit(**kwargs)
+
+    def cancel(self):
+        for writer in self.writers.values():
+            writer.cancel()
+        self.writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.cancel()
+        else:
+            self.commit()
+
+
+class ShardedIndex:
+    """
+    An index split into `shards` sub-indexes (`<storage_path>/shard-<n>`), by the hash of each document's url.
+
+    Writers only lock the shards they write to, and queries run on every shard in parallel (see `_search_shards`).
+    `searcher()` and `get_docnums_and_results()` work like `MyFileIndex`'s, over every shard.
+    """
+
+    SHARD_PREFIX = "shard-"
+
+    def __init__(
+        self,
+        storage_path: str,
+        shards: Optional[int] = None,
+        schema=None,
+        mmap: bool = True,
+    ) -> None:
+        self.storage_path = storage_path
+        existing = self.shard_count(storage_path)
+        if existing and shards and shards != existing:
+            raise ValueError(
+                f"{storage_path} has {existing} shards, but {shards} were requested. The index needs to be rebuilt to change the number of shards."
+            )
+        elif not existing and os.path.exists(os.path.join(storage_path, "_MAIN_LOCK")):
+            raise ValueError(
+                f"{storage_path} holds an unsharded index, it needs to be rebuilt to be sharded."
+            )
+        self.shards = existing or shards
+        if not self.shards:
+            raise ValueError("The number of shards must be given for a new index.")
+        os.makedirs(storage_path, exist_ok=True)
+        self.indexes: List[MyFileIndex] = [
+            get_index(self.shard_path(i), schema=schema, mmap=mmap)
+            for i in range(self.shards)
+        ]
+
+    @classmethod
+    def shard_count(cls, storage_path: str) -> int:
+        if not os.path.isdir(storage_path):
+            return 0
+        return sum(
+            1 for name in os.listdir(storage_path) if name.startswith(cls.SHARD_PREFIX)
+        )
+
+    @classmethod
+    def is_sharded(cls, storage_path: str) -> bool:
+        return cls.shard_count(storage_path) > 0
+
+    def shard_path(self, shard: int) -> str:
+        return os.path.join(self.storage_path, f"{self.SHARD_PREFIX}{shard}")
+
+    def shard_for(self, url: str) -> int:
+        return crc32(url.encode()) % self.shards
+
+    @property
+    def schema(self):
+        return self.indexes[0].schema
+
+    def doc_offsets(self) -> List[int]:
+        """The first (global) docnum of each shard."""
+        offsets, base = [], 0
+        for ix in self.indexes:
+            offsets.append(base)
+            base += ix.doc_count_all()
+        return offsets
+
+    def doc_count(self) -> int:
+        return sum(ix.doc_count() for ix in self.indexes)
+
+    def doc_count_all(self) -> int:
+        return sum(ix.doc_count_all() for ix in self.indexes)
+
+    def latest_generation(self) -> Tuple[int, ...]:
+        return tuple(ix.latest_generation() for ix in self.indexes)
+
+    def writer(self, **kwargs) -> ShardedWriter:
+        return ShardedWriter(self, **kwargs)
+
+    def reader(self) -> MultiReader:
+        # every shard's segments are flattened into one reader, so docnums are offset by shard
+        return MultiReader(
+            [leaf for ix in self.indexes for leaf, _ in ix.reader().leaf_readers()]
+        )
+
+    def searcher(self, **kwargs) -> MySearcher:
+        return MySearcher(self.reader(), fromindex=self, **kwargs)
+
+    get_docnums_and_results = MyFileIndex.get_docnums_and_results
+
+    def close(self):
+        for ix in self.indexes:
+            ix.close()
+
+
+def _file_indexes(ix: Union[MyFileIndex, ShardedIndex]) -> List[MyFileIndex]:
+    return ix.indexes if isinstance(ix, ShardedIndex) else [ix]
+
+
+_open_indexes: Dict[str, Union[MyFileIndex, ShardedIndex]] = {}
+
+
+def _open_index(storage_path: str) -> Union[MyFileIndex, ShardedIndex]:
+    """Returns the index (kept open) that searches, suggestions and spelling corrections read in this process.
+
+    It isn't memory mapped: whoosh copies every part of a memory mapped segment (terms, postings, columns) into a `BytesIO`
+    when a reader opens it, so opening a searcher would read the whole index into memory. Without mmap, readers read what they need from the files.
+    Writers don't open readers for every search, so they keep whoosh's default.
+    """
+    # index objects always read the latest generation, so they can be reused
+    if storage_path not in _open_indexes:
+        _open_indexes[storage_path] = get_index(storage_path, mmap=False)
+    return _open_indexes[storage_path]
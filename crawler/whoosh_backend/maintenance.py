@@ -0,0 +1,374 @@
+"""
+Keeping the index in shape: merging its segments (`merge_segments`, `compact`, and `MergeScheduler` in the background),
+purging dead pages (`purge_dead`), and exporting its documents (`export_documents`) or rebuilding it from them (`rebuild`).
+"""
+
+from datetime import datetime
+import json
+import os
+import threading
+from time import time
+from typing import Any, Dict, Generator, Optional, Union
+
+from whoosh.fields import DATETIME
+from whoosh.index import TOC, LockError, clean_files
+from whoosh.writing import NO_MERGE
+
+from crawler.whoosh_backend.filters import dead_docnums
+from crawler.whoosh_backend.index import MyFileIndex, ShardedIndex, _file_indexes, _index_settings, _schema_class, _schema_setting, get_index
+from crawler.whoosh_backend.query import KGramIndex
+from crawler.whoosh_backend.schema import MySchema
+from crawler.whoosh_backend.writing import TieredMergePolicy
+
+
+def _storage_size(ix: MyFileIndex) -> int:
+    return sum(ix.storage.file_length(name) for name in ix.storage.list())
+
+
+def merge_segments(
+    ix: Union[MyFileIndex, ShardedIndex],
+    policy: Optional[TieredMergePolicy] = None,
+    timeout: float = 0.0,
+) -> bool:
+    """Merges the index's segments (every shard's, if it's sharded) with `policy`, if it picks any.
+
+    Writers are only opened (and the index locked) when there's something to merge,
+    and shards that are locked for longer than `timeout` seconds are skipped.
+
+    Returns:
+        bool: True if any segments were merged.
+    """
+    policy = policy or TieredMergePolicy()
+    merged = False
+    for index in _file_indexes(ix):
+        if not policy.select(index._segments()):
+            continue
+        try:
+            writer = index.writer(timeout=timeout)
+        except LockError:
+            continue
+        writer.commit(mergetype=policy)
+        merged = True
+    return merged
+
+
+def compact(
+    storage_path: Optional[str] = None, max_segments: int = 1, timeout: float = 60
+) -> Dict[str, int]:
+    """Merges the index into at most `max_segments` segments (per shard), dropping every deleted document.
+
+    Shards whose writers haven't finished after `timeout` seconds are skipped.
+
+    Returns:
+        Dict[str, int]: The number of segments, deleted documents and bytes before and after, and the bytes reclaimed.
+    """
+    ix = get_index(storage_path)
+    indexes = _file_indexes(ix)
+
+    def measure(when: str) -> Dict[str, int]:
+        segments = [segment for index in indexes for segment in index._segments()]
+        return {
+            f"segments_{when}": len(segments),
+            f"deleted_{when}": sum(segment.deleted_count() for segment in segments),
+            f"bytes_{when}": sum(_storage_size(index) for index in indexes),
+        }
+
+    stats = measure("before")
+    merge_segments(
+        ix, TieredMergePolicy(max_deleted_ratio=0, max_segments=max_segments), timeout
+    )
+    stats.update(measure("after"))
+    ix.close()
+    stats["bytes_reclaimed"] = stats["bytes_before"] - stats["bytes_after"]
+    return stats
+
+
+def iter_documents(
+    ix: Union[MyFileIndex, ShardedIndex],
+) -> Generator[Dict[str, Any], None, None]:
+    """Yields the fields of every (live) document in the index (every shard's, if it's sharded), except the `phrase_` ones.
+
+    Fields that aren't stored (e.g. `depth`) are read from their columns, so the documents can be added to another index as they are.
+    """
+    field_names = [f for f in ix.schema.names() if not f.startswith("phrase_")]
+    for index in _file_indexes(ix):
+        with index.reader() as reader:
+            # stored fields that are missing are None
+            columns = {
+                name: reader.column_reader(name)
+                for name in field_names
+                if not ix.schema[name].stored and reader.has_column(name)
+            }
+            for docnum, stored_fields in reader.iter_docs():
+                fields = {}
+                for name in field_names:
+                    if name in stored_fields:
+                        fields[name] = stored_fields[name]
+                    elif name in columns:
+                        fields[name] = columns[name][docnum]
+                    else:
+                        fields[name] = None
+                yield fields
+
+
+def export_documents(output_path: str, storage_path: Optional[str] = None) -> int:
+    """Writes every document in the index to a gzipped JSON lines file (one document per line), for `rebuild` (or anything else) to read.
+
+    The index is read one document at a time, so it doesn't need to fit in memory.
+
+    Returns:
+        int: The number of documents exported.
+    """
+    import gzip
+
+    ix = get_index(storage_path)
+    exported = 0
+    with gzip.open(output_path, "wt", encoding="utf-8", compresslevel=6) as f:
+        for fields in iter_documents(ix):
+            f.write(
+                json.dumps(
+                    {
+                        name: value.isoformat() if isinstance(value, datetime) else value
+                        for name, value in fields.items()
+                    },
+                    ensure_ascii=False,
+                )
+            )
+            f.write("\n")
+            exported += 1
+    ix.close()
+    return exported
+
+
+def iter_exported(path: str, schema=MySchema) -> Generator[Dict[str, Any], None, None]:
+    """Yields the documents in a file written by `export_documents`, with their dates parsed again.
+
+    Fields the schema doesn't have (anymore) are dropped, and fields it doesn't have yet are None.
+    """
+    import gzip
+
+    schema = schema()
+    field_names = [f for f in schema.names() if not f.startswith("phrase_")]
+    dates = {name for name in field_names if isinstance(schema[name], DATETIME)}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            document = json.loads(line)
+            fields = {name: document.get(name) for name in field_names}
+            for name in dates:
+                if fields[name] is not None:
+                    fields[name] = datetime.fromisoformat(fields[name])
+            yield fields
+
+
+def _swap_in(index: MyFileIndex, fresh: MyFileIndex, timeout: float):
+    """Replaces the index's documents with `fresh`'s (which must be on the same filesystem).
+
+    Like a commit: the fresh segments' files are moved into the index's directory, then a new TOC listing only them is written,
+    all while holding the index's lock. Readers see either the old segments or the new ones.
+    """
+    segments = fresh._segments()
+    segment_pattern = TOC._segment_pattern(fresh.indexname)
+    # only to hold the lock, so no one commits in between
+    writer = index.writer(timeout=timeout)
+    try:
+        for name in fresh.storage.list():
+            if segment_pattern.match(name):
+                os.replace(
+                    os.path.join(fresh.storage.folder, name),
+                    os.path.join(index.storage.folder, name),
+                )
+        generation = index.latest_generation() + 1
+        TOC(fresh.schema, segments, generation).write(index.storage, index.indexname)
+    finally:
+        writer.cancel()
+    clean_files(index.storage, index.indexname, generation, segments)
+
+
+def rebuild(
+    source: Optional[str] = None,
+    storage_path: Optional[str] = None,
+    procs: Optional[int] = None,
+    timeout: float = 60,
+    schema=None,
+) -> int:
+    """Reindexes every document with the current schema and analyzers, then swaps the new index in (e.g. after changing `MySchema`).
+
+    `schema` defaults to the one the `INDEX_PHRASE_FIELDS` setting picks if no `storage_path` is given, and the index's own otherwise,
+    so this is also how an index gets (or drops) its phrase fields (see `PhraseSchema`).
+
+    The documents are read from `source`, which is either an export (see `export_documents`) or an index's path,
+    and defaults to the index itself. They're analyzed by `procs` processes (defaults to the number of cores) with an `MpWriter`,
+    into a new index next to the old one, which replaces it once it's done (see `_swap_in`). A sharded index keeps its number of shards,
+    and each shard is swapped in on its own.
+
+    The new index has one segment per process, they're merged later on (or with `compact`).
+    Anything committed to the index while it's being rebuilt is lost.
+
+    Returns:
+        int: The number of documents in the new index.
+    """
+    import shutil
+    import tempfile
+
+    shards = None
+    if storage_path is None:
+        storage_path, shards = _index_settings()
+        if schema is None:
+            schema = _schema_setting()
+    if source is None:
+        source = storage_path
+    if not os.path.exists(source):
+        raise FileNotFoundError(f"There's nothing to rebuild the index from at {source}.")
+    # both are opened with the schema they were built with, which may not be the new one
+    target = get_index(storage_path, shards=shards)
+    if schema is None:
+        schema = _schema_class(target.schema)
+    if os.path.isfile(source):
+        source_index = None
+        documents = iter_exported(source, schema)
+    else:
+        source_index = get_index(source)
+        documents = iter_documents(source_index)
+
+    indexes = _file_indexes(target)
+    procs = procs or os.cpu_count() or 1
+    shard_procs = max(1, procs // len(indexes))
+    parent = os.path.dirname(os.path.abspath(storage_path))
+    build_path = tempfile.mkdtemp(prefix=f".{os.path.basename(storage_path)}-rebuild-", dir=parent)
+    try:
+        fresh = []
+        writers = []
+        for i in range(len(indexes)):
+            os.mkdir(os.path.join(build_path, str(i)))
+            index = MyFileIndex.create_in(os.path.join(build_path, str(i)), schema=schema())
+            fresh.append(index)
+            writers.append(
+                index.writer(procs=shard_procs, multisegment=True)
+                if shard_procs > 1
+                else index.writer()
+            )
+        added = 0
+        try:
+            for fields in documents:
+                shard = target.shard_for(fields["url"]) if len(indexes) > 1 else 0
+                writers[shard].add_document(**fields)
+                added += 1
+        except BaseException:
+            # stops the `MpWriter`s' processes too
+            for writer in writers:
+                writer.cancel()
+            raise
+        for writer, index in zip(writers, fresh):
+            writer.commit(mergetype=NO_MERGE)
+            KGramIndex.build_missing(index.storage, index.indexname, index.schema)
+        if source_index is not None:
+            source_index.close()
+        for index, new_index in zip(indexes, fresh):
+            _swap_in(index, new_index, timeout)
+    finally:
+        shutil.rmtree(build_path, ignore_errors=True)
+    target.close()
+    return added
+
+
+class MergeScheduler:
+    """
+    Merges an index's segments in a background thread, while it isn't being written to.
+
+    Writers can then commit without merging (`commit(mergetype=NO_MERGE)`), so commits take about as long however big the index is.
+    Every `interval` seconds, the index's generation is checked, and once it hasn't changed for `idle_seconds`,
+    its segments are merged with `policy` (see `merge_segments`).
+    If writes never stop for long enough, it merges anyway once a shard has more than `max_segments` segments,
+    so searches don't slow down. Writers that want the index while it's being merged have to wait for it (see `SegmentWriter`'s `timeout`).
+    """
+
+    def __init__(
+        self,
+        ix: Union[MyFileIndex, ShardedIndex],
+        policy: Optional[TieredMergePolicy] = None,
+        idle_seconds: float = 30,
+        interval: float = 5,
+        max_segments: int = 50,
+    ) -> None:
+        self.ix = ix
+        self.policy = policy or TieredMergePolicy()
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.max_segments = max_segments
+        self.merges = 0
+        self._generation = None
+        self._changed_at = time()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="merge-scheduler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stops the thread, waiting for a running merge to finish."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self, now: Optional[float] = None) -> bool:
+        """Merges the index if it's been idle (or has too many segments).
+
+        Returns:
+            bool: True if any segments were merged.
+        """
+        now = time() if now is None else now
+        generation = self.ix.latest_generation()
+        if generation != self._generation:
+            self._generation, self._changed_at = generation, now
+        crowded = any(
+            len(index._segments()) > self.max_segments
+            for index in _file_indexes(self.ix)
+        )
+        if now - self._changed_at < self.idle_seconds and not crowded:
+            return False
+        if not merge_segments(self.ix, self.policy):
+            return False
+        self.merges += 1
+        # our own commit isn't a write
+        self._generation = self.ix.latest_generation()
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Merging {self.ix} failed: {e!r}")
+
+
+def purge_dead(
+    ix: Union[MyFileIndex, "ShardedIndex"],
+    ttl: float,
+    now: Optional[datetime] = None,
+    timeout: float = 0.0,
+) -> int:
+    """Deletes the pages that have been dead (see `dead_since`) for more than `ttl` seconds.
+
+    Returns:
+        int: The number of pages deleted.
+    """
+    purged = 0
+    for index in _file_indexes(ix):
+        writer = index.writer(timeout=timeout)
+        # the writer's reader, so the docnums are the writer's
+        with writer.reader() as reader:
+            expired = dead_docnums(reader, ttl, now)
+        for docnum in expired:
+            writer.delete_document(docnum)
+        if expired:
+            writer.commit()
+        else:
+            writer.cancel()
+        purged += len(expired)
+    return purged
@@ -0,0 +1,105 @@
+"""
+The packed result format (`pack_results`), for callers that want as few Python objects as possible (e.g. `web.rs`).
+"""
+
+import struct
+from typing import Any, Dict
+
+
+# The packed result format, returned by `search_packed`.
+# All integers are big-endian. The layout (version 2) is:
+#   header, 20 bytes:
+#       magic       3 bytes, b"SLR"
+#       version     u8, `PACKED_VERSION`
+#       flags       u8, bit 0: valid, bit 1: exact, bit 2: last
+#       (padding)   1 byte
+#       count       u16, the number of results
+#       duration    f32, seconds
+#       total       u32
+#       maxpage     u32
+#   then, for each result, a 16 byte header:
+#       url length, title length, snippet length    u32 each, in bytes
+#       depth       i32
+#   followed by the url, title and snippet, UTF-8 encoded.
+#   then the suggestion (the corrected search term, see `correct_query`):
+#       length      u32, in bytes (0 if there's no suggestion)
+#   followed by the suggestion, UTF-8 encoded.
+# An invalid query is a header with only the version set (and the valid flag unset).
+# Any change to the layout must bump `PACKED_VERSION`, and be mirrored in `unpack_results` (in `web.rs`).
+PACKED_MAGIC = b"SLR"
+PACKED_VERSION = 2
+_PACKED_HEADER = struct.Struct(">3sBBxHfII")
+_PACKED_RESULT = struct.Struct(">IIIi")
+_PACKED_LENGTH = struct.Struct(">I")
+_VALID, _EXACT, _LAST = 1, 2, 4
+
+
+def pack_results(results: Dict[str, Any]) -> bytes:
+    """Packs the results of `search` (see the layout above)."""
+    if not results["valid"]:
+        return _PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, 0, 0, 0, 0, 0)
+    flags = (
+        _VALID | (_EXACT if results["exact"] else 0) | (_LAST if results["last"] else 0)
+    )
+    parts = [
+        _PACKED_HEADER.pack(
+            PACKED_MAGIC,
+            PACKED_VERSION,
+            flags,
+            len(results["results"]),
+            results["duration"],
+            results["total"],
+            results["maxpage"],
+        )
+    ]
+    for result in results["results"]:
+        url = result["url"].encode()
+        title = result["title"].encode()
+        snippet = result["snippet"].encode()
+        parts.append(
+            _PACKED_RESULT.pack(len(url), len(title), len(snippet), result["depth"])
+        )
+        parts += (url, title, snippet)
+    suggestion = (results.get("suggestion") or "").encode()
+    parts += (_PACKED_LENGTH.pack(len(suggestion)), suggestion)
+    return b"".join(parts)
+
+
+def unpack_results(payload: bytes) -> Dict[str, Any]:
+    """The reverse of `pack_results`."""
+    magic, version, flags, count, duration, total, maxpage = _PACKED_HEADER.unpack_from(
+        payload
+    )
+    if magic != PACKED_MAGIC or version != PACKED_VERSION:
+        raise ValueError(
+            f"Expected packed results (version {PACKED_VERSION}), got {magic!r} (version {version})."
+        )
+    if not flags & _VALID:
+        return {"valid": False}
+    view = memoryview(payload)
+    offset = _PACKED_HEADER.size
+    results = []
+    for _ in range(count):
+        url_length, title_length, snippet_length, depth = _PACKED_RESULT.unpack_from(
+            payload, offset
+        )
+        offset += _PACKED_RESULT.size
+        fields = []
+        for length in (url_length, title_length, snippet_length):
+            fields.append(str(view[offset : offset + length], "utf-8"))
+            offset += length
+        url, title, snippet = fields
+        results.append({"url": url, "title": title, "depth": depth, "snippet": snippet})
+    (suggestion_length,) = _PACKED_LENGTH.unpack_from(payload, offset)
+    offset += _PACKED_LENGTH.size
+    suggestion = str(view[offset : offset + suggestion_length], "utf-8") or None
+    return {
+        "valid": True,
+        "results": results,
+        "duration": duration,
+        "total": total,
+        "exact": bool(flags & _EXACT),
+        "last": bool(flags & _LAST),
+        "maxpage": maxpage,
+        "suggestion": suggestion,
+    }
@@ -0,0 +1,352 @@
+"""
+Parsing search terms into queries (`parse_query`), and the query types that make phrases (`ShinglePhrase`)
+and wildcards (`KGramWildcard`, with each segment's `KGramIndex`) faster than whoosh's own.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import os
+import pickle
+import re
+from typing import Dict, List, Optional, Tuple
+
+from whoosh.index import TOC
+from whoosh.matching import IntersectionMatcher, NullMatcher, RequireMatcher, WrappingMatcher
+from whoosh.qparser import FieldsPlugin, OrGroup, QueryParser, WildcardPlugin
+from whoosh.query import Every, Phrase, Query, SpanNear2, Term, Wildcard
+from whoosh.query.qcore import _NullQuery
+from whoosh.reading import OverlayStorage, SegmentReader
+from whoosh.util import make_binary_tree
+
+
+def SimpleParser(fieldname, schema, plugins=[], **kwargs):
+    """Returns a QueryParser configured to support +, -, and (custom) phrase
+    syntax.
+    """
+    from whoosh.qparser import plugins as whoosh_plugins, syntax
+
+    # the WhitespacePlugin used to be added here, but it's added to the QueryParser regardless, with `_add_ws_plugin` in `QueryParser.__init__`
+    # single quotes only group words into one term (which is analyzed into an OR group), double quotes make a phrase
+    pins = [whoosh_plugins.PlusMinusPlugin(r"(^|\s)\+", r"(^|\s)-"), whoosh_plugins.SingleQuotePlugin, whoosh_plugins.PhrasePlugin] + plugins
+    orgroup = kwargs.pop("group", syntax.OrGroup)
+    return QueryParser(fieldname, schema, plugins=pins, group=orgroup, **kwargs)
+
+
+_SIMPLE_WORD = re.compile(r"^\w+$")
+
+
+class _TermAlias:
+    # looks like a matcher of `term` to `TermsCollector`, matching wherever `matcher` does
+    def __init__(self, matcher, term) -> None:
+        self.matcher = matcher
+        self._term = term
+
+    def is_active(self):
+        return self.matcher.is_active()
+
+    def id(self):
+        return self.matcher.id()
+
+    def term(self):
+        return self._term
+
+
+class _PhraseTermsMatcher(WrappingMatcher):
+    # reports the phrase's words as the matched terms (instead of the bigram), so hits are still highlighted
+    def __init__(self, child, terms, boost=1.0):
+        super().__init__(child, boost=boost)
+        self.terms = terms
+
+    def _replacement(self, newchild):
+        return self.__class__(newchild, self.terms, boost=self.boost)
+
+    def term_matchers(self):
+        return (_TermAlias(self, term) for term in self.terms)
+
+
+class _RequireMatcher(RequireMatcher):
+    # whoosh's `skip_to_quality` doesn't check whether the skip already landed on a match
+    def skip_to_quality(self, minquality):
+        skipped = self.a.skip_to_quality(minquality)
+        if self.a.is_active() and self.b.is_active() and self.a.id() != self.b.id():
+            self.child._find_next()
+        return skipped
+
+
+class _ShinglePhraseMatcher(SpanNear2.SpanNear2Matcher):
+    # `SpanNear2`'s matcher, but only the documents containing every bigram have their words' positions checked
+    # (the bigrams are much rarer than the words, so they lead the intersection), the score is still the words'
+    def __init__(self, ms, bigram_ms) -> None:
+        self.ms = ms
+        self.bigram_ms = bigram_ms
+        self.slop = 1
+        self.ordered = True
+        self.mindist = 1
+        isect = _RequireMatcher(
+            make_binary_tree(IntersectionMatcher, ms),
+            make_binary_tree(IntersectionMatcher, bigram_ms),
+        )
+        super(SpanNear2.SpanNear2Matcher, self).__init__(isect)
+
+    def copy(self):
+        return self.__class__(
+            [m.copy() for m in self.ms], [m.copy() for m in self.bigram_ms]
+        )
+
+
+class ShinglePhrase(Phrase):
+    """
+    A `Phrase` that uses the word bigrams in the `phrase_<field>` field (see `SHINGLE_ANALYZER`), if the index has it (see `PhraseSchema`).
+
+    Two word phrases are a single term lookup.
+    Longer phrases only have their words' positions checked in documents that contain every one of their bigrams.
+    Phrases with words containing punctuation (which the analyzers split differently) are checked against the positions as usual.
+    """
+
+    def matcher(self, searcher, context=None):
+        shingle_field = f"phrase_{self.fieldname}"
+        if (
+            self.slop != 1
+            or len(self.words) < 2
+            # every document has the field if the schema does, as switching schemas needs a rebuild
+            or shingle_field not in searcher.schema
+            or not all(_SIMPLE_WORD.match(word) for word in self.words)
+        ):
+            return super().matcher(searcher, context)
+
+        reader = searcher.reader()
+        bigrams = [
+            (shingle_field, f"{first} {second}".encode("utf-8"))
+            for first, second in zip(self.words, self.words[1:])
+        ]
+        if not all(bigram in reader for bigram in bigrams):
+            return NullMatcher()
+        to_bytes = searcher.schema[self.fieldname].to_bytes
+        terms = [(self.fieldname, to_bytes(word)) for word in self.words]
+        if len(bigrams) == 1:
+            return _PhraseTermsMatcher(
+                Term(*bigrams[0]).matcher(searcher, context), terms, boost=self.boost
+            )
+        # the positions are checked anyway, so bigrams that cover every word are enough to narrow the documents down
+        covering = bigrams[::2] if len(bigrams) % 2 else bigrams[::2] + bigrams[-1:]
+        m = _ShinglePhraseMatcher(
+            [Term(*term).matcher(searcher, context) for term in terms],
+            [
+                Term(*bigram).matcher(searcher, searcher.boolean_context())
+                for bigram in covering
+            ],
+        )
+        if self.boost != 1.0:
+            m = WrappingMatcher(m, boost=self.boost)
+        return m
+
+
+# The most terms a wildcard query (e.g. `*wiki*`) is expanded to
+WILDCARD_MAX_TERMS = 1000
+
+
+class KGramIndex:
+    """
+    Maps the k-grams (e.g. `^wi`, `wik`, `iki`, `ki$` for `wiki`) of every term in a segment's `FIELDS` to the terms containing them.
+
+    Wildcard queries use this to find their candidate terms (see `KGramWildcard`),
+    by intersecting the term lists of the pattern's k-grams instead of scanning every term.
+
+    Segments never change, so each segment's index is built once (when it's committed by `MyIndexWriter`,
+    or when it's first needed), and saved next to the segment's files (whoosh deletes it along with the segment).
+    """
+
+    FIELDS = ("content", "title")
+    EXTENSION = ".kgram"
+    VERSION = 1
+
+    def __init__(
+        self, k: int, fields: Dict[str, Tuple[List[str], Dict[str, array]]]
+    ) -> None:
+        self.k = k
+        # fieldname: (sorted terms, {k-gram: sorted indexes of the terms containing it})
+        self.fields = fields
+
+    @staticmethod
+    def grams(text: str, k: int):
+        return {text[i : i + k] for i in range(len(text) - k + 1)}
+
+    @classmethod
+    def build(cls, reader, k: int = 3) -> "KGramIndex":
+        fields = {}
+        for fieldname in cls.FIELDS:
+            if fieldname not in reader.schema:
+                continue
+            terms = [btext.decode() for btext in reader.lexicon(fieldname)]
+            postings: Dict[str, List[int]] = {}
+            for i, term in enumerate(terms):
+                for gram in cls.grams(f"^{term}$", k):
+                    postings.setdefault(gram, []).append(i)
+            fields[fieldname] = (
+                terms,
+                {gram: array("I", ids) for gram, ids in postings.items()},
+            )
+        return cls(k, fields)
+
+    def save(self, storage, filename: str):
+        # written under a temporary name first, so readers never see a partial file
+        temp_name = f"{filename}.{os.getpid()}.tmp"
+        with storage.create_file(temp_name) as f:
+            pickle.dump((self.VERSION, self.k, self.fields), f, pickle.HIGHEST_PROTOCOL)
+        storage.rename_file(temp_name, filename)
+
+    @classmethod
+    def load(cls, storage, filename: str) -> Optional["KGramIndex"]:
+        with storage.open_file(filename) as f:
+            version, k, fields = pickle.load(f)
+        return cls(k, fields) if version == cls.VERSION else None
+
+    @classmethod
+    def for_reader(cls, reader) -> Optional["KGramIndex"]:
+        """Returns the segment reader's k-gram index (loading or building it if needed), or `None` if it isn't a segment reader."""
+        if not hasattr(reader, "segment"):
+            return None
+        segment = reader.segment()
+        segment_id = segment.segment_id()
+        index = _kgram_indexes.get(segment_id)
+        if index is not None:
+            _kgram_indexes.move_to_end(segment_id)
+            return index
+
+        storage = reader.storage()
+        if isinstance(storage, OverlayStorage):  # the segment is a compound file
+            storage = storage.b
+        filename = segment.make_filename(cls.EXTENSION)
+        try:
+            index = cls.load(storage, filename)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            index = None
+        if index is None:
+            index = cls.build(reader)
+            try:
+                index.save(storage, filename)
+            except OSError:
+                pass
+        _kgram_indexes[segment_id] = index
+        while len(_kgram_indexes) > 64:
+            _kgram_indexes.popitem(last=False)
+        return index
+
+    @classmethod
+    def build_missing(cls, storage, indexname: str, schema):
+        """Builds and saves the k-gram index of every segment that doesn't have one yet."""
+        for segment in TOC.read(storage, indexname, schema=schema).segments:
+            filename = segment.make_filename(cls.EXTENSION)
+            if storage.file_exists(filename):
+                continue
+            with SegmentReader(storage, schema, segment) as reader:
+                index = cls.build(reader)
+            index.save(storage, filename)
+            _kgram_indexes[segment.segment_id()] = index
+
+    def candidates(self, fieldname: str, pattern: str) -> Optional[List[str]]:
+        """Returns the terms that may match the glob pattern, or `None` if every term may (i.e. it's too short to have any k-grams)."""
+        if fieldname not in self.fields or "[" in pattern:
+            return None
+        terms, postings = self.fields[fieldname]
+        grams = set()
+        for piece in re.split(r"[*?]", f"^{pattern}$"):
+            grams |= self.grams(piece, self.k)
+        if not grams:
+            return None
+        lists = []
+        for gram in grams:
+            if gram not in postings:
+                return []
+            lists.append(postings[gram])
+        lists.sort(key=len)
+        smallest, others = lists[0], lists[1:]
+
+        def contains(ids: array, i: int) -> bool:
+            j = bisect_left(ids, i)
+            return j < len(ids) and ids[j] == i
+
+        return [terms[i] for i in smallest if all(contains(ids, i) for ids in others)]
+
+
+_kgram_indexes: "OrderedDict[str, KGramIndex]" = OrderedDict()
+
+
+class KGramWildcard(Wildcard):
+    """
+    A `Wildcard` that gets its candidate terms from each segment's `KGramIndex`, instead of scanning every term.
+
+    It's expanded to at most `max_terms` terms.
+    """
+
+    max_terms = WILDCARD_MAX_TERMS
+
+    def _btexts(self, ixreader):
+        field = ixreader.schema[self.fieldname]
+        expression = re.compile(self._get_pattern())
+        expanded = set()
+        for leaf, _ in ixreader.leaf_readers():
+            index = KGramIndex.for_reader(leaf)
+            candidates = (
+                None if index is None else index.candidates(self.fieldname, self.text)
+            )
+            if candidates is None:
+                btexts = super()._btexts(leaf)
+            else:
+                btexts = (
+                    field.to_bytes(text)
+                    for text in candidates
+                    if expression.match(text)
+                )
+            for btext in btexts:
+                if btext not in expanded:
+                    expanded.add(btext)
+                    yield btext
+                    if len(expanded) >= self.max_terms:
+                        return
+
+
+class KGramWildcardPlugin(WildcardPlugin):
+    class WildcardNode(WildcardPlugin.WildcardNode):
+        qclass = KGramWildcard
+
+    nodetype = WildcardNode
+
+
+def query_is_valid(node):
+    if isinstance(node, (Every, _NullQuery)):
+        return False
+    # If the node has subqueries (e.g., a compound query), recursively check them
+    subqueries = [subquery for subquery in node.children()]
+    if not subqueries:
+        return True
+    return any(query_is_valid(subquery) for subquery in subqueries)
+
+
+def query_parser(schema) -> QueryParser:
+    from whoosh.qparser import (
+        GroupPlugin,
+        OperatorsPlugin,
+    )
+
+    # for reference: https://whoosh-reloaded.readthedocs.io/en/latest/parsing.html#overview
+    return SimpleParser(
+        "content",
+        schema=schema,
+        group=OrGroup.factory(0.9),
+        phraseclass=ShinglePhrase,
+        plugins=[
+            KGramWildcardPlugin(),
+            GroupPlugin(),
+            OperatorsPlugin(),
+            OperatorsPlugin(
+                And=r"&", Or=r"\|", AndNot=r"&!", AndMaybe=r"&~", Not=None
+            ),
+            FieldsPlugin(),
+        ],
+    )
+
+
+def parse_query(search_term: str, schema) -> Query:
+    return query_parser(schema).parse(search_term)
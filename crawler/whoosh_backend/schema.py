@@ -0,0 +1,123 @@
+"""
+The index's schema (`MySchema`), and the analyzers its text fields are tokenized with.
+"""
+
+from itertools import chain
+
+from whoosh.analysis import (
+    BiWordFilter,
+    CharsetFilter,
+    Filter,
+    IntraWordFilter,
+    LowercaseFilter,
+    MultiFilter,
+    RegexTokenizer,
+    SubstitutionFilter,
+    Token,
+)
+from whoosh.fields import DATETIME, ID, NUMERIC, TEXT, SchemaClass
+from whoosh.support.charset import accent_map
+
+
+# The default MultiFilter raises an error when there are no tokens, this fixes that
+# Currently unused but here for safekeeping
+class MultiFilter(MultiFilter):
+    def __call__(self, tokens):
+        # Only selects on the first token
+        t = next(tokens, None)
+        if t is not None:
+            filter = self.filters.get(t.mode, self.default_filter)
+            return filter(chain([t], tokens))
+        return []
+
+
+class DuplicateFilter(Filter):
+    def __call__(self, tokens):
+        yielded = set()
+        for t in tokens:
+            t: Token
+            token_hash = (
+                t.positions,
+                t.chars,
+                t.stopped,
+                t.boost,
+                t.removestops,
+                t.mode,
+                getattr(t, "text", getattr(t, "original", "")),
+                getattr(t, "startchar", 0),
+                getattr(t, "endchar", 0),
+            )
+            if token_hash not in yielded:
+                yielded.add(token_hash)
+                yield t
+
+
+class AllFilters(Filter):
+    def __init__(self, *filters, yield_original: bool = True) -> None:
+        assert filters
+        super().__init__()
+        self.yield_original = yield_original
+        self.filters = filters
+
+    def __call__(self, tokens):
+        for t in tokens:
+            if self.yield_original:
+                yield t
+            for f in self.filters:
+                yield from f([t.copy()])
+
+
+# This separates on whitespace, while also stripping surrounding punctuation
+# e.g. `hello.. world..` becomes `hello world`
+WhitespaceTokenizer = RegexTokenizer(
+    expression=r"[^\w]*\s+[^\w]*|[^\w]+$|^[^\w]+", gaps=True
+)
+
+PunctuationFilter = SubstitutionFilter(r"[^\w]+", r"")
+
+SANITIZATION = DuplicateFilter() | LowercaseFilter() | CharsetFilter(accent_map)
+INTRAWORD = IntraWordFilter()
+
+DEFAULT_ANALYZER = (
+    WhitespaceTokenizer | AllFilters(PunctuationFilter, INTRAWORD) | SANITIZATION
+)
+
+# Word bigrams (e.g. `opennic search`), for `ShinglePhrase`.
+# The words are lowercased and accent folded like `DEFAULT_ANALYZER`'s, but not split on punctuation.
+SHINGLE_ANALYZER = (
+    WhitespaceTokenizer | LowercaseFilter() | CharsetFilter(accent_map) | BiWordFilter(" ")
+)
+
+
+class MySchema(SchemaClass):
+    url = ID(stored=True, unique=True, field_boost=0.5)
+    depth = NUMERIC(sortable=True)
+    title = TEXT(
+        stored=True,
+        field_boost=1.5,
+        analyzer=DEFAULT_ANALYZER,
+    )
+    content = TEXT(
+        stored=True,
+        chars=True,
+        analyzer=DEFAULT_ANALYZER,
+    )
+    description = TEXT(
+        stored=True,
+        chars=True,
+        analyzer=DEFAULT_ANALYZER,
+    )
+    created_at = DATETIME(stored=True, sortable=True)
+    last_updated = DATETIME(stored=True, sortable=True)
+    dead_since = DATETIME(stored=True, sortable=True)
+
+
+class PhraseSchema(MySchema):
+    """
+    `MySchema`, plus the word bigrams of `content` for `ShinglePhrase` (enabled by the `INDEX_PHRASE_FIELDS` setting).
+
+    Phrases only use the bigrams if every document has them, so an index only switches to (or from) this schema by being rebuilt.
+    """
+
+    # filled in from `content` by `MyIndexWriter.add_document`
+    phrase_content = TEXT(analyzer=SHINGLE_ANALYZER, phrase=False)
@@ -0,0 +1,401 @@
+"""
+Searching the index: `search` (and `search_many`, `search_packed`), and `warmup`, which gets a process ready to search.
+
+Searches borrow a searcher from a per-index pool (see `_pooled_searcher`), so their readers are only reopened when the index changes.
+"""
+
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from itertools import repeat
+from math import ceil
+import threading
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Dict, Generator, Iterable, List, Optional, Tuple, Union
+
+from whoosh.query import Query
+from whoosh.reading import SegmentReader
+from whoosh.searching import Hit
+
+from crawler.metrics import Metrics, SamplingProfiler
+from crawler.whoosh_backend.filters import reader_filter
+from crawler.whoosh_backend.index import MySearcher, ShardedIndex, _index_settings, _open_index
+from crawler.whoosh_backend.packed import pack_results
+from crawler.whoosh_backend.query import KGramIndex, parse_query, query_is_valid, query_parser
+from crawler.whoosh_backend.spelling import correct_query
+from crawler.whoosh_backend.suggestions import _get_suggester, _suggesters
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+
+# How long each stage of searching takes (parse, search, highlight, spelling), disabled unless `enable_metrics` is called
+METRICS = Metrics(enabled=False, prefix="search_")
+
+
+def enable_metrics(
+    export_path: Optional[str] = None,
+    interval: float = 60,
+    profile_path: Optional[str] = None,
+    profile_interval: float = 0.01,
+):
+    """Starts recording `METRICS`, exporting them to `export_path` (if given) every `interval` seconds (see `Metrics.export`).
+
+    If `profile_path` is given, a `SamplingProfiler` runs too, and its samples are written there along with the metrics.
+    """
+    METRICS.enabled = True
+    profiler = None
+    if profile_path:
+        profiler = SamplingProfiler(profile_interval)
+        profiler.start()
+    if export_path:
+        METRICS.start_exporting(export_path, interval, profiler, profile_path)
+
+
+def hit_to_result(hit: Hit) -> Dict[str, Any]:
+    return {
+        "url": hit["url"],
+        "title": hit["title"],
+        "depth": hit["depth"],
+        "snippet": hit.highlights("content", strict_phrase=True)
+        or hit["description"]
+        or hit["content"][:170],
+    }
+
+
+def _search_page(
+    searcher: MySearcher, query: Query, pagenum: int, pagelen: int = 10
+) -> Dict[str, Any]:
+    if not query_is_valid(query):
+        return {"valid": False}
+
+    with METRICS.time("search"):
+        results_page = searcher.search_page(
+            query,
+            terms=True,
+            pagenum=pagenum,
+            pagelen=pagelen,
+            mask=reader_filter(searcher.reader(), "dead"),
+        )
+    results = results_page.results
+    is_last = results_page.is_last_page()
+    num_results = results_page.pagecount * pagelen if not is_last else ((results_page.pagecount - 1) * pagelen) + results_page.pagelen
+    with METRICS.time("highlight"):
+        hits = [hit_to_result(hit) for hit in results_page]
+    return {
+        "valid": True,
+        "results": hits,
+        "duration": results.runtime,
+        "total": num_results,
+        "exact": is_last,
+        "last": is_last,
+        "maxpage": results_page.pagecount,
+    }
+
+
+def search(search_term: str, storage_path: str, pagenum: int = 1):
+    ix = _open_index(storage_path)
+    if isinstance(ix, ShardedIndex):
+        results = _search_shards(ix, search_term, pagenum)
+    else:
+        with _pooled_searcher(storage_path) as searcher:
+            with METRICS.time("parse"):
+                query = parse_query(search_term, ix.schema)
+            results = _search_page(searcher, query, pagenum)
+
+    if results["valid"]:
+        with METRICS.time("spelling"):
+            results["suggestion"] = correct_query(search_term, storage_path)
+    suggester = _suggesters.get(storage_path)
+    if suggester is not None and results.get("total"):
+        suggester.record_query(search_term)
+    return results
+
+
+def search_many(
+    queries: Iterable[str],
+    storage_path: str,
+    pages: Union[int, Iterable[int]] = 1,
+    cache_size: int = 1024,
+) -> Generator[Dict[str, Any], None, None]:
+    """Runs a batch of searches, yielding each one's results (the same as `search`) in order, as soon as they're ready.
+
+    Unlike calling `search` in a loop, one searcher is used for the whole batch, so it isn't checked for changes between searches,
+    and term statistics (which the searcher caches) are only looked up once per term.
+    The query parser is only built once, and the last `cache_size` parsed queries and results are reused,
+    so repeated search terms aren't parsed again, and repeated (search term, page) pairs aren't searched again
+    (the same dict is yielded again).
+
+    The results are from the index as it was when the batch started.
+
+    Args:
+        queries (Iterable[str]): The search terms.
+        storage_path (str): The index's path.
+        pages (Union[int, Iterable[int]], optional): The page number for every query, or the page number of each query. Defaults to 1.
+        cache_size (int, optional): How many parsed queries and results are kept. Defaults to 1024.
+    """
+    ix = _open_index(storage_path)
+    pages = repeat(pages) if isinstance(pages, int) else pages
+    if isinstance(ix, ShardedIndex):
+        # every shard is searched with its own searcher, so there's nothing to share
+        for search_term, pagenum in zip(queries, pages):
+            results = _search_shards(ix, search_term, pagenum)
+            if results["valid"]:
+                results["suggestion"] = correct_query(search_term, storage_path)
+            yield results
+        return
+
+    parser = query_parser(ix.schema)
+    with _pooled_searcher(storage_path) as searcher:
+        parse = lru_cache(cache_size)(parser.parse)
+
+        @lru_cache(cache_size)
+        def search_page(search_term: str, pagenum: int) -> Dict[str, Any]:
+            results = _search_page(searcher, parse(search_term), pagenum)
+            if results["valid"]:
+                results["suggestion"] = correct_query(search_term, storage_path)
+            return results
+
+        for search_term, pagenum in zip(queries, pages):
+            yield search_page(search_term, pagenum)
+
+
+def search_packed(search_term: str, storage_path: str, pagenum: int = 1) -> bytes:
+    """The same as `search`, but the results are packed into one bytes object (see `pack_results`)."""
+    return pack_results(search(search_term, storage_path, pagenum))
+
+
+# the idle searchers of each index, with the generation they were opened at
+_idle_searchers: Dict[str, List[Tuple[MySearcher, int]]] = {}
+_idle_searchers_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _get_pool() -> "Executor":
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor()
+
+
+@contextmanager
+def _pooled_searcher(storage_path: str) -> Generator[MySearcher, None, None]:
+    """Lends one of the (unsharded) index's idle searchers, or a new one if they're all in use (or the index has changed).
+
+    Searchers keep their segments' readers (and the columns those have read) between searches, and are only reopened when the index changes,
+    but a searcher can't be used by two threads at once, so each one is only lent to one search at a time.
+    Searchers of an older generation are closed and replaced instead of refreshed, as whoosh's `Searcher.refresh`
+    adds the old segments back on top of the new ones (so merged documents would be found twice).
+    """
+    ix = _open_index(storage_path)
+    generation = ix.latest_generation()
+    with _idle_searchers_lock:
+        idle = _idle_searchers.setdefault(storage_path, [])
+        searcher, searcher_generation = idle.pop() if idle else (None, None)
+    if searcher is not None and searcher_generation != generation:
+        searcher.close()
+        searcher = None
+    if searcher is None:
+        searcher = ix.searcher()
+    try:
+        yield searcher
+    finally:
+        with _idle_searchers_lock:
+            idle.append((searcher, generation))
+
+
+def _shard_top_docs(
+    searcher: MySearcher, query: Query, limit: int
+) -> Tuple[int, float, List[Tuple[float, int]]]:
+    """Returns a shard's total hits, runtime and top `limit` (score, docnum) pairs."""
+    results = searcher.search(
+        query, limit=limit, mask=reader_filter(searcher.reader(), "dead")
+    )
+    return (
+        len(results),
+        results.runtime,
+        [(score, docnum) for docnum, score in results.items()],
+    )
+
+
+def _shard_hits(
+    searcher: MySearcher, query: Query, docnums: List[int]
+) -> Dict[int, Dict[str, Any]]:
+    """Returns the results (as in `search`) of the given docnums, with snippets."""
+    results = searcher.search(
+        query, filter=set(docnums), limit=len(docnums), terms=True
+    )
+    return {hit.docnum: hit_to_result(hit) for hit in results}
+
+
+def _search_shards(
+    ix: ShardedIndex,
+    search_term: str,
+    pagenum: int = 1,
+    pagelen: int = 10,
+) -> Dict[str, Any]:
+    """Runs the query on every shard in parallel (on a thread pool), and merges the results.
+
+    Each shard returns its top `pagenum * pagelen` hits, which are merged by score.
+    Scores use each shard's own term statistics, which are close to the whole index's as urls are spread evenly.
+    Snippets are only made for the hits on the requested page, with the same searcher that found them,
+    as a commit (or merge) in between could renumber the shard's documents.
+
+    Returns:
+        Dict[str, Any]: The same as `search`.
+    """
+    query = parse_query(search_term, ix.schema)
+    if not query_is_valid(query):
+        return {"valid": False}
+    pool = _get_pool()
+    with ExitStack() as stack:
+        searchers = [
+            stack.enter_context(_pooled_searcher(ix.shard_path(i)))
+            for i in range(ix.shards)
+        ]
+        return _merge_shard_results(pool, searchers, query, pagenum, pagelen)
+
+
+def _merge_shard_results(
+    pool: "Executor",
+    searchers: List[MySearcher],
+    query: Query,
+    pagenum: int,
+    pagelen: int,
+) -> Dict[str, Any]:
+    with METRICS.time("search"):
+        tops = list(
+            pool.map(
+                _shard_top_docs,
+                searchers,
+                repeat(query),
+                repeat(pagenum * pagelen),
+            )
+        )
+    total = sum(top[0] for top in tops)
+    runtime = max((top[1] for top in tops), default=0)
+    pagecount = ceil(total / pagelen)
+    pagenum = min(pagecount, pagenum)
+    offset = max(0, (pagenum - 1) * pagelen)
+    # ties are broken by shard and docnum, so the order is stable between pages
+    ranked = sorted(
+        (-score, shard, docnum)
+        for shard, top in enumerate(tops)
+        for score, docnum in top[2]
+    )[offset : offset + pagelen]
+
+    wanted: Dict[int, List[int]] = {}
+    for _, shard, docnum in ranked:
+        wanted.setdefault(shard, []).append(docnum)
+    shards = list(wanted)
+    with METRICS.time("highlight"):
+        rendered = dict(
+            zip(
+                shards,
+                pool.map(
+                    _shard_hits,
+                    [searchers[shard] for shard in shards],
+                    repeat(query),
+                    [wanted[shard] for shard in shards],
+                ),
+            )
+        )
+    is_last = pagecount == 0 or pagenum == pagecount
+    return {
+        "valid": True,
+        "results": [rendered[shard][docnum] for _, shard, docnum in ranked],
+        "duration": runtime,
+        # like `search`, the total is only exact on the last page
+        "total": total if is_last else pagecount * pagelen,
+        "exact": is_last,
+        "last": is_last,
+        "maxpage": pagecount,
+    }
+
+
+# the parts of a segment that (almost) every search reads: the term dictionary, and the columns (field lengths, stored fields...)
+WARMUP_EXTENSIONS = (".trm", ".col")
+
+
+def _read_segment_files(leaf: SegmentReader, extensions: Tuple[str, ...]) -> int:
+    """Reads the segment's files (or the parts of its compound file) with the given extensions, so the OS has them cached.
+
+    Returns:
+        int: The number of bytes read.
+    """
+    storage = leaf.storage()
+    prefix = leaf.segment().make_filename("")
+    read = 0
+    for name in storage.list():
+        if name.startswith(prefix) and name.endswith(extensions):
+            with storage.open_file(name) as f:
+                while chunk := f.read(1 << 20):
+                    read += len(chunk)
+    return read
+
+
+def warmup(
+    storage_path: Optional[str] = None, queries_path: Optional[str] = None
+) -> Dict[str, float]:
+    """Gets this process ready to search the index, so its first searches are as fast as the ones after them.
+
+    A searcher is opened for the index (or each of its shards), and kept for the searches after it (see `_pooled_searcher`).
+    Every segment's term dictionary and columns are read (so they're in the OS' cache), and the columns searches use
+    (field lengths, stored fields and the dead pages' bitmaps, see `reader_filter`) are loaded by the searcher's readers.
+    The segments' k-gram indexes (see `KGramIndex`), the query parser, the spelling dictionary (see `correct_query`)
+    and the suggestions (see `suggest`) are loaded too, and if `queries_path` is given, each of its lines is searched.
+
+    Returns:
+        Dict[str, float]: How long each step took, and in `total` the whole warmup, in seconds,
+            along with `bytes` (the number of bytes read) and `searched` (the number of queries searched).
+    """
+    start = perf_counter()
+    if storage_path is None:
+        storage_path = _index_settings()[0]
+    timings: Dict[str, float] = Counter(bytes=0, searched=0)
+
+    @contextmanager
+    def timed(step: str):
+        step_start = perf_counter()
+        yield
+        timings[step] += perf_counter() - step_start
+
+    with timed("open"):
+        ix = _open_index(storage_path)
+    paths = (
+        [ix.shard_path(i) for i in range(ix.shards)]
+        if isinstance(ix, ShardedIndex)
+        else [storage_path]
+    )
+    for path in paths:
+        opened = perf_counter()
+        with _pooled_searcher(path) as searcher:
+            reader = searcher.reader()
+            timings["open"] += perf_counter() - opened
+            leaves = [leaf for leaf, _ in reader.leaf_readers() if leaf.doc_count_all()]
+            with timed("files"):
+                for leaf in leaves:
+                    timings["bytes"] += _read_segment_files(leaf, WARMUP_EXTENSIONS)
+            with timed("columns"):
+                for leaf in leaves:
+                    leaf.stored_fields(0)
+                    for fieldname in leaf.schema.scorable_names():
+                        leaf.doc_field_length(0, fieldname)
+                reader_filter(reader, "dead")
+            with timed("kgrams"):
+                for leaf in leaves:
+                    KGramIndex.for_reader(leaf)
+
+    with timed("parser"):
+        parse_query("warmup", ix.schema)
+    with timed("spelling"):
+        correct_query("warmup", storage_path)
+    with timed("suggestions"):
+        _get_suggester(storage_path).refresh(wait=True)
+    if queries_path is not None:
+        with timed("queries"), open(queries_path, encoding="utf-8") as f:
+            for line in f:
+                if search_term := line.strip():
+                    search(search_term, storage_path)
+                    timings["searched"] += 1
+    timings["total"] = perf_counter() - start
+    return dict(timings)
@@ -0,0 +1,256 @@
+"""
+The search service (`serve`), which runs searches in a pool of worker processes for other processes (e.g. `web.rs`), and its client (`SearchClient`).
+"""
+
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import struct
+import sys
+from typing import Any, Dict, List, Optional
+
+from crawler.whoosh_backend.index import _index_settings
+from crawler.whoosh_backend.packed import PACKED_MAGIC, pack_results
+from crawler.whoosh_backend.searching import METRICS, enable_metrics, search, warmup
+from crawler.whoosh_backend.suggestions import suggest
+
+
+# The search service (`python -m crawler.whoosh_backend serve`).
+# Every message, in both directions, is a frame: a 4 byte (big-endian) length, then that many bytes of UTF-8 JSON.
+# Requests are `{"q": <search term>, "p": <page number, optional>, "f": <"json" (the default) or "packed">}`.
+# Responses are what `search` returns, as JSON or packed (see `pack_results`).
+# Suggestion requests are `{"s": <prefix>, "k": <number of suggestions, optional>}`, and get back a JSON list of suggestions.
+# If a request can't be answered, the response is `{"valid": false, "error": <message>}`, always as JSON.
+# A connection can be reused for any number of requests.
+_FRAME_HEADER = struct.Struct(">I")
+
+
+def _recv_exactly(conn: socket.socket, size: int) -> Optional[bytes]:
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(conn: socket.socket) -> Optional[bytes]:
+    """Returns the next frame's payload, or `None` if the connection was closed."""
+    header = _recv_exactly(conn, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    return _recv_exactly(conn, _FRAME_HEADER.unpack(header)[0])
+
+
+def send_frame(conn: socket.socket, payload: bytes):
+    conn.sendall(_FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def _handle_request(frame: bytes, storage_path: str) -> bytes:
+    with METRICS.time("request"):
+        return _handle_request_frame(frame, storage_path)
+
+
+def _handle_request_frame(frame: bytes, storage_path: str) -> bytes:
+    try:
+        request = json.loads(frame)
+        if "s" in request:
+            suggestions = suggest(request["s"], storage_path, int(request.get("k", 10)))
+            return json.dumps(suggestions).encode()
+        results = search(request["q"], storage_path, int(request.get("p", 1)))
+        if request.get("f") == "packed":
+            return pack_results(results)
+        return json.dumps(results).encode()
+    except Exception as e:
+        return json.dumps(
+            {"valid": False, "error": f"{type(e).__name__}: {e}"}
+        ).encode()
+
+
+def _search_worker(
+    listener: socket.socket,
+    storage_path: str,
+    metrics_path: Optional[str] = None,
+    metrics_interval: float = 60,
+    profile_path: Optional[str] = None,
+    warmup_queries: Optional[str] = None,
+):
+    # the parent process handles ctrl+c, and stops its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if metrics_path or profile_path:
+        enable_metrics(metrics_path, metrics_interval, profile_path)
+    # warming up before accepting connections keeps the first requests fast.
+    # Each worker does its own, the searchers' files can't be shared with forked processes (they'd share their positions)
+    warmup(storage_path, warmup_queries)
+    while True:
+        conn, _ = listener.accept()
+        with conn:
+            try:
+                while (frame := recv_frame(conn)) is not None:
+                    send_frame(conn, _handle_request(frame, storage_path))
+            except OSError:
+                # the client went away mid-request
+                pass
+
+
+def serve(
+    storage_path: Optional[str] = None,
+    socket_path: str = "search.sock",
+    workers: Optional[int] = None,
+    metrics_path: Optional[str] = None,
+    metrics_interval: float = 60,
+    profile_path: Optional[str] = None,
+    warmup_queries: Optional[str] = None,
+):
+    """Serves searches over a Unix socket, until interrupted.
+
+    Each of the `workers` processes keeps the index open, and handles one connection at a time,
+    so as many searches can run at once as there are workers (`os.cpu_count()` by default).
+    Workers that die are restarted. Workers only accept connections once they've warmed up (see `warmup`),
+    searching the lines of `warmup_queries` if it's given.
+
+    If `metrics_path` or `profile_path` is given, each worker records its `METRICS` (and samples its stacks),
+    and exports them every `metrics_interval` seconds, to the path with the worker's number added (e.g. `search-0.prom`).
+
+    See `SearchClient` for a client, and the comment above `recv_frame` for the protocol.
+    """
+    if storage_path is None:
+        storage_path = _index_settings()[0]
+    workers = workers or os.cpu_count() or 1
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.connect(socket_path)
+        except OSError:
+            # left behind by a server that didn't shut down cleanly
+            os.unlink(socket_path)
+        else:
+            raise ValueError(f"A search service is already listening on {socket_path}.")
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(workers * 16)
+    # the workers inherit the listening socket, so they need to be forked
+    context = multiprocessing.get_context("fork")
+
+    def worker_path(path: Optional[str], worker: int) -> Optional[str]:
+        if not path:
+            return None
+        root, extension = os.path.splitext(path)
+        return f"{root}-{worker}{extension}"
+
+    def start_worker(worker: int) -> multiprocessing.Process:
+        process = context.Process(
+            target=_search_worker,
+            args=(
+                listener,
+                storage_path,
+                worker_path(metrics_path, worker),
+                metrics_interval,
+                worker_path(profile_path, worker),
+                warmup_queries,
+            ),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    processes = [start_worker(worker) for worker in range(workers)]
+    print(
+        f"Serving {storage_path} on {socket_path} with {workers} workers.", flush=True
+    )
+    try:
+        while True:
+            multiprocessing.connection.wait([p.sentinel for p in processes])
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    print(
+                        f"Search worker {process.pid} exited with code {process.exitcode}, restarting it."
+                    )
+                    processes[i] = start_worker(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        listener.close()
+        os.unlink(socket_path)
+
+
+class SearchClient:
+    """
+    Sends searches to a `serve` process.
+
+    The connection is kept open between searches (and reopened if it's lost), so one client shouldn't be shared between threads.
+    """
+
+    def __init__(
+        self, socket_path: str = "search.sock", timeout: Optional[float] = None
+    ) -> None:
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.conn: Optional[socket.socket] = None
+
+    def _connect(self) -> socket.socket:
+        if self.conn is None:
+            self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.conn.settimeout(self.timeout)
+            self.conn.connect(self.socket_path)
+        return self.conn
+
+    def _request(self, payload: bytes) -> Optional[bytes]:
+        conn = self._connect()
+        send_frame(conn, payload)
+        return recv_frame(conn)
+
+    def search(self, search_term: str, pagenum: int = 1) -> Dict[str, Any]:
+        """The same as `search`, but run by the service."""
+        return json.loads(self._search({"q": search_term, "p": pagenum}))
+
+    def search_packed(self, search_term: str, pagenum: int = 1) -> bytes:
+        """The same as `search_packed`, but run by the service."""
+        response = self._search({"q": search_term, "p": pagenum, "f": "packed"})
+        if not response.startswith(PACKED_MAGIC):
+            raise ValueError(json.loads(response)["error"])
+        return response
+
+    def suggest(self, prefix: str, k: int = 10) -> List[str]:
+        """The same as `suggest`, but run by the service."""
+        response = json.loads(self._search({"s": prefix, "k": k}))
+        if isinstance(response, dict):
+            raise ValueError(response["error"])
+        return response
+
+    def _search(self, request: Dict[str, Any]) -> bytes:
+        payload = json.dumps(request).encode()
+        try:
+            response = self._request(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            response = None
+        if response is None:
+            # the worker was restarted (or the connection timed out), try once more on a new connection
+            self.close()
+            response = self._request(payload)
+            if response is None:
+                raise ConnectionError("The search service closed the connection.")
+        return response
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
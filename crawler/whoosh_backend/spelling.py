@@ -0,0 +1,393 @@
+"""
+"Did you mean" suggestions (`correct_query`), from a precomputed dictionary of the index's terms (`SpellingDictionary`).
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import os
+import re
+import struct
+import sys
+import threading
+from time import time
+from typing import Callable, Dict, Generator, List, Optional, Set, Tuple, Union
+from zlib import crc32
+
+from whoosh.support.charset import accent_map
+
+from crawler.whoosh_backend.index import MyFileIndex, ShardedIndex, _file_indexes, _open_index
+from crawler.whoosh_backend.suggestions import _segment_frequencies
+
+
+def _deletes(word: str, distance: int) -> List[Set[str]]:
+    """Returns the strings made by deleting 0, 1, ... up to `distance` characters from `word` (each only in the first set it's in)."""
+    levels = [{word}]
+    seen = {word}
+    for _ in range(distance):
+        level = {w[:i] + w[i + 1 :] for w in levels[-1] for i in range(len(w))} - seen
+        seen |= level
+        levels.append(level)
+    return levels
+
+
+def _edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Returns the number of edits (insertions, deletions, substitutions and swaps of adjacent characters) between `a` and `b`,
+    or `max_distance + 1` if there are more than `max_distance`."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    # only the parts between the common prefix and suffix need comparing
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start : len(a) - end], b[start : len(b) - end]
+    if not a or not b:
+        return min(len(a) + len(b), max_distance + 1)
+    before_previous: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (a[i - 1] != b[j - 1]),
+            )
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        before_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+# Words in queries that are checked for typos, i.e. not numbers, field names (`title:`) or wildcards
+_QUERY_WORD = re.compile(r"(?<![\w*?])[^\W\d_]{3,}(?![\w*?:])")
+_QUERY_OPERATORS = frozenset(("AND", "OR", "NOT", "ANDNOT", "ANDMAYBE"))
+
+
+class SpellingDictionary:
+    """
+    A SymSpell-style dictionary of the terms in the `title` and `content` fields, for correcting typos in queries.
+
+    Every term (with a document frequency of at least `min_frequency`) is stored under every string made by deleting up to `MAX_DISTANCE`
+    characters from its first `PREFIX_LENGTH` characters, e.g. `search` is stored under `search`, `earch`, `sarch`, ..., `arch`, `rch`, ...
+    A word's candidate corrections are then the terms stored under the word's own deletes (a few dozen lookups, instead of comparing it with every term),
+    and the closest (then most frequent) candidate is the correction.
+
+    The deletes are stored by their CRC-32, in one sorted array of `hash << 32 | term number`,
+    so the dictionary is a few flat arrays, which are saved and loaded in one go (see `save`).
+    Hash collisions only add candidates, which are all checked with the actual edit distance.
+    """
+
+    FIELDS = ("title", "content")
+    FILENAME = "spelling_{}.dict"
+    _FILENAME = re.compile(r"spelling_(\d+)\.dict")
+    MAX_DISTANCE = 2
+    PREFIX_LENGTH = 7
+    MAGIC = b"SLS"
+    VERSION = 1
+    _HEADER = struct.Struct("<3sBII")
+
+    def __init__(self, terms: List[str], frequencies: array, keys: array) -> None:
+        # sorted, with their document frequencies
+        self.terms = terms
+        self.frequencies = frequencies
+        self.keys = keys
+
+    @classmethod
+    def build(cls, totals: Counter, min_frequency: int = 2) -> "SpellingDictionary":
+        """Builds the dictionary from the document frequency of every term (as utf-8)."""
+        counts = {
+            text: n
+            for term, n in totals.items()
+            if n >= min_frequency and (text := term.decode()).isalpha()
+        }
+        terms = sorted(counts)
+        frequencies = array("I", (min(counts[t], 0xFFFFFFFF) for t in terms))
+        # bucketed by the hash's top byte, so only one bucket at a time is sorted as a list (of Python ints, ~5x the size)
+        buckets = [array("Q") for _ in range(256)]
+        for i, term in enumerate(terms):
+            for level in _deletes(term[: cls.PREFIX_LENGTH], cls.MAX_DISTANCE):
+                for delete in level:
+                    h = crc32(delete.encode())
+                    buckets[h >> 24].append(h << 32 | i)
+        keys = array("Q")
+        for b in range(256):
+            keys.extend(sorted(buckets[b]))
+            buckets[b] = None
+        return cls(terms, frequencies, keys)
+
+    def save(self, path: str):
+        """Saves the dictionary to `path` (replacing it atomically)."""
+        frequencies, keys = array("I", self.frequencies), array("Q", self.keys)
+        if sys.byteorder == "big":
+            frequencies.byteswap()
+            keys.byteswap()
+        terms = "\n".join(self.terms).encode()
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(
+                self._HEADER.pack(self.MAGIC, self.VERSION, len(frequencies), len(keys))
+            )
+            f.write(frequencies.tobytes())
+            f.write(keys.tobytes())
+            f.write(terms)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["SpellingDictionary"]:
+        """Loads a saved dictionary, or returns `None` if there isn't one (or it's from a different version)."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < cls._HEADER.size:
+            return None
+        magic, version, term_count, key_count = cls._HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            return None
+        offset = cls._HEADER.size
+        frequencies = array("I", data[offset : offset + term_count * 4])
+        offset += term_count * 4
+        keys = array("Q", data[offset : offset + key_count * 8])
+        offset += key_count * 8
+        if sys.byteorder == "big":
+            frequencies.byteswap()
+            keys.byteswap()
+        terms = data[offset:].decode().split("\n") if term_count else []
+        return cls(terms, frequencies, keys)
+
+    def _candidates(self, delete: str) -> Generator[int, None, None]:
+        key = crc32(delete.encode()) << 32
+        keys = self.keys
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i] >> 32 == key >> 32:
+            yield keys[i] & 0xFFFFFFFF
+            i += 1
+
+    def closest(self, word: str) -> Tuple[Optional[str], Tuple[int, int]]:
+        """Returns the closest (then most frequent) term to `word` (which should be lowercased and accent folded), and its (distance, -frequency).
+
+        The term is `word` itself if it's a term, or `None` if no term is close enough."""
+        i = bisect_left(self.terms, word)
+        if i < len(self.terms) and self.terms[i] == word:
+            return word, (0, -self.frequencies[i])
+        # short words have too many neighbours to correct them any further
+        max_distance = 1 if len(word) <= 4 else self.MAX_DISTANCE
+        best, best_key = None, (max_distance + 1, 0)
+        seen = set()
+        levels = _deletes(word[: self.PREFIX_LENGTH], max_distance)
+        for deleted, level in enumerate(levels):
+            # terms found by deleting more characters than the best one's distance can't be any closer
+            if deleted > best_key[0]:
+                break
+            for delete in level:
+                for i in self._candidates(delete):
+                    if i in seen:
+                        continue
+                    seen.add(i)
+                    # only candidates at most as close as the best so far can replace it
+                    distance = _edit_distance(word, self.terms[i], best_key[0])
+                    key = (distance, -self.frequencies[i])
+                    if key < best_key:
+                        best, best_key = self.terms[i], key
+        return best, best_key
+
+    def correct_word(self, word: str) -> Optional[str]:
+        """Returns the closest (then most frequent) term to `word` (which should be lowercased and accent folded),
+        `word` itself if it's a term, or `None` if no term is close enough."""
+        return self.closest(word)[0]
+
+    def correct(self, search_term: str) -> Optional[str]:
+        """Returns the search term with its typos corrected, or `None` if it has none (or they can't be corrected)."""
+        return _correct_words(search_term, self.correct_word)
+
+    @classmethod
+    def newest(cls, storage) -> Optional[Tuple[int, str]]:
+        """Returns the generation and filename of the newest dictionary saved in the index's storage, or `None` if there isn't one."""
+        saved = [
+            (int(match.group(1)), filename)
+            for filename in storage.list()
+            if (match := cls._FILENAME.fullmatch(filename))
+        ]
+        return max(saved, default=None)
+
+    @classmethod
+    def build_latest(
+        cls, storage, indexname: str, schema, interval: float = 60, min_frequency: int = 2
+    ) -> bool:
+        """Builds and saves the dictionary of the index's latest generation (as `spelling_<generation>.dict`), and deletes the older ones.
+
+        Writers start this in a background thread when they commit (see `build_in_background`),
+        so processes that only search (e.g. `serve`'s workers) never build a dictionary, they load the newest one.
+        Nothing is built if the newest dictionary is less than `interval` seconds old (the crawler commits all the time),
+        and only the segments that are new since the last build (in this process) are read.
+        The dictionary is saved and the older ones deleted while holding the index's write lock, so processes writing to the same index don't race each other.
+        If another writer has the lock, nothing is saved, and the next commit tries again.
+
+        Returns:
+            bool: Whether a dictionary was saved.
+        """
+        newest = cls.newest(storage)
+        if newest is not None and time() - storage.file_modified(newest[1]) < interval:
+            return False
+        ix = MyFileIndex(storage, schema=schema, indexname=indexname)
+        generation = ix.latest_generation()
+        if newest is not None and newest[0] >= generation:
+            return False
+        segments = _segment_frequencies(
+            ix, cls.FIELDS, _spelling_frequencies.get(storage.folder, {})
+        )
+        _spelling_frequencies[storage.folder] = segments
+        totals = Counter()
+        for counts in segments.values():
+            totals.update(counts)
+        dictionary = cls.build(totals, min_frequency)
+
+        lock = ix.lock("WRITELOCK")
+        if not lock.acquire():
+            return False
+        try:
+            # another writer may have saved a newer one while this one was built
+            newest = cls.newest(storage)
+            if newest is not None and newest[0] >= generation:
+                return False
+            filename = cls.FILENAME.format(generation)
+            dictionary.save(os.path.join(storage.folder, filename))
+            for name in storage.list():
+                if cls._FILENAME.fullmatch(name) and name != filename:
+                    try:
+                        storage.delete_file(name)
+                    except OSError:  # e.g. it's open on Windows, it's deleted by the next build
+                        pass
+        finally:
+            lock.release()
+        return True
+
+    @classmethod
+    def build_in_background(cls, storage, indexname: str, schema) -> bool:
+        """Runs `build_latest` in a daemon thread, unless it's already running for this index in this process.
+
+        Building reads every new segment's terms and sorts millions of keys (seconds, for a big index), so commits don't wait for it.
+
+        Returns:
+            bool: Whether a thread was started.
+        """
+        with _spelling_builds_lock:
+            building = _spelling_builds.get(storage.folder)
+            if building is not None and building.is_alive():
+                return False
+            building = _spelling_builds[storage.folder] = threading.Thread(
+                target=cls.build_latest, args=(storage, indexname, schema), daemon=True
+            )
+            building.start()
+        return True
+
+
+def _correct_words(
+    search_term: str, correct_word: Callable[[str], Optional[str]]
+) -> Optional[str]:
+    """Returns the search term with its words corrected by `correct_word`, or `None` if none of them were.
+
+    Only plain words are corrected, operators, field names, wildcards and numbers are left alone.
+    """
+    corrected = False
+
+    def correct_match(match: re.Match) -> str:
+        nonlocal corrected
+        word = match.group()
+        if word in _QUERY_OPERATORS:
+            return word
+        normalized = word.lower().translate(accent_map)
+        correction = correct_word(normalized)
+        if correction is None or correction == normalized:
+            return word
+        corrected = True
+        return correction
+
+    correction = _QUERY_WORD.sub(correct_match, search_term)
+    return correction if corrected else None
+
+
+# the document frequencies of the segments of the indexes this process writes to (by storage folder), for `SpellingDictionary.build_latest`
+_spelling_frequencies: Dict[str, Dict[str, Counter]] = {}
+# the threads running `SpellingDictionary.build_latest`, by storage folder
+_spelling_builds: Dict[str, threading.Thread] = {}
+_spelling_builds_lock = threading.Lock()
+
+
+class SpellingCorrector:
+    """
+    Keeps the newest `SpellingDictionary` of an index (of each shard, if it's sharded) loaded, for "did you mean" suggestions.
+
+    Dictionaries are built by the processes writing to the index, in the background after they commit (see `SpellingDictionary.build_latest`),
+    so searching processes never build one. At most every `check_interval` seconds, the newest saved dictionary is loaded, if it's changed.
+    For a sharded index, a word is corrected to the closest (then most frequent) term in any shard's dictionary.
+
+    Use `correct_query`, which keeps one corrector per index.
+    """
+
+    def __init__(
+        self, ix: Union[MyFileIndex, "ShardedIndex"], check_interval: float = 10
+    ) -> None:
+        self.ix = ix
+        self.check_interval = check_interval
+        self.dictionaries: List[SpellingDictionary] = []
+        # the path and dictionary loaded from each shard, by the shard's folder
+        self._loaded: Dict[str, Tuple[str, SpellingDictionary]] = {}
+        self._checked = 0.0
+
+    def refresh(self, force: bool = False):
+        """Loads the newest saved dictionaries, if they've changed (checking at most every `check_interval` seconds)."""
+        now = time()
+        if not force and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        for index in _file_indexes(self.ix):
+            folder = index.storage.folder
+            newest = SpellingDictionary.newest(index.storage)
+            if newest is None:
+                continue
+            path = os.path.join(folder, newest[1])
+            if folder in self._loaded and self._loaded[folder][0] == path:
+                continue
+            # `None` if a newer one replaced it since it was listed, that one is loaded next time
+            dictionary = SpellingDictionary.load(path)
+            if dictionary is not None:
+                self._loaded[folder] = (path, dictionary)
+        self.dictionaries = [dictionary for _, dictionary in self._loaded.values()]
+
+    def correct_word(self, word: str) -> Optional[str]:
+        best, best_key = None, None
+        for dictionary in self.dictionaries:
+            term, key = dictionary.closest(word)
+            if term is not None and (best_key is None or key < best_key):
+                best, best_key = term, key
+        return best
+
+    def correct(self, search_term: str) -> Optional[str]:
+        self.refresh()
+        if not self.dictionaries:
+            return None
+        return _correct_words(search_term, self.correct_word)
+
+
+_spelling_correctors: Dict[str, SpellingCorrector] = {}
+
+
+def correct_query(search_term: str, storage_path: str) -> Optional[str]:
+    """Returns the search term with its typos corrected (see `SpellingDictionary`), or `None` if it has none.
+
+    Until a writer has saved the index's dictionary (see `SpellingDictionary.build_latest`), this returns `None`.
+    """
+    corrector = _spelling_correctors.get(storage_path)
+    if corrector is None:
+        corrector = _spelling_correctors[storage_path] = SpellingCorrector(
+            _open_index(storage_path)
+        )
+    return corrector.correct(search_term)
@@ -0,0 +1,203 @@
+"""
+Type-ahead suggestions (`suggest`), from the index's terms and from recent queries.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+from heapq import nlargest
+from itertools import groupby
+import threading
+from time import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Union
+
+from whoosh.support.charset import accent_map
+
+from crawler.whoosh_backend.index import MyFileIndex, ShardedIndex, _open_index
+
+
+def _segment_frequencies(
+    ix: Union[MyFileIndex, "ShardedIndex"],
+    fieldnames: Iterable[str],
+    cached: Dict[str, Counter],
+) -> Dict[str, Counter]:
+    """Returns the document frequency of every term in the fields, per segment (by segment id).
+
+    Segments never change, so the counts of segments that are in `cached` are reused.
+    """
+    segments: Dict[str, Counter] = {}
+    with ix.reader() as reader:
+        for leaf, _ in reader.leaf_readers():
+            if not leaf.doc_count_all():  # e.g. an empty index
+                continue
+            segment_id = leaf.segment().segment_id()
+            counts = cached.get(segment_id)
+            if counts is None:
+                counts = Counter()
+                for fieldname in fieldnames:
+                    for text, info in leaf.iter_field(fieldname):
+                        counts[text] += info.doc_frequency()
+            segments[segment_id] = counts
+    return segments
+
+
+class SuggestionTable(NamedTuple):
+    """The suggestable terms of one generation of an index, sorted, with their weights and the precomputed top terms of short prefixes."""
+
+    terms: List[str]
+    weights: array
+    top: Dict[str, List[int]]
+
+
+class Suggester:
+    """
+    Type-ahead suggestions, from the terms in the `title` and `content` fields and from recent queries.
+
+    Terms are weighted by their document frequency (and only kept if it's at least `min_frequency`).
+    They're kept in one sorted list, with a parallel array of weights, so the terms with a given prefix are a contiguous range, found by bisection.
+    The top `k` terms for every prefix of up to `PRECOMPUTED_PREFIX` characters (the largest ranges) are precomputed.
+
+    Recent queries (that had results) are weighted by how often they were searched for, times `query_weight`.
+
+    When the index's generation has changed (checking at most every `check_interval` seconds), a new `SuggestionTable` is built
+    in a background thread (document frequencies are counted per segment, so only the new segments are read),
+    and swapped in once it's ready. Until then, the old one is used.
+    Use the `suggest` function, which keeps one suggester per index.
+    """
+
+    FIELDS = ("title", "content")
+    PRECOMPUTED_PREFIX = 3
+
+    def __init__(
+        self,
+        ix: Union[MyFileIndex, "ShardedIndex"],
+        min_frequency: int = 2,
+        max_queries: int = 1000,
+        query_weight: int = 10,
+        k: int = 10,
+        check_interval: float = 1,
+    ) -> None:
+        self.ix = ix
+        self.min_frequency = min_frequency
+        self.query_weight = query_weight
+        self.k = k
+        self.check_interval = check_interval
+        self.generation = None
+        self._checked = 0.0
+        self._segments: Dict[str, Counter] = {}
+        self._building: Optional[threading.Thread] = None
+        self.table = SuggestionTable([], array("Q"), {})
+        self.queries: Counter = Counter()
+        self._recent_queries: deque = deque(maxlen=max_queries)
+
+    def refresh(self, wait: bool = False) -> bool:
+        """Starts building the suggestions of the index's latest generation, if it's changed.
+
+        Args:
+            wait (bool, optional): Wait for them to be built, instead of building them in the background. Defaults to False.
+
+        Returns:
+            bool: Whether a new table is being (or was) built.
+        """
+        now = time()
+        if not wait and now - self._checked < self.check_interval:
+            return False
+        self._checked = now
+        generation = self.ix.latest_generation()
+        if generation == self.generation:
+            return False
+        if self._building is None or not self._building.is_alive():
+            self._building = threading.Thread(
+                target=self._build, args=(generation,), daemon=True
+            )
+            self._building.start()
+        if wait:
+            self._building.join()
+        return True
+
+    def _build(self, generation):
+        self._segments = _segment_frequencies(self.ix, self.FIELDS, self._segments)
+        totals = Counter()
+        for counts in self._segments.values():
+            totals.update(counts)
+        # utf-8 sorts the same as the strings it encodes
+        encoded = sorted(t for t, n in totals.items() if n >= self.min_frequency)
+        terms = [t.decode() for t in encoded]
+        weights = array("Q", (totals[t] for t in encoded))
+        top = {}
+        for length in range(1, self.PRECOMPUTED_PREFIX + 1):
+            # the terms are sorted, so the terms sharing a prefix are consecutive
+            for prefix, group in groupby(
+                range(len(terms)), key=lambda i: terms[i][:length]
+            ):
+                if len(prefix) == length:
+                    top[prefix] = nlargest(self.k, group, key=weights.__getitem__)
+        # searches read `table` once, so they see either the old table or the new one
+        self.table = SuggestionTable(terms, weights, top)
+        self.generation = generation
+
+    def record_query(self, search_term: str):
+        query = " ".join(search_term.lower().split())
+        if not query:
+            return
+        if len(self._recent_queries) == self._recent_queries.maxlen:
+            oldest = self._recent_queries[0]
+            self.queries[oldest] -= 1
+            if not self.queries[oldest]:
+                del self.queries[oldest]
+        self._recent_queries.append(query)
+        self.queries[query] += 1
+
+    def _top_terms(self, table: SuggestionTable, prefix: str, k: int) -> List[int]:
+        if k <= self.k and prefix in table.top:
+            return table.top[prefix][:k]
+        start = bisect_left(table.terms, prefix)
+        end = bisect_left(table.terms, prefix + "\U0010ffff", start)
+        return nlargest(k, range(start, end), key=table.weights.__getitem__)
+
+    def suggest(self, prefix: str, k: int = 10) -> List[str]:
+        """Returns up to `k` completions of `prefix`, best first.
+
+        Only the last word is completed, the words before it are only lowercased.
+        """
+        if not prefix.strip():
+            return []
+        head, _, last = prefix.rpartition(" ")
+        last = last.lower().translate(accent_map)
+        candidates: Dict[str, int] = {}
+        table = self.table
+        if last:
+            # normalised like the recorded queries, so the same suggestion isn't made twice
+            head = " ".join(head.lower().split())
+            head = f"{head} " if head else ""
+            for i in self._top_terms(table, last, k):
+                candidates[head + table.terms[i]] = table.weights[i]
+        lowered = " ".join(prefix.lower().split())
+        # a snapshot, as `search` records queries from other threads
+        for query, count in list(self.queries.items()):
+            if query.startswith(lowered):
+                weight = count * self.query_weight
+                candidates[query] = max(candidates.get(query, 0), weight)
+        return nlargest(k, candidates, key=candidates.__getitem__)
+
+
+_suggesters: Dict[str, Suggester] = {}
+
+
+def _get_suggester(storage_path: str) -> Suggester:
+    suggester = _suggesters.get(storage_path)
+    if suggester is None:
+        suggester = _suggesters[storage_path] = Suggester(_open_index(storage_path))
+    return suggester
+
+
+def suggest(prefix: str, storage_path: str, k: int = 10) -> List[str]:
+    """Returns up to `k` suggestions for what's being typed (see `Suggester`).
+
+    The suggester starts building its terms on the first call (in the background, so until they're ready only recent queries are suggested),
+    and rebuilds them (only reading new segments) once the index changes.
+    From then on, `search` records the queries it's given for this index.
+    """
+    suggester = _get_suggester(storage_path)
+    suggester.refresh()
+    return suggester.suggest(prefix, k)
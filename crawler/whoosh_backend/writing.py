@@ -0,0 +1,256 @@
+"""
+The index's writers (`MyIndexWriter`, and `MyMpWriter` for analyzing documents in several processes), and the merge policy they commit with.
+
+`MyFileIndex.writer` imports this module when it's first called, so processes that only search don't import whoosh's multiprocessing writer.
+"""
+
+from itertools import groupby
+from math import log
+from typing import Any, Dict, Iterable, List, Optional
+
+from typing_extensions import override
+from whoosh.multiproc import MpWriter
+from whoosh.reading import SegmentReader
+from whoosh.writing import SegmentWriter
+
+from crawler.whoosh_backend.query import KGramIndex
+from crawler.whoosh_backend.spelling import SpellingDictionary
+
+
+class TieredMergePolicy:
+    """
+    A merge policy (a `mergetype` for `commit`) that keeps the number of segments logarithmic in the number of documents.
+
+    Segments are grouped into tiers by their number of live documents (tier n holds segments of `factor`**n to `factor`**(n+1) documents),
+    and once a tier has `factor` segments, they're merged into one (in the next tier). So each document is only rewritten once per tier,
+    instead of whenever whoosh's default policy (or `optimize`) decides to rewrite most of the index.
+
+    Segments with more than `max_deleted_ratio` of their documents deleted are rewritten (dropping the deleted documents),
+    and segments without any live documents are dropped.
+    If `max_segments` is given, the smallest segments are also merged until there are at most that many.
+    """
+
+    def __init__(
+        self,
+        factor: int = 10,
+        max_deleted_ratio: float = 0.2,
+        max_segments: Optional[int] = None,
+    ) -> None:
+        if factor < 2:
+            raise ValueError("The merge factor must be at least 2.")
+        self.factor = factor
+        self.max_deleted_ratio = max_deleted_ratio
+        self.max_segments = max_segments
+
+    def tier(self, segment) -> int:
+        return int(log(max(segment.doc_count(), 1), self.factor))
+
+    def select(self, segments) -> list:
+        """Returns the segments that should be merged (into one), smallest first."""
+        live = sorted(
+            (segment for segment in segments if segment.doc_count()),
+            key=lambda segment: segment.doc_count(),
+        )
+        selected = {
+            segment.segment_id(): segment
+            for segment in live
+            if segment.deleted_count() > self.max_deleted_ratio * segment.doc_count_all()
+        }
+        for _, tier in groupby(live, key=self.tier):
+            tier = list(tier)
+            if len(tier) >= self.factor:
+                selected.update((segment.segment_id(), segment) for segment in tier)
+        if self.max_segments and len(live) > self.max_segments:
+            # the merged segments become one, so one more than the excess is merged
+            rest = [segment for segment in live if segment.segment_id() not in selected]
+            excess = len(rest) + min(len(selected), 1) - self.max_segments
+            if excess > 0:
+                selected.update(
+                    (segment.segment_id(), segment)
+                    for segment in rest[: excess + (not selected)]
+                )
+        return sorted(selected.values(), key=lambda segment: segment.doc_count())
+
+    def __call__(self, writer: SegmentWriter, segments) -> list:
+        merged = set()
+        for segment in self.select(segments):
+            with SegmentReader(writer.storage, writer.schema, segment) as reader:
+                writer.add_reader(reader)
+            merged.add(segment.segment_id())
+        return [
+            segment
+            for segment in segments
+            if segment.doc_count() and segment.segment_id() not in merged
+        ]
+
+
+def _with_phrase_fields(schema, fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Fills in the `phrase_` fields (e.g. `phrase_content`) from their fields, if they're missing."""
+    for field in list(fields):
+        phrasename = f"phrase_{field}"
+        if (phrasename in schema._fields) and (phrasename not in fields):
+            fields[phrasename] = fields[field]
+    return fields
+
+
+class MyIndexWriter(SegmentWriter):
+    @override
+    def update_document(
+        self,
+        *,
+        comparison_functions: Optional[Dict[str, callable]] = {},
+        fields_if_exists: Optional[Dict[str, Any]] = None,
+        **fields,
+    ):
+        """
+        Works like usual with the exception of the `fields_if_exists` being a reserved keyword.
+
+        Refer to `IndexWriter.update_document` for further documentation.
+        To add or update many documents, `update_documents` is much faster.
+
+        Args:
+            fields_if_exists (Optional[Dict[str, Any]], optional): If the document exists, these fields are used instead of the ones specified with keywords. Useful for fields like "created time". Defaults to None.
+            comparison_functions (Optional[Dict[str, callable]], optional): If the document exists, use the functions in this dictionary to compare old/new values and pick one. The callable should take the old value as the first argument, and the new one as the second. It should return whichever value should be used.
+        """
+        self.update_documents(
+            [
+                dict(
+                    fields,
+                    fields_if_exists=fields_if_exists,
+                    comparison_functions=comparison_functions,
+                )
+            ]
+        )
+
+    def update_documents(self, documents: Iterable[Dict[str, Any]]) -> int:
+        """
+        Adds or updates every document, like calling `update_document` for each one.
+
+        Each document is a dict of `update_document`'s keyword arguments (the fields, and optionally `fields_if_exists` and `comparison_functions`).
+        Instead of a searcher lookup and a new reader per document, the urls are sorted and looked up together, segment by segment,
+        with the writer's reader, and the existing documents' fields are read in docnum order. Values that aren't stored
+        (e.g. `depth`) are read from their columns, so `comparison_functions` compare them with the old value too.
+        If a url appears more than once, each document updates the one before it, as if they'd been committed one by one.
+
+        Every document is checked before anything is changed.
+
+        Returns:
+            int: How many existing documents were replaced.
+        """
+        no_phrase_fields = {
+            f for f in self.schema.names() if not f.startswith("phrase_")
+        }
+        # url -> [(fields, fields_if_exists, comparison_functions)], in the order they were given
+        by_url: Dict[str, List[tuple]] = {}
+        for document in documents:
+            fields = dict(document)
+            fields_if_exists = fields.pop("fields_if_exists", None)
+            comparison_functions = fields.pop("comparison_functions", None) or {}
+            assert fields.keys() == no_phrase_fields, f"You are missing the following fields: {list(no_phrase_fields.difference(fields))}. You have the following extra fields: {list(set(fields).difference(no_phrase_fields))}"
+            by_url.setdefault(fields["url"], []).append(
+                (fields, fields_if_exists, comparison_functions)
+            )
+
+        # closed once the old documents are read, so every batch doesn't leave its segments' files open
+        with self.searcher() as searcher:
+            reader = searcher.reader()
+            existing = self._existing_docnums(reader, sorted(by_url))
+            columns = {}
+            old_documents = {}
+            for url, docnum in sorted(existing.items(), key=lambda item: item[1]):
+                old = reader.stored_fields(docnum)
+                # stored fields that are missing are None
+                for fieldname in no_phrase_fields.difference(old):
+                    if self.schema[fieldname].stored:
+                        continue
+                    if fieldname not in columns:
+                        columns[fieldname] = (
+                            reader.column_reader(fieldname)
+                            if reader.has_column(fieldname)
+                            else None
+                        )
+                    if columns[fieldname] is not None:
+                        old[fieldname] = columns[fieldname][docnum]
+                old_documents[url] = old
+
+        for url in sorted(by_url):
+            old = old_documents.get(url)
+            for fields, fields_if_exists, comparison_functions in by_url[url]:
+                if old is not None:
+                    fields = self._merge_existing(
+                        old, fields, fields_if_exists, comparison_functions
+                    )
+                old = fields
+            if url in existing:
+                self.delete_document(existing[url])
+            self.add_document(**old)
+        return len(existing)
+
+    @staticmethod
+    def _existing_docnums(reader, urls: List[str]) -> Dict[str, int]:
+        """Returns the (live) docnum of each url that's in the index. `urls` must be sorted, so the terms are read in order."""
+        docnums = {}
+        url_format = reader.schema["url"].format
+        for leaf, offset in reader.leaf_readers():
+            for url in urls:
+                if url in docnums or ("url", url) not in leaf:
+                    continue
+                # `leaf.postings` copies the segment's deleted docnums for every term, so they're checked one by one instead
+                matcher = leaf._terms.matcher("url", url.encode("utf-8"), url_format)
+                for docnum in matcher.all_ids():
+                    if not leaf.is_deleted(docnum):
+                        docnums[url] = offset + docnum
+        return docnums
+
+    @staticmethod
+    def _merge_existing(
+        old: Dict[str, Any],
+        fields: Dict[str, Any],
+        fields_if_exists: Optional[Dict[str, Any]],
+        comparison_functions: Dict[str, callable],
+    ) -> Dict[str, Any]:
+        """The fields to replace an existing document with (see `update_document`)."""
+        fields_if_exists = dict(fields if fields_if_exists is None else fields_if_exists)
+        for field, func in comparison_functions.items():
+            # fields that are left out keep their old values
+            if field in fields_if_exists and field in old:
+                fields_if_exists[field] = func(old[field], fields_if_exists[field])
+        merged = dict(fields)
+        merged.update((k, v) for k, v in old.items() if k in fields)
+        merged.update(fields_if_exists)
+        return merged
+
+    @override
+    def add_document(self, **fields):
+        """Works like usual, except the `phrase_` fields are filled in from their fields if they're missing."""
+        super().add_document(**_with_phrase_fields(self.schema, fields))
+
+    @override
+    def commit(self, mergetype=None, optimize=None, merge=None):
+        """Works like usual, except segments are merged with `TieredMergePolicy` unless told otherwise,
+        and the new segments' k-gram indexes are built (and, if it's due, the spelling dictionary, in the background)."""
+        if mergetype is None and optimize is None and merge is None:
+            mergetype = self.mergetype or TieredMergePolicy()
+        super().commit(mergetype, optimize, merge)
+        KGramIndex.build_missing(self.storage, self.indexname, self.schema)
+        SpellingDictionary.build_in_background(self.storage, self.indexname, self.schema)
+
+
+class MyMpWriter(MpWriter, MyIndexWriter):
+    """
+    An `MpWriter` (documents are analyzed by `procs` processes) that works like `MyIndexWriter`.
+
+    So `update_documents` looks up and deletes the existing documents in this process, and the analysis of the new ones is spread over the processes.
+    """
+
+    @override
+    def add_document(self, **fields):
+        MpWriter.add_document(self, **_with_phrase_fields(self.schema, fields))
+
+    @override
+    def commit(self, mergetype=None, optimize=None, merge=None):
+        if mergetype is None and optimize is None and merge is None:
+            mergetype = TieredMergePolicy()
+        MpWriter.commit(self, mergetype, optimize, merge)
+        KGramIndex.build_missing(self.storage, self.indexname, self.schema)
+        SpellingDictionary.build_in_background(self.storage, self.indexname, self.schema)
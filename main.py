@@ -1,5 +1,7 @@
+from argparse import ArgumentParser
 from datetime import datetime
 import signal
+import subprocess
 import sys
 from asyncio import set_event_loop_policy
 if sys.platform == "win32":
@@ -10,21 +12,30 @@ from scrapy import Request
 from scrapy.crawler import CrawlerProcess, create_instance, load_object
 from scrapy.utils import project
 from scrapy.utils.reactor import install_reactor
+from whoosh.index import LockError
+from crawler.sharding import merge_index, shard_settings
 from crawler.spiders import OpenNICSpider
 
 
 wait_logging = None
+SHARD = 0
+SHARDS = 1
 
 
 def start():
     from twisted.internet import task, reactor
 
     settings = project.get_project_settings()
+    if SHARDS > 1:
+        settings.setdict(shard_settings(settings, SHARD, SHARDS), priority="cmdline")
 
     process = CrawlerProcess(settings=settings)
     crawler = process.create_crawler(OpenNICSpider)
 
     def process_queued_urls():
+        # the queue is emptied when read, so only one shard reads it
+        if SHARD != 0:
+            return
         create_db("urls.db")
         urls = get_urls("urls.db")
         for url in urls:
@@ -53,13 +64,21 @@ def start():
             pass
         elapsed = time() - TIME
         wait_time = max(crawler.settings.getint("WAIT_TIME", 0) - elapsed, 0)
-        # Deletes crawl_dir before starting over (if no error is raised), to ensure a fresh crawl
+        # JOBDIR is kept between crawls, the frontier decides which urls are due to be recrawled
         if args[0] is None:
-            from shutil import rmtree
-
-            print("Crawl completed successfully, deleting JOBDIR")
-
-            rmtree(crawler.settings.get("JOBDIR"))
+            print("Crawl completed successfully")
+            if SHARDS > 1:
+                try:
+                    merged = merge_index(
+                        crawler.settings.get("INDEX_PATH"),
+                        crawler.settings.get("SHARD_MERGE_INDEX_PATH"),
+                        timeout=crawler.settings.getfloat("INDEX_WRITE_TIMEOUT", 60),
+                    )
+                    print(f"Merged {merged} record(s) from shard {SHARD} into the index")
+                except LockError:
+                    print(
+                        f"The index stayed locked, shard {SHARD}'s records will be merged after the next crawl"
+                    )
         print(f"waiting for {wait_time} to restart")
         wait_delay = reactor.callLater(wait_time, lambda *_: (start()))
         wait_logging = task.LoopingCall(wait_log)
@@ -99,7 +118,44 @@ def start():
     looping_call.start(3600)
 
 
+def run_shards(shards: int):
+    """Runs each shard in its own process, until they all stop."""
+    processes = [
+        subprocess.Popen(
+            [sys.executable, __file__, "--shards", str(shards), "--shard", str(shard)]
+        )
+        for shard in range(shards)
+    ]
+
+    def stop(*_):
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.wait()
+
+
 if __name__ == "__main__":
+    parser = ArgumentParser(description="Runs the crawler.")
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=project.get_project_settings().getint("SHARD_COUNT", 1),
+        help="The number of crawler processes, each crawls its own share of the netlocs.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=None,
+        help="Run a single shard (used internally by --shards).",
+    )
+    args = parser.parse_args()
+    SHARDS = args.shards
+    if SHARDS > 1 and args.shard is None:
+        run_shards(SHARDS)
+        sys.exit()
+    SHARD = args.shard or 0
 
     if sys.platform == "win32":
         set_event_loop_policy(WindowsSelectorEventLoopPolicy())
@@ -111,6 +167,3 @@ if __name__ == "__main__":
     reactor.run()
     # NOTE: Ctrl+C *does* stop the crawler, but it may take a moment, be patient!
 
-
-# TODO: Figure out why SQLPipeline.cleanup sometimes causes the startup to hang indefinitely.
-# Is this still an issue? Might be so infrequent it becomes negligible, might actually be fixed. Who knows.
@@ -1,4 +1,9 @@
 use std::{cmp::min, collections::HashMap, fs::read_to_string, net::Ipv4Addr};
+#[cfg(unix)]
+use std::{
+    io::{self, Read, Write},
+    os::unix::net::UnixStream,
+};
 
 use actix_files::Files;
 use actix_web::{
@@ -13,7 +18,7 @@ use actix_web::{
 use once_cell::sync::Lazy;
 use pyo3::{
     prepare_freethreaded_python,
-    types::{PyAnyMethods, PyDict, PyList, PyModule},
+    types::{PyAnyMethods, PyBytes, PyBytesMethods, PyModule},
     Python,
 };
 use rusqlite::Result;
@@ -40,6 +45,7 @@ pub struct SearchResults {
     pub maxpage: u32,
     pub query: String,
     pub valid: bool,
+    pub suggestion: Option<String>,
 }
 
 #[derive(Deserialize, Debug)]
@@ -65,94 +71,210 @@ signal.signal(signal.SIGINT, signal.SIG_DFL)
         // Import the `sys` module so we can manipulate `sys.path`
         let sys = PyModule::import_bound(py, "sys").unwrap();
         let path = sys.getattr("path").unwrap();
-        path.call_method1("append", ("../crawler/",)).unwrap();
+        // the project root, so the crawler is imported as a package (`crawler.whoosh_backend`)
+        path.call_method1("append", ("../",)).unwrap();
         path.call_method1("append", ("../.venv/Lib/site-packages/",))
             .unwrap();
-        // search(String::from("init"), 1);
-        // the first search is noticeably slower, so we do a search here to make sure the function is loaded or something
-        // it works, idk
+        // the first searches would be noticeably slower (they import whoosh, open the index and load what it caches), so that's done here.
+        // The search service's workers warm up on their own, this is for when searches run in-process
+        if CONFIG.search_socket.is_none() {
+            if let Err(e) = PyModule::import_bound(py, "crawler.whoosh_backend")
+                .and_then(|module| module.call_method1("warmup", ("../records",)))
+            {
+                eprintln!(
+                    "Warming up the search index failed ({e}), the first searches will be slower."
+                );
+            }
+        }
+    })
+}
+
+const PACKED_VERSION: u8 = 2;
+const PACKED_HEADER: usize = 20;
+const PACKED_RESULT: usize = 16;
+
+fn invalid_results(query: String) -> SearchResults {
+    SearchResults {
+        results: vec![],
+        duration: 0.0,
+        total: 0,
+        exact: true,
+        is_last: true,
+        pagenum: 0,
+        maxpage: 0,
+        query,
+        valid: false,
+        suggestion: None,
+    }
+}
+
+fn packed_field(payload: &[u8], offset: &mut usize, length: usize) -> Result<String, String> {
+    let field = payload
+        .get(*offset..*offset + length)
+        .ok_or("the packed results are truncated")?;
+    *offset += length;
+    String::from_utf8(field.to_vec()).map_err(|e| e.to_string())
+}
+
+/// Decodes the results packed by `crawler.whoosh_backend.pack_results` (the layout is documented there)
+fn unpack_results(payload: &[u8], query: String, pagenum: u32) -> Result<SearchResults, String> {
+    if payload.len() < PACKED_HEADER || !payload.starts_with(b"SLR") {
+        return Err("the payload isn't packed results".to_string());
+    }
+    if payload[3] != PACKED_VERSION {
+        return Err(format!(
+            "expected version {PACKED_VERSION} of the packed results, got version {}",
+            payload[3]
+        ));
+    }
+    let flags = payload[4];
+    if flags & 1 == 0 {
+        return Ok(invalid_results(query));
+    }
+    let u32_at = |offset: usize| u32::from_be_bytes(payload[offset..offset + 4].try_into().unwrap());
+    let count = u16::from_be_bytes([payload[6], payload[7]]) as usize;
+    let maxpage = u32_at(16);
+    let mut offset = PACKED_HEADER;
+    let mut results = Vec::with_capacity(count);
+    for _ in 0..count {
+        if payload.len() < offset + PACKED_RESULT {
+            return Err("the packed results are truncated".to_string());
+        }
+        let (url, title, snippet) = (
+            u32_at(offset) as usize,
+            u32_at(offset + 4) as usize,
+            u32_at(offset + 8) as usize,
+        );
+        offset += PACKED_RESULT;
+        results.push(SearchResult {
+            url: packed_field(payload, &mut offset, url)?,
+            title: packed_field(payload, &mut offset, title)?,
+            snippet: packed_field(payload, &mut offset, snippet)?,
+        });
+    }
+    if payload.len() < offset + 4 {
+        return Err("the packed results are truncated".to_string());
+    }
+    let suggestion_length = u32_at(offset) as usize;
+    offset += 4;
+    let suggestion = packed_field(payload, &mut offset, suggestion_length)?;
+    Ok(SearchResults {
+        results,
+        duration: f32::from_be_bytes(payload[8..12].try_into().unwrap()),
+        total: u32_at(12),
+        exact: flags & 2 != 0,
+        is_last: flags & 4 != 0,
+        pagenum: min(maxpage, pagenum),
+        maxpage,
+        query,
+        valid: true,
+        suggestion: (!suggestion.is_empty()).then_some(suggestion),
     })
 }
 
+/// Sends a request to the search service (`python -m crawler.whoosh_backend serve`), and returns its response.
+/// Both the request and the response are a 4 byte (big-endian) length, followed by the payload.
+#[cfg(unix)]
+fn service_request(socket: &str, request: serde_json::Value) -> io::Result<Vec<u8>> {
+    let mut stream = UnixStream::connect(socket)?;
+    let request = serde_json::to_vec(&request)?;
+    stream.write_all(&(request.len() as u32).to_be_bytes())?;
+    stream.write_all(&request)?;
+    let mut length = [0u8; 4];
+    stream.read_exact(&mut length)?;
+    let mut response = vec![0u8; u32::from_be_bytes(length) as usize];
+    stream.read_exact(&mut response)?;
+    Ok(response)
+}
+
+/// Sends the search to the search service. The response is packed results (or JSON, if there was an error).
+#[cfg(unix)]
+fn search_service(socket: &str, query: String, pagenum: u32) -> io::Result<SearchResults> {
+    let response = service_request(
+        socket,
+        serde_json::json!({"q": query, "p": pagenum, "f": "packed"}),
+    )?;
+    if !response.starts_with(b"SLR") {
+        let error: serde_json::Value = serde_json::from_slice(&response)?;
+        return Err(io::Error::new(io::ErrorKind::Other, error["error"].to_string()));
+    }
+    unpack_results(&response, query, pagenum).map_err(|e| io::Error::new(io::ErrorKind::InvalidData, e))
+}
+
 pub async fn search(query: String, pagenum: u32) -> SearchResults {
+    // Searches go to the search service if it's configured, so they aren't serialised by the GIL
+    #[cfg(unix)]
+    if let Some(socket) = CONFIG.search_socket.as_deref() {
+        let service_query = query.clone();
+        match block(move || search_service(socket, service_query, pagenum)).await {
+            Ok(Ok(results)) => return results,
+            Ok(Err(e)) => eprintln!("The search service failed ({e}), searching in-process instead."),
+            Err(e) => eprintln!("The search service failed ({e}), searching in-process instead."),
+        }
+    }
     let results = block(move || {
-        Python::with_gil(|py| unsafe {
-            let results_dict = PyModule::import_bound(py, "whoosh_backend")
+        // The results are packed into one bytes object, so the GIL is only held to copy it, and they're decoded after it's released
+        let payload = Python::with_gil(|py| {
+            PyModule::import_bound(py, "crawler.whoosh_backend")
                 .unwrap()
-                .call_method1("search", (&query, "../records", pagenum))
+                .call_method1("search_packed", (&query, "../records", pagenum))
                 .unwrap()
-                .downcast_into_unchecked::<PyDict>();
+                .downcast_into::<PyBytes>()
+                .unwrap()
+                .as_bytes()
+                .to_vec()
+        });
+        unpack_results(&payload, query, pagenum).unwrap()
+    })
+    .await;
+    results.unwrap()
+}
 
-            if !results_dict
-                .get_item("valid")
+pub async fn suggest(prefix: String, k: usize) -> Vec<String> {
+    #[cfg(unix)]
+    if let Some(socket) = CONFIG.search_socket.as_deref() {
+        let service_prefix = prefix.clone();
+        let response = block(move || {
+            service_request(socket, serde_json::json!({"s": service_prefix, "k": k}))
+        })
+        .await;
+        // errors are sent as a JSON object instead of a list
+        if let Ok(Ok(Ok(suggestions))) =
+            response.map(|r| r.map(|r| serde_json::from_slice::<Vec<String>>(&r)))
+        {
+            return suggestions;
+        }
+    }
+    block(move || {
+        Python::with_gil(|py| {
+            PyModule::import_bound(py, "crawler.whoosh_backend")
                 .unwrap()
-                .extract::<bool>()
+                .call_method1("suggest", (&prefix, "../records", k))
                 .unwrap()
-            {
-                return SearchResults {
-                    results: vec![],
-                    duration: 0.0,
-                    total: 0,
-                    exact: true,
-                    is_last: true,
-                    pagenum: 0,
-                    maxpage: 0,
-                    query,
-                    valid: false,
-                };
-            }
-            let results: Vec<SearchResult> = results_dict
-                .get_item("results")
+                .extract::<Vec<String>>()
                 .unwrap()
-                .downcast_into_unchecked::<PyList>()
-                .into_iter()
-                .map(|r| SearchResult {
-                    url: r.get_item("url").unwrap_unchecked().to_string(),
-                    title: r.get_item("title").unwrap_unchecked().to_string(),
-                    snippet: r.get_item("snippet").unwrap_unchecked().to_string(),
-                })
-                .collect();
-            let duration = results_dict
-                .get_item("duration")
-                .unwrap_unchecked()
-                .extract::<f32>()
-                .unwrap_unchecked();
-            let total = results_dict
-                .get_item("total")
-                .unwrap_unchecked()
-                .extract::<u32>()
-                .unwrap_unchecked();
-            let exact = results_dict
-                .get_item("exact")
-                .unwrap_unchecked()
-                .extract::<bool>()
-                .unwrap_unchecked();
-            let is_last = results_dict
-                .get_item("last")
-                .unwrap_unchecked()
-                .extract::<bool>()
-                .unwrap_unchecked();
-            let maxpage = results_dict
-                .get_item("maxpage")
-                .unwrap_unchecked()
-                .extract::<u32>()
-                .unwrap_unchecked();
-
-            SearchResults {
-                results,
-                duration,
-                total,
-                exact,
-                is_last,
-                pagenum: min(maxpage, pagenum),
-                maxpage,
-                query,
-                valid: true,
-            }
         })
     })
-    .await;
-    results.unwrap()
+    .await
+    .unwrap_or_default()
+}
+
+#[derive(Deserialize, Debug)]
+struct SuggestQuery {
+    q: Option<String>,
+    k: Option<usize>,
+}
+
+/// Type-ahead suggestions, as a JSON list
+#[get("/suggest")]
+async fn suggest_route(params: web::Query<SuggestQuery>) -> impl Responder {
+    match &params.q {
+        Some(prefix) => {
+            let k = min(params.k.unwrap_or(10), 20);
+            HttpResponse::Ok().json(suggest(prefix.to_owned(), k).await)
+        }
+        None => HttpResponse::BadRequest().finish(),
+    }
 }
 
 #[get("/search")]
@@ -272,6 +394,9 @@ struct Config {
     port: u16,
     bind_address: String,
     restrict_hostname: bool,
+    /// The Unix socket of the search service, if it's running (`python -m crawler.whoosh_backend serve`)
+    #[serde(default)]
+    search_socket: Option<String>,
 }
 
 fn load_config() -> Config {
@@ -300,6 +425,7 @@ pub async fn main() -> std::io::Result<()> {
                 .service(Files::new("/img", "./img"))
                 .service(index)
                 .service(search_route)
+                .service(suggest_route)
                 .service(faq)
                 .service(add_url)
                 .service(get_add_url)